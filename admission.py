@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+class Overloaded(Exception):
+    '''
+    The node we sent a request to was too busy to handle it
+    '''
+    pass
+
+
+class RequestClass:
+    '''
+    Requests that share a concurrency limit and a queue
+    '''
+    def __init__(self, name, concurrency, queue_size):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.queue = deque()
+
+    def __repr__(self):
+        return "RequestClass({}, running {}/{}, queued {}/{})".format(
+            self.name, self.running, self.concurrency, len(self.queue), self.queue_size)
+
+
+class AdmissionControl:
+    '''
+    Bounds the work done for incoming requests.
+
+    Each request type belongs to a class with its own limit on the requests handled at once
+    and on the requests queued behind them, so that slow requests (store_value, which pulls
+    the value from the requester) can't hold up the cheap ones. Requests beyond both limits
+    are rejected, and the caller should tell the requester that we are overloaded.
+    '''
+    def __init__(self, classes, default):
+        #request type => class, with every other type in default
+        self.classes = classes
+        self.default = default
+        #Keys of the requests admitted and not yet finished, so retransmissions aren't handled twice
+        self.active = set()
+
+    def __len__(self):
+        return len(self.active)
+
+    def class_for(self, request_type):
+        if not isinstance(request_type, str):
+            return self.default
+        return self.classes.get(request_type, self.default)
+
+    def submit(self, key, request_type, start, done):
+        '''
+        Admits a request, identified by key, running the coroutine start() once the request's
+        class has a free slot and calling done(task) once it finishes.
+        Returns False if the request was rejected
+        '''
+        if key in self.active:
+            log.debug("Already handling request %s", key)
+            return True
+
+        cls = self.class_for(request_type)
+        if cls.running < cls.concurrency:
+            self.__start(cls, key, start, done)
+        elif len(cls.queue) < cls.queue_size:
+            cls.queue.append((key, start, done))
+        else:
+            log.info("Rejecting request %s, %s is full", key, cls)
+            return False
+
+        self.active.add(key)
+        return True
+
+    def __start(self, cls, key, start, done):
+        cls.running += 1
+        task = asyncio.ensure_future(start())
+        task.add_done_callback(lambda task: self.__finished(cls, key, task, done))
+
+    def __finished(self, cls, key, task, done):
+        cls.running -= 1
+        self.active.discard(key)
+        if len(cls.queue) > 0:
+            self.__start(cls, *cls.queue.popleft())
+        done(task)
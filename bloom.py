@@ -0,0 +1,47 @@
+import hashlib
+import math
+
+class BloomFilter:
+    '''
+    Set membership with no false negatives and a false positive rate of about error_rate
+    while it holds at most capacity keys. Keys can't be removed.
+    '''
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __positions(self, key):
+        #Double hashing, every position comes from the two halves of one digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], byteorder="little")
+        h2 = int.from_bytes(digest[8:], byteorder="little") | 1
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, key):
+        '''
+        Adds key, returning whether it changed the filter. Keys that were already in it (or
+        that it gave a false positive for) don't count towards capacity, so adding a key
+        again doesn't make the filter look fuller than it is
+        '''
+        added = False
+        for pos in self.__positions(key):
+            mask = 1 << (pos & 7)
+            if not self.bits[pos >> 3] & mask:
+                self.bits[pos >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self.__positions(key))
+
+    def is_full(self):
+        return self.count > self.capacity
@@ -0,0 +1,140 @@
+'''
+Splitting files into the chunks stored in the network.
+
+FixedChunker cuts every size bytes. ContentChunker cuts where a rolling (Gear) hash of the
+last 32 bytes matches a mask, so that the cut points move with the content: inserting or
+removing bytes only changes the chunks around the edit, and the other chunks of a new
+version of a file keep the hashes they had. Like FastCDC it uses a stricter mask before the
+average size and a looser one after it, which keeps most chunks close to the average size.
+'''
+
+import hashlib
+import mmap
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+HAVE_NUMPY = np is not None
+
+#Bytes of content that each rolling hash value depends on
+WINDOW = 32
+HASH_MASK = (1 << WINDOW) - 1
+#Random value for each byte, the same for every client so that they all cut at the same points
+GEAR = tuple(int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(256))
+if HAVE_NUMPY:
+    GEAR_ARRAY = np.array(GEAR, dtype=np.uint32)
+#Bits the masks before and after the average size differ from log2(avg_size) by
+NORMALIZATION = 2
+
+def rolling_hashes(data, lo, hi):
+    '''
+    The rolling hash at each position from lo to hi of data, each the sum of the gear values
+    of the last WINDOW bytes shifted by their age
+    '''
+    start = max(0, lo - WINDOW + 1)
+    gear = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8, count=hi - start, offset=start)]
+    h = gear.copy()
+    for age in range(1, WINDOW):
+        h[age:] += gear[:-age] << np.uint32(age)
+    return h[lo - start:]
+
+
+class FixedChunker:
+    '''
+    Cuts every size bytes
+    '''
+    def __init__(self, size):
+        self.max_size = size
+
+    def cut(self, data):
+        return min(len(data), self.max_size)
+
+
+class ContentChunker:
+    '''
+    Cuts where the content says to, into chunks of min_size to max_size bytes, avg_size on
+    average. avg_size must be a power of two
+    '''
+    def __init__(self, avg_size, min_size=None, max_size=None):
+        bits = avg_size.bit_length() - 1
+        if avg_size != 1 << bits or bits <= NORMALIZATION or bits + NORMALIZATION > WINDOW:
+            raise ValueError("Average chunk size {} isn't a supported power of two".format(avg_size))
+
+        self.avg_size = avg_size
+        self.min_size = min_size if min_size is not None else avg_size // 4
+        self.max_size = max_size if max_size is not None else avg_size * 4
+        if not 0 < self.min_size <= self.avg_size <= self.max_size:
+            raise ValueError("Chunk sizes must be 0 < min <= avg <= max")
+
+        self.small_mask = (1 << (bits + NORMALIZATION)) - 1
+        self.large_mask = (1 << (bits - NORMALIZATION)) - 1
+
+    def cut(self, data):
+        '''
+        The length of the chunk at the start of data, which must hold at least max_size
+        bytes unless it runs to the end of the file
+        '''
+        end = min(len(data), self.max_size)
+        if end <= self.min_size:
+            return end
+        if HAVE_NUMPY:
+            return self.cut_numpy(data, end)
+        return self.cut_python(data, end)
+
+    def cut_python(self, data, end):
+        #The hash only depends on the last WINDOW bytes, so start that far before the first
+        #position that can be cut at
+        h = 0
+        for i in range(max(0, self.min_size - WINDOW), self.min_size):
+            h = ((h << 1) + GEAR[data[i]]) & HASH_MASK
+
+        mask = self.small_mask
+        for i in range(self.min_size, end):
+            h = ((h << 1) + GEAR[data[i]]) & HASH_MASK
+            if i == self.avg_size:
+                mask = self.large_mask
+            if h & mask == 0:
+                return i + 1
+        return end
+
+    def cut_numpy(self, data, end):
+        #Most chunks are cut near the average size, so the hashes past it are only worked
+        #out a block at a time as they are needed
+        ranges = [(self.min_size, min(end, self.avg_size), self.small_mask)]
+        for lo in range(self.avg_size, end, self.avg_size):
+            ranges.append((lo, min(end, lo + self.avg_size), self.large_mask))
+
+        for lo, hi, mask in ranges:
+            if lo >= hi:
+                continue
+            hits = np.flatnonzero((rolling_hashes(data, lo, hi) & np.uint32(mask)) == 0)
+            if len(hits) > 0:
+                return lo + int(hits[0]) + 1
+        return end
+
+
+
+def map_file(path):
+    '''
+    The contents of the file at path, memory mapped read only. The map is closed once nothing
+    references it
+    '''
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+def chunk_bounds(data, chunker):
+    '''
+    Generates (offset, size) for each chunk of data, a bytes-like object such as a mapped
+    file, cut by chunker. Slices of data are only looked at, never copied
+    '''
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        size = chunker.cut(view[offset:offset + chunker.max_size])
+        yield offset, size
+        offset += size
@@ -1,11 +1,21 @@
-from os import path
+from os import SEEK_CUR, SEEK_END, SEEK_SET, cpu_count, path, pwrite
 from argparse import ArgumentParser
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import sys
 import asyncio
 
+import chunking
+import compression
+from chunking import ContentChunker, FixedChunker, chunk_bounds, map_file
+from compression import NONE, encode
 from dht import startup as start_dht
 from hash_utils import hash_data
+from eviction import is_id
+from manifest import LEAF, build_manifest, verify_page
+from storage import ChunkCache
 
 FAKE_HASHES = [
     ("1EB79602411EF02CF6FE117897015FFF89F80FACE4ECCD50425C45149B148408", 992358),
@@ -16,12 +26,29 @@ FAKE_HASHES = [
     ("9F86D081884C7D659A2FEAA0C55AD015A3BF4F1B2B0B822CD15D6C15B0F00A08", 600106),
     ("3A4278F83ECEA3815F068FF7E014DD671BC7D790661F139315B2952888356A72", 907218),
 ]
-DEFAULT_PATH = path.relpath("./dht_store/")
 MAX_CHUNK_SIZE = 1 << 20
+#Average size of content defined chunks
+CONTENT_CHUNK_SIZE = 1 << 20
+#Number of chunks retrieved at once
+DEFAULT_WINDOW = 8
+#Bytes of recently read chunks a RemoteFileReader keeps in memory
+READER_CACHE_SIZE = 16 << 20
+#Manifest pages a reader keeps in memory, enough for the path to a chunk in any file
+MAX_MANIFEST_PAGES = 8
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+def write_at(fd, data, offset):
+    '''
+    Writes all of data at offset in the file fd, leaving its position alone
+    '''
+    view = memoryview(data)
+    while len(view) > 0:
+        written = pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
 byte_suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 def humansize(nbytes):
     '''
@@ -54,22 +81,309 @@ def humansize(nbytes):
     return '%s %s' % (f, byte_suffixes[i])
 
 
+def hash_chunk(view, codec=NONE):
+    '''
+    Hashes a chunk of a mapped file, returning the hash, the size and the value to store for
+    the chunk, compressed with codec, which doesn't keep the file mapped
+    '''
+    return hash_data(view), len(view), encode(view, codec)
+
+
+class ChunkList:
+    '''
+    The chunks of a file from a hash file or a list of hash-size tuples
+    '''
+    def __init__(self, hashes):
+        self.hashes = list(hashes)
+        self.offsets = [0]
+        for (hash, size) in self.hashes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.size = self.offsets[-1]
+
+    @asyncio.coroutine
+    def locate(self, offset):
+        '''
+        (hash, start, size) of the chunk holding the byte at offset
+        '''
+        i = bisect_right(self.offsets, offset) - 1
+        hash, size = self.hashes[i]
+        return hash, self.offsets[i], size
+
+    @asyncio.coroutine
+    def all(self):
+        return self.hashes
+
+
+class ManifestChunks:
+    '''
+    The chunks of a file from its manifest in the network, fetching the pages that are
+    needed as they are needed and checking each against the hash and size its parent gives
+    for it. Up to MAX_MANIFEST_PAGES pages are kept
+    '''
+    def __init__(self, dht, root, page):
+        self.dht = dht
+        self.root = root
+        self.size = page.size
+        #hash => page, least recently used first
+        self.pages = OrderedDict([(root, page)])
+
+    @classmethod
+    @asyncio.coroutine
+    def load(cls, dht, root):
+        data = yield from dht.get_value(root)
+        if data is None:
+            raise Exception("Failed to retrieve manifest {}".format(root))
+        return cls(dht, root, verify_page(root, data))
+
+    @asyncio.coroutine
+    def page(self, hash, size):
+        page = self.pages.get(hash)
+        if page is not None:
+            self.pages.move_to_end(hash)
+            return page
+
+        data = yield from self.dht.get_value(hash)
+        if data is None:
+            raise Exception("Failed to retrieve manifest page {}".format(hash))
+        page = verify_page(hash, data, size)
+        self.pages[hash] = page
+        if len(self.pages) > MAX_MANIFEST_PAGES:
+            self.pages.popitem(last=False)
+        return page
+
+    @asyncio.coroutine
+    def locate(self, offset):
+        '''
+        (hash, start, size) of the chunk holding the byte at offset, fetching one page for
+        each level of the manifest that isn't already kept
+        '''
+        page = yield from self.page(self.root, None)
+        start = 0
+        while True:
+            i = page.locate(offset - start)
+            hash, size = page.hashes[i], page.sizes[i]
+            start += page.offsets[i]
+            if page.kind == LEAF:
+                return hash, start, size
+            page = yield from self.page(hash, size)
+
+    @asyncio.coroutine
+    def all(self):
+        '''
+        Every (hash, size) chunk of the file, fetching each page of the manifest
+        '''
+        hashes = []
+        offset = 0
+        while offset < self.size:
+            hash, start, size = yield from self.locate(offset)
+            hashes.append((hash, size))
+            offset = start + size
+        return hashes
+
+
+class RemoteFileReader:
+    '''
+    A stored file opened for reading without it going through the local disk.
+
+    Reads the file a chunk at a time (read_chunk, or async for) or like a read only file
+    (read, seek and tell), fetching only the chunks that are read, which chunks (a ChunkList
+    or ManifestChunks) finds by offset. Up to prefetch chunks after the one being read are
+    fetched in the background, but none past end. The chunks read last are kept in memory
+    for reads near them
+    '''
+    def __init__(self, client, chunks, prefetch=DEFAULT_WINDOW, cache_size=READER_CACHE_SIZE,
+            end=None):
+        self.client = client
+        self.chunks = chunks
+        self.prefetch = max(0, prefetch)
+        self.size = chunks.size
+        self.end = self.size if end is None else min(end, self.size)
+        self.position = 0
+        #chunk start => future for the chunk, of the chunks being fetched
+        self.fetching = {}
+        self.cache = ChunkCache(cache_size)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        chunk = yield from self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.position
+        elif whence == SEEK_END:
+            offset += self.size
+        elif whence != SEEK_SET:
+            raise ValueError("Invalid whence {}".format(whence))
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self.position = offset
+        return offset
+
+    @asyncio.coroutine
+    def fill(self, location):
+        '''
+        Fetches the chunk at location and the prefetch chunks after it that aren't past end,
+        and stops fetching any other chunks
+        '''
+        wanted = [location]
+        while len(wanted) <= self.prefetch:
+            _, start, size = wanted[-1]
+            if start + size >= self.end:
+                break
+            wanted.append((yield from self.chunks.locate(start + size)))
+
+        starts = set(start for (_, start, _) in wanted)
+        for start in list(self.fetching):
+            if start not in starts:
+                self.fetching.pop(start).cancel()
+
+        new = [(hash, start) for (hash, start, _) in wanted
+            if start not in self.fetching and hash not in self.cache]
+        if len(new) == 0:
+            return
+        #Rank the routing table against the new chunks at once
+        plans = self.client.dht.plan_lookups(hash for (hash, _) in new)
+        for hash, start in new:
+            self.fetching[start] = asyncio.ensure_future(
+                self.client.dht.get_value(hash, candidates=plans[hash]))
+
+    @asyncio.coroutine
+    def chunk(self, offset):
+        '''
+        The start and data of the chunk holding the byte at offset. Raises ValueError if the
+        chunk isn't the size the file's chunk list gives for it, since the offsets of the
+        rest of the file would be wrong
+        '''
+        location = yield from self.chunks.locate(offset)
+        hash, start, size = location
+        yield from self.fill(location)
+        chunk = self.cache.get(hash)
+        if chunk is None:
+            chunk = yield from self.fetching.pop(start)
+            if chunk is None:
+                raise Exception("Failed to retrieve chunk {}".format(hash))
+            self.cache.put(hash, chunk)
+        if len(chunk) != size:
+            raise ValueError("Chunk {} is {} bytes, expected {}".format(hash, len(chunk), size))
+        return start, chunk
+
+    @asyncio.coroutine
+    def read_chunk(self):
+        '''
+        The rest of the chunk at the current position, or b"" at the end of the file. From
+        the start of the file this gives each of its chunks in order
+        '''
+        if self.position >= self.size:
+            return b""
+        start, chunk = yield from self.chunk(self.position)
+        data = chunk[self.position - start:]
+        self.position = start + len(chunk)
+        return data
+
+    @asyncio.coroutine
+    def read(self, size=-1):
+        '''
+        Up to size bytes from the current position, or all of the rest of the file if size is
+        negative
+        '''
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        parts = []
+        while self.position < end:
+            start, chunk = yield from self.chunk(self.position)
+            stop = min(start + len(chunk), end)
+            parts.append(chunk[self.position - start:stop - start])
+            self.position = stop
+        return b"".join(parts)
+
+    def close(self):
+        '''
+        Stops fetching the chunks that haven't been read
+        '''
+        for fut in self.fetching.values():
+            fut.cancel()
+        self.fetching.clear()
+
+
 class DistributedClient:
-    def __init__(self, dht, loop):
+    def __init__(self, dht, loop, window=DEFAULT_WINDOW, chunker=None, hash_threads=None,
+            codec=NONE):
         self.dht = dht
         self.loop = loop
+        self.window = window
+        #How files are split into chunks, chunking.FixedChunker or chunking.ContentChunker
+        self.chunker = chunker or FixedChunker(MAX_CHUNK_SIZE)
+        if isinstance(self.chunker, ContentChunker) and not chunking.HAVE_NUMPY:
+            log.warning("NumPy isn't installed, so content defined chunking runs in pure python, "
+                "at a few MB/s")
+        #Chunks of a stored file are hashed on this many threads at once, one per core by
+        #default, as hashlib lets go of the GIL while hashing
+        self.hash_threads = hash_threads or cpu_count() or 1
+        self.hash_pool = ThreadPoolExecutor(max_workers=self.hash_threads)
+        #Stored chunks are compressed with this compression codec, on the hashing threads.
+        #Chunks it doesn't make smaller are stored as they are
+        self.codec = codec
 
-    def __retrieve_from_hashes(self, hashes):
+    @asyncio.coroutine
+    def __retrieve_from_hashes(self, hashes, local_file):
         '''
         Given a list of tuples containing hashes and chunk sizes, retrieves the
-        data chunks and creates a local copy of the file
+        data chunks and writes each one at its offset in local_file as it arrives,
+        keeping up to self.window chunks in flight at once. The writes are done on
+        the default executor, so they don't hold up the event loop
         '''
-        for (hash, size) in hashes:
-            log.debug("Retrieving chunk %s", hash)
-            val = self.loop.run_until_complete(self.dht.get_value(hash))
-            yield val
+        #Rank our routing table against all of the chunks at once
+        plans = self.dht.plan_lookups(hash for (hash, size) in hashes)
 
-        yield None
+        offsets = []
+        offset = 0
+        for (hash, size) in hashes:
+            offsets.append(offset)
+            offset += size
+
+        in_flight = {}
+        failed = []
+        remaining = iter(zip(hashes, offsets))
+        while True:
+            for ((hash, size), offset) in remaining:
+                log.debug("Retrieving chunk %s", hash)
+                fut = asyncio.ensure_future(self.dht.get_value(hash, candidates=plans[hash]))
+                in_flight[fut] = (hash, size, offset)
+                if len(in_flight) >= self.window:
+                    break
+
+            if len(in_flight) == 0:
+                break
+
+            done, _ = yield from asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                hash, size, offset = in_flight.pop(fut)
+                if fut.exception() is not None or fut.result() is None:
+                    log.warning("Failed to retrieve chunk %s: %s", hash, fut.exception())
+                    failed.append(hash)
+                    continue
+
+                chunk = fut.result()
+                if len(chunk) != size:
+                    log.warning("Chunk %s is %d bytes, expected %d", hash, len(chunk), size)
+                    failed.append(hash)
+                    continue
+                yield from self.loop.run_in_executor(
+                    None, write_at, local_file.fileno(), chunk, offset)
+
+        if len(failed) > 0:
+            raise Exception("Failed to retrieve {} of {} chunks".format(len(failed), len(hashes)))
 
     def hashes_from_file(self, hashfile_path):
         # read hashes from file
@@ -87,40 +401,99 @@ class DistributedClient:
             # hashes = map(lambda pair: (pair[0], int(pair[1])), pairs)
             # return hashes
 
-    def __retrieve_from_file(self, hashfile_path):
+    @asyncio.coroutine
+    def chunks_of(self, hash_data):
+        '''
+        The chunks of a remote file, as a ChunkList or ManifestChunks
+
+        Args:
+            hash_data (str | [(str, int)...]): a string containing either a path
+                to a hash file or the root hash of a manifest, or a list of
+                hash-size tuples
         '''
-        Given a path to a file containing hashes and chunk sizes, retrieves the
-        data chunks and creates a local copy of the file
+        if not isinstance(hash_data, str):
+            return ChunkList(hash_data)
+        if not path.exists(hash_data) and is_id(hash_data):
+            return (yield from ManifestChunks.load(self.dht, hash_data))
+        return ChunkList(self.hashes_from_file(hash_data))
+
+    @asyncio.coroutine
+    def open_file(self, hash_data, prefetch=None, end=None):
+        '''
+        Opens a remote file for reading, without writing it to disk. Opening by
+        a manifest root only fetches the root page, the rest of the manifest is
+        fetched as it is read
+
+        Args:
+            hash_data (str | [(str, int)...]): a string containing either a path
+                to a hash file or the root hash of a manifest, or a list of
+                hash-size tuples
+            prefetch (int | None): number of chunks to fetch ahead of the one
+                being read, self.window by default
+            end (int | None): offset past which chunks are only fetched once read
+        Return:
+            (RemoteFileReader) reader for the file
+        '''
+        chunks = yield from self.chunks_of(hash_data)
+        if prefetch is None:
+            prefetch = self.window
+        return RemoteFileReader(self, chunks, prefetch, end=end)
+
+    @asyncio.coroutine
+    def read_range(self, hash_data, offset, length):
+        '''
+        Reads length bytes of a remote file from offset, fetching only the
+        chunks that overlap them
+
+        Args:
+            hash_data (str | [(str, int)...]): a string containing either a path
+                to a hash file or the root hash of a manifest, or a list of
+                hash-size tuples
+            offset (int): where in the file to start reading
+            length (int): number of bytes to read
+        Return:
+            (bytes) the bytes read, fewer than length if the file ends first
         '''
-        return self.__retrieve_from_hashes(self.hashes_from_file(hashfile_path))
+        reader = yield from self.open_file(hash_data, end=offset + length)
+        try:
+            reader.seek(offset)
+            return (yield from reader.read(length))
+        finally:
+            reader.close()
 
     def retrieve_file(self, hash_data, file_path):
+        '''
+        Retrieves the data chunks of a remote file and creates a local copy.
+        Runs the event loop until it is done, so it can't be called from a
+        coroutine, which should use retrieve_file_async instead
+        '''
+        return self.loop.run_until_complete(self.retrieve_file_async(hash_data, file_path))
+
+    @asyncio.coroutine
+    def retrieve_file_async(self, hash_data, file_path):
         '''
         Retrieves the data chunks of a remote file and creates a local copy
 
         Args:
-            hash_data (str | [(str, int)...]): either a string containing a path
-                to a hash file, or a list of hash-size tuples
+            hash_data (str | [(str, int)...]): a string containing either a path
+                to a hash file or the root hash of a manifest, or a list of
+                hash-size tuples
             file_path (str): the local file path to create the local copy
         Return:
             (str) file path of retrieved file
         '''
-        # determine retrieval function to use
-        if isinstance(hash_data, str):
-            retrieve_fn = self.__retrieve_from_file
-        else:
-            retrieve_fn = self.__retrieve_from_hashes
+        chunks = yield from self.chunks_of(hash_data)
+        hashes = yield from chunks.all()
 
-        # write to the file as chunks become available
+        # chunks arrive out of order, so size the file up front and write
+        # each chunk at its offset
         with open(file_path, "wb") as local_file:
-            for chunk in retrieve_fn(hash_data):
-                if chunk is not None:
-                    # write to local file
-                    local_file.write(chunk)
+            local_file.truncate(sum(size for (hash, size) in hashes))
+            yield from self.__retrieve_from_hashes(hashes, local_file)
 
         if isinstance(hash_data, str):
             log.info(
-                "Retrieved file from hashes in '%s' to '%s'" % \
+                "Retrieved file '%s' to '%s'" % \
                 (hash_data, file_path))
 
         return file_path
@@ -142,60 +515,179 @@ class DistributedClient:
         '''
         Stores file data on the network and returns a set of hashes stored
 
+        The chunks go through a pipeline of stages: read, hash and store locally,
+        look up the nodes to store on, and ask those nodes to store the chunk.
+        The file is memory mapped and its chunks hashed self.hash_threads at a time,
+        in order.
+        Each stage after the first runs self.window workers, with a queue of at
+        most self.window chunks in front of it, so the lookups and transfers of
+        different chunks overlap while the file is still being read. A chunk that
+        appears more than once in the file is only stored once
+
         Args:
             file_path (str): the local file to be stored
         Returns:
             [(str, int), ...] a list of hash-size tuples
         '''
-        unread = path.getsize(file_path)
-        start = unread
+        start = path.getsize(file_path)
         hashes = []
-    
-        with open(file_path, "rb") as file:
-            while unread > 0:
-                chunk = file.read(MAX_CHUNK_SIZE)
-                hash = hash_data(chunk)
+        lookups = asyncio.Queue(maxsize=self.window)
+        replications = asyncio.Queue(maxsize=self.window)
+        stored = [0]
+
+        @asyncio.coroutine
+        def read():
+            seen = set()
+            data = yield from self.loop.run_in_executor(None, map_file, file_path)
+            view = memoryview(data)
+            bounds = chunk_bounds(data, self.chunker)
+            #Chunks being hashed, in the order they are in the file
+            hashing = deque()
+            while True:
+                while len(hashing) < self.hash_threads:
+                    bound = yield from self.loop.run_in_executor(None, next, bounds, None)
+                    if bound is None:
+                        break
+                    offset, size = bound
+                    hashing.append(self.loop.run_in_executor(
+                        self.hash_pool, hash_chunk, view[offset:offset + size], self.codec))
+                if len(hashing) == 0:
+                    return
+
+                hash, size, value = yield from hashing.popleft()
+                hashes.append((hash, size))
+                if hash in seen:
+                    stored[0] += size
+                    continue
+                seen.add(hash)
+
+                # the nodes we store on pull the chunk from our storage
+                yield from self.dht.disk.set(hash, value)
+                yield from lookups.put((hash, size))
+
+        @asyncio.coroutine
+        def lookup():
+            while True:
+                item = yield from lookups.get()
+                if item is None:
+                    return
+                nodes = yield from self.dht.find_node(item[0])
+                yield from replications.put(item + (nodes,))
+
+        @asyncio.coroutine
+        def replicate():
+            while True:
+                item = yield from replications.get()
+                if item is None:
+                    return
+                hash, size, nodes = item
+                yield from self.dht.replicate(hash, nodes)
+
+                stored[0] += size
+                log.info("Saving: {:.2%} done".format(float(stored[0])/start))
+
+        readers = [asyncio.ensure_future(read())]
+        lookers = [asyncio.ensure_future(lookup()) for _ in range(self.window)]
+        replicators = [asyncio.ensure_future(replicate()) for _ in range(self.window)]
+        tasks = readers + lookers + replicators + [
+            asyncio.ensure_future(self.__close_stage(readers, lookups, len(lookers))),
+            asyncio.ensure_future(self.__close_stage(lookers, replications, len(replicators))),
+        ]
+
+        done, pending = yield from asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
 
-                yield from self.dht.store_value(hash, chunk)
-                hashes.append((hash, min(MAX_CHUNK_SIZE, unread)))
+        return hashes
 
-                unread -= min(MAX_CHUNK_SIZE, unread)
-                log.info("Saving: {:.2%} done".format(1. - (float(unread)/start)))
+    @asyncio.coroutine
+    def store_manifest(self, hashes):
+        '''
+        Stores the manifest of a file in the network, self.window pages at a
+        time, so that the file can be retrieved by the root hash alone
 
-        return hashes
+        Args:
+            hashes ([(str, int), ...]): the file's list of hash-size tuples
+        Returns:
+            (str) the root hash of the manifest
+        '''
+        root, pages = build_manifest(hashes)
+        pending = set()
+        for hash, page in pages:
+            pending.add(asyncio.ensure_future(self.dht.store_value(hash, page)))
+            if len(pending) >= self.window:
+                done, pending = yield from asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    fut.result()
+        if len(pending) > 0:
+            done, _ = yield from asyncio.wait(pending)
+            for fut in done:
+                fut.result()
+        return root
+
+    @asyncio.coroutine
+    def __close_stage(self, workers, queue, consumers):
+        '''
+        Once all of a stage's workers are done, tells each of the consumers of
+        its output queue to stop
+        '''
+        yield from asyncio.wait(workers)
+        for _ in range(consumers):
+            yield from queue.put(None)
 
     def store_file(self, file_path, hashfile_path=None):
         '''
         Distributes all data to the network and creates a local file that
-        contains the metadata required to retreive the data back on request
+        contains the metadata required to retreive the data back on request.
+        Runs the event loop until it is done, so it can't be called from a
+        coroutine, which should use store_file_async instead
+        '''
+        return self.loop.run_until_complete(self.store_file_async(file_path, hashfile_path))
+
+    @asyncio.coroutine
+    def store_file_async(self, file_path, hashfile_path=None):
+        '''
+        Distributes all data to the network along with its manifest, and
+        creates a local file that contains the metadata required to retreive
+        the data back on request. The file can also be retrieved by the root
+        hash of its manifest, which is logged
 
         Args:
             file_path (str): the local file to be stored
-            hashfile_path (str | None): the local file to write the hashes to
+            hashfile_path (str | None): the local file to write the hashes to,
+                by default <name>-<start of root hash>.hashes in the current
+                directory. Never the storage directory, where a file named
+                like a hash would be taken for a stored value
         Returns:
             (str) file path of created hash file
         '''
         # get file hashes
-        hashes = self.loop.run_until_complete(self.__store_file(file_path))
+        hashes = yield from self.__store_file(file_path)
+        root = yield from self.store_manifest(hashes)
 
         # determine hash file path
-        # TODO: better file name choice
         if hashfile_path is None:
-            hashfile_path = path.join(DEFAULT_PATH, hashes[0][0])
+            hashfile_path = "{}-{}.hashes".format(path.basename(file_path), root[:16])
         hashfile_path = path.abspath(hashfile_path)
 
         # write out hashes
         self.__write_hashfile(hashfile_path, hashes)
 
         log.info(
-            "Stored file '%s' and wrote hashes to '%s'" % \
-            (file_path, hashfile_path))
+            "Stored file '%s' with manifest %s and wrote hashes to '%s'" % \
+            (file_path, root, hashfile_path))
 
         return hashfile_path;
 
-def main(store, retrieve, config_file):
+def main(store, retrieve, config_file, window, content_chunking, hash_threads, compress):
     loop, dht = start_dht(config_file)
-    client = DistributedClient(dht, loop)
+    chunker = ContentChunker(CONTENT_CHUNK_SIZE) if content_chunking else None
+    codec = compression.BY_NAME[compress]
+    client = DistributedClient(dht, loop, window, chunker, hash_threads, codec)
 
     if store:
         client.store_file(*store)
@@ -216,7 +708,7 @@ if __name__ == "__main__":
     group.add_argument(
         "-r", "--retrieve",
         nargs=2,
-        help="Retrieves a file; first argument specifies hash file; second " +
+        help="Retrieves a file; first argument specifies hash file or manifest root; second " +
             "argument specifies destination of retrieved file",
         metavar=("source_loc", "dest_loc"))
     arg.add_argument(
@@ -225,7 +717,32 @@ if __name__ == "__main__":
         default="config.json",
         help="Config file location",
         metavar="config_path")
+    arg.add_argument(
+        "-w", "--window",
+        dest="window",
+        default=DEFAULT_WINDOW, type=int,
+        help="Number of chunks to transfer at once",
+        metavar="num_chunks")
+    arg.add_argument(
+        "-d", "--dedup",
+        dest="content_chunking",
+        action="store_true",
+        help="Split stored files where their content says to rather than every " +
+            "%s, so that versions of a file share most of their chunks" % humansize(MAX_CHUNK_SIZE))
+
+    arg.add_argument(
+        "-t", "--hash-threads",
+        dest="hash_threads",
+        default=None, type=int,
+        help="Number of chunks to hash at once, one per core by default",
+        metavar="num_threads")
+    arg.add_argument(
+        "-z", "--compress",
+        dest="compress",
+        default="none", choices=["none"] + compression.names(),
+        help="Compression codec to store chunks with, none by default")
 
     args = arg.parse_args()
 
-    main(args.store, args.retrieve, args.config_file)
+    main(args.store, args.retrieve, args.config_file, args.window, args.content_chunking,
+        args.hash_threads, args.compress)
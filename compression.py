@@ -0,0 +1,268 @@
+'''
+Compressed values, chosen per chunk when it is stored.
+
+A compressed value is kept on disk and sent between nodes as a frame: the marker, the codec
+and the size of the uncompressed value, followed by the compressed data. Values that aren't
+compressed are kept as they are, unless they happen to start with the marker, in which case
+they go in a frame of codec NONE so that every stored value reads back the same way. Keys
+stay the hash of the uncompressed value, so a value is checked the same way however it was
+stored or sent.
+
+zlib is always available, zstd and lz4 when the zstandard and lz4 packages are installed.
+'''
+
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+HAVE_ZSTD = zstandard is not None
+HAVE_LZ4 = lz4 is not None
+
+MARKER = b"\x00DZ"
+#Marker, codec, size of the uncompressed value
+FRAME = struct.Struct(">3sBQ")
+NONE, ZLIB, ZSTD, LZ4 = range(4)
+
+#Transfers between nodes cost more than compressing, so the slower codecs are worked hard
+ZLIB_LEVEL = 9
+ZSTD_LEVEL = 15
+#Largest value that is compressed, the largest chunk a client stores (content defined chunks
+#are up to 4 times their 1 MB average). The size in a frame comes from whoever stored or sent
+#the value, so frames claiming more are rejected before anything is decompressed
+MAX_VALUE_SIZE = 4 << 20
+#Most output a decompressor produces at once
+DECOMPRESS_STEP = 1 << 16
+
+
+class Decompressor:
+    '''
+    Decompresses a value a piece at a time. Codecs produce their output at most
+    DECOMPRESS_STEP bytes at a time, and decompress raises a ValueError as soon as the output
+    would pass limit bytes, so a frame that inflates to far more than its size says is
+    caught before it takes up much memory
+    '''
+    def decompress(self, data, limit):
+        self.limit = limit
+        self.pieces = []
+        try:
+            self.run(data)
+            return b"".join(self.pieces)
+        finally:
+            self.pieces = None
+
+    def write(self, piece):
+        self.limit -= len(piece)
+        if self.limit < 0:
+            raise ValueError("Value decompressed past its expected size")
+        self.pieces.append(piece)
+        return len(piece)
+
+
+class Identity(Decompressor):
+    '''
+    Decompressor for values that were stored without compressing them
+    '''
+    def run(self, data):
+        self.write(bytes(data))
+
+
+class ZlibDecompressor(Decompressor):
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+
+    def run(self, data):
+        while True:
+            piece = self.decompressor.decompress(data, DECOMPRESS_STEP)
+            self.write(piece)
+            data = self.decompressor.unconsumed_tail
+            #A full step may leave output pending even once all of the input is taken
+            if not data and len(piece) < DECOMPRESS_STEP:
+                return
+
+
+class ZstdDecompressor(Decompressor):
+    def __init__(self):
+        #The stream hands its output to write as it goes, DECOMPRESS_STEP bytes at a time
+        self.stream = zstandard.ZstdDecompressor().stream_writer(
+            self, write_size=DECOMPRESS_STEP)
+
+    def run(self, data):
+        self.stream.write(data)
+
+
+class LZ4Decompressor(Decompressor):
+    def __init__(self):
+        self.decompressor = lz4.frame.LZ4FrameDecompressor()
+
+    def run(self, data):
+        while not self.decompressor.eof:
+            self.write(self.decompressor.decompress(data, DECOMPRESS_STEP))
+            data = b""
+            if self.decompressor.needs_input:
+                return
+
+
+class Codec:
+    def __init__(self, name, compress, decompressor):
+        self.name = name
+        self.compress = compress
+        #Makes a Decompressor
+        self.decompressor = decompressor
+
+
+CODECS = {
+    NONE: Codec("none", bytes, Identity),
+    ZLIB: Codec("zlib", lambda data: zlib.compress(data, ZLIB_LEVEL), ZlibDecompressor),
+}
+if HAVE_ZSTD:
+    CODECS[ZSTD] = Codec("zstd",
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress, ZstdDecompressor)
+if HAVE_LZ4:
+    CODECS[LZ4] = Codec("lz4", lz4.frame.compress, LZ4Decompressor)
+
+BY_NAME = { codec.name: n for n, codec in CODECS.items() }
+
+def names():
+    '''
+    Names of the codecs we can compress and decompress with, other than none
+    '''
+    return [codec.name for n, codec in sorted(CODECS.items()) if n != NONE]
+
+def parse_names(names):
+    '''
+    The set of codecs named, ignoring the names we don't know
+    '''
+    return set(BY_NAME[name] for name in names if name in BY_NAME)
+
+def codec_of(data):
+    '''
+    The codec of a stored value, given at least its first FRAME.size bytes, or None if it
+    isn't in a frame
+    '''
+    data = bytes(data[:FRAME.size])
+    if not data.startswith(MARKER):
+        return None
+    if len(data) < FRAME.size:
+        raise ValueError("Truncated compressed value")
+    _, codec, _ = FRAME.unpack_from(data)
+    if codec not in CODECS:
+        raise ValueError("Value compressed with unknown codec {}".format(codec))
+    return codec
+
+def frame_size(data):
+    '''
+    The size of the uncompressed value in the frame at the start of data, checking that it
+    isn't too large to decompress
+    '''
+    _, codec, size = FRAME.unpack_from(data)
+    if codec != NONE and size > MAX_VALUE_SIZE:
+        raise ValueError("Compressed value claims {} bytes, more than the {} allowed".format(
+            size, MAX_VALUE_SIZE))
+    return size
+
+def encode(data, codec=NONE):
+    '''
+    The value to store for data, compressed with codec unless that wouldn't make it smaller
+    or it is too large to decompress again
+    '''
+    if codec != NONE and len(data) <= MAX_VALUE_SIZE:
+        packed = CODECS[codec].compress(data)
+        if FRAME.size + len(packed) < len(data):
+            return FRAME.pack(MARKER, codec, len(data)) + packed
+    data = bytes(data)
+    if data.startswith(MARKER):
+        return FRAME.pack(MARKER, NONE, len(data)) + data
+    return data
+
+def decode(data):
+    '''
+    The uncompressed value of a stored value
+    '''
+    codec = codec_of(data)
+    if codec is None:
+        return data
+    size = frame_size(data)
+    value = CODECS[codec].decompressor().decompress(data[FRAME.size:], size)
+    if len(value) != size:
+        raise ValueError("Value decompressed to {} bytes, expected {}".format(len(value), size))
+    return value
+
+def sendable(codec, codecs):
+    '''
+    Whether a value stored with codec (None if it isn't in a frame) can be sent as it is to a
+    peer that decodes codecs, or that only takes uncompressed values if codecs is None
+    '''
+    return codec is None or (codecs is not None and (codec == NONE or codec in codecs))
+
+def transcode(data, codecs):
+    '''
+    A stored value as it can be sent to a peer that decodes codecs, as for sendable
+    '''
+    if sendable(codec_of(data), codecs):
+        return data
+    value = decode(data)
+    return value if codecs is None else encode(value)
+
+
+class IncomingValue:
+    '''
+    A value arriving a piece at a time from a peer, which sends it as it is stored if
+    encoded, and otherwise uncompressed. feed and finish give the bytes to store and the
+    uncompressed bytes to check its hash against
+    '''
+    def __init__(self, size, encoded):
+        self.size = size
+        self.encoded = encoded
+        #The first bytes, until there are enough to tell whether the value is in a frame
+        self.head = b""
+        self.started = False
+        self.decompressor = Identity()
+        self.expected = None
+        self.decoded = 0
+
+    def feed(self, data):
+        if self.started:
+            return data, self.decompress(data)
+
+        self.head += data
+        if len(self.head) < min(FRAME.size, self.size):
+            return b"", b""
+        return self.start()
+
+    def finish(self):
+        stored, value = (b"", b"") if self.started else self.start()
+        tail = self.decompress(b"")
+        if self.expected is not None and self.decoded != self.expected:
+            raise ValueError("Value decompressed to {} bytes, expected {}".format(
+                self.decoded, self.expected))
+        return stored, value + tail
+
+    def start(self):
+        data, self.head = self.head, b""
+        self.started = True
+        if not self.encoded:
+            if data.startswith(MARKER):
+                return FRAME.pack(MARKER, NONE, self.size) + data, data
+            return data, data
+
+        codec = codec_of(data)
+        if codec is None:
+            return data, data
+        self.expected = frame_size(data)
+        self.decompressor = CODECS[codec].decompressor()
+        return data, self.decompress(data[FRAME.size:])
+
+    def decompress(self, data):
+        expected = self.size if self.expected is None else self.expected
+        value = self.decompressor.decompress(data, expected - self.decoded)
+        self.decoded += len(value)
+        return value
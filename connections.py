@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import struct
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+#First line sent on a connection to switch it to the framed protocol, echoed back by the server
+HELLO = b"MUX1\n"
+#Like HELLO, but followed by the names of the compression codecs we can decode, so that values
+#can be sent compressed as they are stored. Answered with ENCODED_HELLO
+ENCODED = b"MUX2"
+ENCODED_HELLO = ENCODED + b"\n"
+#Request frame: request id, then the length of the key that follows
+REQUEST = struct.Struct("<IH")
+#Response frame: request id, then the size of the value that follows (MISSING if there is none)
+RESPONSE = struct.Struct("<Iq")
+MISSING = -1
+#Size header of the one request per connection protocol, the size then a newline
+LEGACY_SIZE = struct.Struct("<Ic")
+#Most peers remembered as not understanding ENCODED_HELLO, or HELLO
+MAX_PLAIN_PEERS = 4096
+
+def encoded_hello(codecs):
+    return b" ".join([ENCODED] + [name.encode() for name in codecs]) + b"\n"
+
+def parse_hello(line):
+    '''
+    The codec names in an encoded hello line, or None if it isn't one
+    '''
+    words = line.split()
+    if len(words) == 0 or words[0] != ENCODED:
+        return None
+    return [word.decode(errors="replace") for word in words[1:]]
+
+class PeerConnection:
+    '''
+    A framed TCP connection to one peer, which can have many requests outstanding at once.
+
+    The peer tags each response with the id of its request, so responses are matched to
+    requests whatever order they come back in (our own server answers in the order the
+    requests were sent). A single task reads the responses, handing each value to the receive
+    function of its request. Any error closes the connection and fails every outstanding
+    request, since the stream can't be trusted after it. Values come as the peer stores them
+    if the connection is encoded, otherwise uncompressed.
+    '''
+    def __init__(self, pool, addr, reader, writer, encoded=False):
+        self.pool = pool
+        self.addr = addr
+        self.reader = reader
+        self.writer = writer
+        self.encoded = encoded
+        #request id => (future, receive, timeout), in the order the requests were sent
+        self.pending = OrderedDict()
+        self.next_id = 0
+        self.closed = False
+        self.idle_timer = None
+        self.wakeup = asyncio.Event()
+        self.read_task = asyncio.ensure_future(self.read_responses(), loop=pool.loop)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def request(self, key, receive, timeout=None):
+        '''
+        Sends a request for key, returning a future for the result of receive(reader, size).
+        receive is a coroutine that must read exactly size bytes of value off reader, size
+        is MISSING if the peer doesn't have the key. timeout bounds the wait for a response
+        while this is the oldest request outstanding
+        '''
+        fut = asyncio.Future(loop=self.pool.loop)
+        if self.closed:
+            fut.set_exception(ConnectionError("Connection to {} is closed".format(self.addr)))
+            return fut
+
+        request_id = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        key = key.encode()
+        self.writer.write(REQUEST.pack(request_id, len(key)) + key)
+
+        self.pending[request_id] = (fut, receive, timeout)
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+        self.wakeup.set()
+        return fut
+
+    @asyncio.coroutine
+    def read_responses(self):
+        error = None
+        try:
+            while not self.closed:
+                if len(self.pending) == 0:
+                    self.wakeup.clear()
+                    yield from self.wakeup.wait()
+                    continue
+
+                _, _, timeout = next(iter(self.pending.values()))
+                header = yield from asyncio.wait_for(
+                    self.reader.readexactly(RESPONSE.size), timeout=timeout)
+                response_id, size = RESPONSE.unpack(header)
+                if response_id not in self.pending:
+                    raise ValueError("Got response {} to no outstanding request".format(response_id))
+                fut, receive, _ = self.pending.pop(response_id)
+
+                try:
+                    result = yield from receive(self.reader, size)
+                except Exception as e:
+                    if not fut.done():
+                        fut.set_exception(e)
+                    raise
+                if not fut.done():
+                    fut.set_result(result)
+
+                if len(self.pending) == 0:
+                    self.pool.idle(self)
+        except Exception as e:
+            log.info("Error on connection to %s (%s)", self.addr, e)
+            error = e
+        finally:
+            self.close(error)
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        #Closing the transport ends any read in progress, and the reader stops once woken
+        self.writer.close()
+        self.wakeup.set()
+        self.pool.remove(self)
+
+        if error is None:
+            error = ConnectionError("Connection to {} was closed".format(self.addr))
+        for fut, _, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(error)
+        self.pending.clear()
+
+
+class LegacyConnection:
+    '''
+    Stands in for a PeerConnection to a peer from before pooled connections, which answers a
+    single request per connection: the key and a newline, answered with LEGACY_SIZE and the
+    value, or by closing the connection if it doesn't have the key
+    '''
+    encoded = False
+
+    def __init__(self, addr):
+        self.addr = addr
+
+    @asyncio.coroutine
+    def request(self, key, receive, timeout=None):
+        reader, writer = yield from asyncio.wait_for(
+            asyncio.open_connection(*self.addr), timeout=timeout)
+        try:
+            writer.write(key.encode() + b"\n")
+            try:
+                header = yield from asyncio.wait_for(
+                    reader.readexactly(LEGACY_SIZE.size), timeout=timeout)
+                size, _ = LEGACY_SIZE.unpack(header)
+            except asyncio.IncompleteReadError:
+                size = MISSING
+            return (yield from receive(reader, size))
+        finally:
+            writer.close()
+
+
+class ConnectionPool:
+    '''
+    Framed connections to peers for chunk transfers, keyed by (ip, port).
+
+    Keeps at most one connection per peer, which every request to that peer shares, and at
+    most max_size connections in total. When the pool is full the least recently used idle
+    connection is closed to make room, and if every connection is busy the new connection
+    is used without being kept. Connections with no requests outstanding are closed after
+    idle_timeout.
+
+    Connections offer the peer codecs, the names of the compression codecs we can decode. A
+    peer that closes the connection on that is connected to again without them, and
+    remembered so that later connections to it skip the offer. A peer that closes the
+    connection on HELLO as well is remembered as only answering one request per connection,
+    and gets a LegacyConnection, which isn't pooled.
+    '''
+    def __init__(self, loop, max_size=64, idle_timeout=30., codecs=()):
+        self.loop = loop
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.codecs = list(codecs)
+        #Addresses of the peers that don't understand ENCODED_HELLO, and of those that don't
+        #understand HELLO either, least recently added first
+        self.plain_peers = OrderedDict()
+        self.legacy_peers = OrderedDict()
+        #addr => connection, least recently used first
+        self.connections = OrderedDict()
+        #addr => future for a connection being opened, so concurrent requests share it
+        self.connecting = {}
+
+    def __len__(self):
+        return len(self.connections)
+
+    @asyncio.coroutine
+    def get(self, addr, timeout=None):
+        '''
+        Returns a connection to addr, opening one if needed. timeout bounds connecting and
+        the handshake
+        '''
+        conn = self.connections.get(addr)
+        if conn is not None and not conn.closed:
+            self.connections.move_to_end(addr)
+            return conn
+        if addr in self.legacy_peers:
+            return LegacyConnection(addr)
+
+        fut = self.connecting.get(addr)
+        if fut is None:
+            fut = asyncio.ensure_future(self.connect(addr, timeout), loop=self.loop)
+            self.connecting[addr] = fut
+            fut.add_done_callback(lambda f: self.connecting.pop(addr, None))
+        #Don't let one cancelled request cancel the connection the others are waiting on
+        return (yield from asyncio.shield(fut))
+
+    @asyncio.coroutine
+    def connect(self, addr, timeout):
+        encoded = len(self.codecs) > 0 and addr not in self.plain_peers
+        conn = yield from self.open(addr, timeout, encoded)
+        if conn is None and encoded:
+            #Peers from before compression treat the hello as a key they don't have
+            self.remember(self.plain_peers, addr)
+            conn = yield from self.open(addr, timeout, False)
+        if conn is None:
+            #and so do peers from before pooled connections
+            self.remember(self.legacy_peers, addr)
+            return LegacyConnection(addr)
+
+        if self.make_room():
+            self.connections[addr] = conn
+        self.idle(conn)
+        return conn
+
+    @asyncio.coroutine
+    def open(self, addr, timeout, encoded):
+        '''
+        Connects to addr and switches the connection to the framed protocol, returning None if
+        the peer closes it on the hello
+        '''
+        reader, writer = yield from asyncio.wait_for(
+            asyncio.open_connection(*addr), timeout=timeout)
+        try:
+            writer.write(encoded_hello(self.codecs) if encoded else HELLO)
+            hello = yield from asyncio.wait_for(reader.readline(), timeout=timeout)
+            if hello == b"":
+                writer.close()
+                return None
+            if hello != (ENCODED_HELLO if encoded else HELLO):
+                raise ConnectionError("{} doesn't support pipelined transfers".format(addr))
+        except:
+            writer.close()
+            raise
+
+        return PeerConnection(self, addr, reader, writer, encoded)
+
+    def remember(self, peers, addr):
+        peers[addr] = True
+        peers.move_to_end(addr)
+        if len(peers) > MAX_PLAIN_PEERS:
+            peers.popitem(last=False)
+
+    def make_room(self):
+        '''
+        Closes idle connections until there is room for another one, returning False if
+        every connection is busy
+        '''
+        while len(self.connections) >= self.max_size:
+            idle = next((c for c in self.connections.values() if len(c) == 0), None)
+            if idle is None:
+                return False
+            idle.close()
+        return True
+
+    def idle(self, conn):
+        '''
+        Called when conn has no requests outstanding, closes it once it has been idle for
+        idle_timeout, or straight away if it isn't kept in the pool
+        '''
+        if conn.idle_timer is not None:
+            conn.idle_timer.cancel()
+
+        delay = self.idle_timeout
+        #A connection that isn't kept is closed once the requests it was opened for are done
+        if self.connections.get(conn.addr) is not conn and conn.next_id > 0:
+            delay = 0
+        conn.idle_timer = self.loop.call_later(delay, conn.close)
+
+    def remove(self, conn):
+        if self.connections.get(conn.addr) is conn:
+            del self.connections[conn.addr]
+
+    def close(self):
+        for conn in list(self.connections.values()):
+            conn.close()
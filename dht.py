@@ -8,14 +8,36 @@ import base64
 import sys # DEBUG
 from concurrent.futures import ThreadPoolExecutor as Executor
 
+from admission import Overloaded
+from compression import codec_of, decode
+from diskio import AsyncStorage
+from eviction import evict, eviction_order, is_id
+from inflight import InFlightRequests
+from lookup import Lookup
 from networking import Networking
+from packstore import PackStorage
 from routing import Node, Routing
+from rtt import RTTTable
 from storage import Storage
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 HEALTH_CHECK_INTERVAL = 100
+#Number of storage maintenance steps (values moved to the current directory layout or out of a
+#pack file being compacted) done between other work
+STORAGE_MAINTENANCE_BATCH = 100
+#How often to check whether the storage needs maintenance once it is done
+STORAGE_MAINTENANCE_INTERVAL = 60
+#How often to check whether the storage is over its capacity
+EVICTION_INTERVAL = 5
+#Once over capacity, values are evicted until the storage is down to this fraction of it
+EVICTION_TARGET = 0.9
+#Number of keys ranked against the routing table between other work while evicting
+EVICTION_RANK_BATCH = 4096
+#Requests answered as soon as they arrive, so that their response times are round trip times.
+#store_value is only answered once the value has been pulled over TCP
+TIMED_REQUESTS = { "ping_node", "find_node", "find_value" }
 
 class DHT:
     def __init__(self, eventLoop, config_file):
@@ -24,15 +46,75 @@ class DHT:
         config = self.read_config(config_file)
 
         self.server = None
-        #The ids of the current in-flight requests
-        #maps id to {future, node}
-        self.request_magics = {}
 
         self.max_timeout = 15.
+        #Number of requests a lookup keeps in flight
+        self.alpha = config.get("alpha", 3)
+        #How long to wait for a response before retransmitting a request to a node we have no
+        #round trip times for, doubled on each retry
+        self.rpc_timeout = config.get("rpc_timeout", 1.)
+        #Smoothed round trip times of the nodes we have heard back from, which set the timeout
+        #of each request to that node
+        self.rtt = RTTTable(
+            initial_timeout=self.rpc_timeout,
+            min_timeout=config.get("min_rpc_timeout", 0.2),
+            max_timeout=self.max_timeout)
+        #Lookups retransmit less, since another node can take the slot of an unresponsive one.
+        #A dead peer holds a lookup slot for rpc_timeout * (1 + 2 + ... 2^lookup_retries)
+        self.lookup_retries = config.get("lookup_retries", 1)
+
+        #Most incoming requests handled at once, and queued waiting for a slot, before we tell
+        #requesters that we are overloaded. store_value requests are limited separately
+        self.max_concurrent_requests = config.get("max_concurrent_requests", 64)
+        self.max_queued_requests = config.get("max_queued_requests", 256)
+        self.max_concurrent_stores = config.get("max_concurrent_stores", 8)
+        self.max_queued_stores = config.get("max_queued_stores", 32)
+        #Whether to use the binary message format with the peers that understand it
+        self.binary_wire = config.get("binary_wire", True)
+        #Most connections kept open for fetching chunks, and how long an unused one is kept
+        self.max_connections = config.get("max_connections", 64)
+        self.connection_idle_timeout = config.get("connection_idle_timeout", 30.)
+        #Longest a chunk transfer can go without any data arriving before it is given up on
+        self.transfer_timeout = config.get("transfer_timeout", 10.)
+        #Whether to offer the peers we fetch chunks from to send them compressed
+        self.transfer_compression = config.get("transfer_compression", True)
+        #How long we keep a connection that other nodes fetch chunks over open while it is
+        #unused, longer than their own idle timeout so that they are the ones to close it
+        self.serve_idle_timeout = 2 * self.connection_idle_timeout
+
+        #The current in-flight requests, keyed by request magic
+        self.requests = InFlightRequests(
+            self.loop,
+            lambda request, node: self.networking.send_message(request, (node.ip, node.port)),
+            max_size=config.get("max_requests_in_flight", 4096),
+            retries=config.get("rpc_retries", 2),
+            on_timeout=lambda entry: self.rtt.timed_out(entry.node))
 
         self.node = Node(config)
+        #Ids of the stale nodes currently being pinged before they are evicted from routing
+        self.pending_evictions = set()
         self.routing = Routing(self.node, [Node(n) for n in config["nodes"]])
-        self.storage = Storage(config["file_dir"])
+        #"files" stores each value in its own file, "pack" appends them to large pack files,
+        #which suits stores of many small values
+        engine = config.get("storage_engine", "files")
+        if engine == "files":
+            self.storage = Storage(config["file_dir"],
+                cache_size=config.get("cache_size", 64 << 20),
+                index=config.get("storage_index", "keys"),
+                fanout=config.get("storage_fanout", (2, 2)))
+        elif engine == "pack":
+            self.storage = PackStorage(config["file_dir"],
+                cache_size=config.get("cache_size", 64 << 20),
+                max_pack_size=config.get("max_pack_size", 64 << 20))
+        else:
+            raise ValueError("Unknown storage engine {}".format(engine))
+        #Disk reads and writes run on their own threads so they don't hold up requests, with
+        #writes synced to disk in batches unless storage_sync is off
+        self.disk = AsyncStorage(self.storage, self.loop,
+            Executor(max_workers=config.get("storage_threads", 4)),
+            sync=config.get("storage_sync", True))
+        #Most bytes of values to keep, with no limit if None
+        self.storage_capacity = config.get("storage_capacity")
         self.networking = Networking(self, self.storage)
 
     @asyncio.coroutine
@@ -52,6 +134,8 @@ class DHT:
             yield from create_tcp_server
             yield from self.join()
             asyncio.ensure_future(self.health_check())
+            asyncio.ensure_future(self.maintain_storage())
+            asyncio.ensure_future(self.evict_storage())
 
     def start(self):
         self.loop.run_until_complete(self.start_async())
@@ -63,35 +147,95 @@ class DHT:
             #self.save_state()
             self.loop.stop()
 
+    def close(self):
+        '''
+        Releases the storage once the loop has stopped, after the writes still running on the
+        storage threads
+        '''
+        self.disk.executor.shutdown()
+        self.storage.close()
+
     @asyncio.coroutine
     def health_check(self):
         while True:
             log.info("Health check")
             yield from self.ping_nodes()
             yield from self.find_node(self.node.node_id)
-
-            for key in list(self.request_magics):
-                value = self.request_magics[key]
-                fut = value["fut"]
-                #Remove any request_magics that were from unsatisfied requests
-                if(fut.done()):
-                    log.debug("removed orphaned request magic %s", key)
-                    del self.request_magics[key]
-            
-
-            log.info("Keys in storage: %d\n" % len(self.storage.keys()))
-            for key in self.storage.keys():
-                log.info(key)
+            log.info("Requests in flight: %d", len(self.requests))
+
+            cache = self.storage.cache
+            log.info("Cache: %d values, %d bytes, %d hits, %d misses",
+                len(cache), cache.size, cache.hits, cache.misses)
+            log.info("Storage writes: %d batches, %d coalesced, %d queued",
+                self.disk.batches, self.disk.coalesced, len(self.disk.pending))
+            log.info("Keys in storage: %d (%d bytes)\n" % (len(self.storage), self.storage.size))
+            if log.isEnabledFor(logging.DEBUG):
+                for key in self.storage.keys():
+                    log.debug(key)
 
             #Check every 10 minutes
             yield from asyncio.sleep(HEALTH_CHECK_INTERVAL)
 
+    @asyncio.coroutine
+    def maintain_storage(self):
+        '''
+        Does the storage's background upkeep (migrating values to a new directory layout, or
+        compacting pack files) a few steps at a time, so that requests are still served while
+        it goes on
+        '''
+        while True:
+            remaining = yield from self.disk.run(self.storage.maintain, STORAGE_MAINTENANCE_BATCH)
+            if remaining > 0:
+                log.debug("%d storage maintenance steps left", remaining)
+                yield from asyncio.sleep(0)
+            else:
+                yield from asyncio.sleep(STORAGE_MAINTENANCE_INTERVAL)
+
+    @asyncio.coroutine
+    def evict_storage(self):
+        '''
+        Keeps the stored values under storage_capacity bytes. Once it is exceeded, evicts
+        the values of the keys we aren't among the closest known nodes to first, then those
+        furthest from us and least recently used
+        '''
+        while self.storage_capacity is not None:
+            if self.storage.size > self.storage_capacity:
+                excess = self.storage.size - EVICTION_TARGET * self.storage_capacity
+                keys = yield from self.disk.run(self.storage.keys)
+                keys = [k for k in keys if is_id(k)]
+
+                responsible = set()
+                for start in range(0, len(keys), EVICTION_RANK_BATCH):
+                    batch = keys[start:start + EVICTION_RANK_BATCH]
+                    for key, nearest in zip(batch, self.routing.nearest_nodes_batch(batch)):
+                        if self.is_responsible(key, nearest):
+                            responsible.add(key)
+                    yield from asyncio.sleep(0)
+
+                recency = self.storage.recent.recency()
+                order = eviction_order(self.node.id, keys, responsible, recency)
+                cleared, freed = yield from self.disk.run(evict, self.storage, order, excess)
+                log.info("Evicted %d values (%d bytes) to keep storage under %d bytes",
+                    cleared, freed, self.storage_capacity)
+
+            yield from asyncio.sleep(EVICTION_INTERVAL)
+
+    def is_responsible(self, hash_id, nearest, k=7):
+        '''
+        Whether we are among the k closest nodes to hash_id, given nearest, the k closest
+        nodes to it in our routing table
+        '''
+        if len(nearest) < k:
+            return True
+        target = hash_utils.id_to_int(hash_id)
+        return self.node.distance(target) < nearest[-1].distance(target)
+
     @asyncio.coroutine
     def join(self):
         '''
         Joins the DHT network
         '''
-        if(len(self.routing.nodes) == 0):
+        if(len(self.routing) == 0):
             log.error("No nodes to bootstrap from")
             return
 
@@ -157,9 +301,12 @@ class DHT:
 
         #Try to add the requester node to our routing table, so that nodes can bootstrap themselves
         #into the network
-        request_node = Node(request_node)
+        try:
+            request_node = Node(request_node)
+        except (KeyError, TypeError, ValueError):
+            return {"error": 'Request has an invalid requester node'}
         log.info("Received request from node %s", request_node)
-        self.routing.add_or_update_node(request_node)
+        self.update_routing(request_node)
 
 
         response = {
@@ -173,24 +320,24 @@ class DHT:
             yield from self.ping_nodes()
 
         if(request_type == "ping_node"):
-            response["result"] = self.node.__dict__
+            response["result"] = self.node.to_dict()
 
         request_hash = request_params.get("id")
         if(request_type == "store_value"):
             #Initialize a get request to the other node, opens a TCP connection to transfer the data
-            data = yield from self.get_value(request_hash, node=request_node)
+            yield from self.fetch_value(request_hash, node=request_node)
             response["result"] = "saved"
 
         if(request_type == "find_node"):
             nodes = self.routing.nearest_nodes(request_hash)
-            response["result"] = [n.__dict__ for n in nodes]
+            response["result"] = [n.to_dict() for n in nodes]
 
         if(request_type == "find_value"):
-            if(self.storage.has(request_hash)):
-                response["result"] = self.node.__dict__
+            if (yield from self.disk.has(request_hash)):
+                response["result"] = self.node.to_dict()
             else:
                 nodes = self.routing.nearest_nodes(request_hash)
-                response["result"] = [n.__dict__ for n in nodes]
+                response["result"] = [n.to_dict() for n in nodes]
 
         return response
 
@@ -206,67 +353,73 @@ class DHT:
             log.debug("Response has no request type")
             return
 
-        fut_node = self.request_magics.get(magic)
-        if fut_node is None:
+        #Marking the request/response transaction as complete
+        in_flight = self.requests.pop(magic)
+        if in_flight is None:
             log.info("Response with magic %s was unexpected. Duplicate response?", magic)
             return
 
-        #Marking the request/response transaction as complete
-        del self.request_magics[magic]
+        #Karn's algorithm, a response to a retransmitted request can't be timed
+        if in_flight.timed and in_flight.attempts == 1:
+            self.rtt.add_sample(in_flight.node, self.loop.time() - in_flight.sent_at)
 
         result = response.get("result")
 
-        node = fut_node["node"]
-        fut = fut_node["fut"]
+        fut = in_flight.fut
         #Future was cancelled / already handled but we didn't remove from our in-flight requests
         if(fut.done()):
             return
 
-        if(request_type == "ping_node"):
-            fut.set_result(Node(result))
+        if response.get("overloaded"):
+            log.info("%s is overloaded, dropping %s request", in_flight.node, request_type)
+            fut.set_exception(Overloaded("{} is overloaded".format(in_flight.node)))
             return
 
+        try:
+            fut.set_result(self.parse_result(request_type, result))
+        except (KeyError, TypeError, ValueError) as e:
+            log.info("Malformed %s response: %s", request_type, e)
+            fut.set_exception(e)
+
+    def parse_result(self, request_type, result):
+        if(request_type == "ping_node"):
+            return Node(result)
+
         #Just confirmation that the result was stored
         if(request_type == "store_value"):
-            fut.set_result(result)
-            return
+            return result
 
         if(request_type == "find_node"):
-            nodes = [Node(n) for n in result]
-            fut.set_result(nodes)
-
-            return
+            return [Node(n) for n in result]
 
         if(request_type == "find_value"):
             #If a node is returned, instead of a list of nodes, they have the value
             if(isinstance(result, dict)):
-                fut.set_result(Node(result))
-            else:
-                nodes = [Node(n) for n in result]
-                fut.set_result(nodes)
-
-            return
+                return Node(result)
+            return [Node(n) for n in result]
 
+        return result
 
-    def make_request(self, request, node):
-        request['magic'] = int.from_bytes(os.urandom(4), byteorder='little')
-        request["requester"] = self.node.__dict__
-
-        future = asyncio.Future()
-        self.request_magics[request['magic']] = { "node": node, "fut": future }
-        host = node.ip
-        port = node.port
+    def make_request(self, request, node, timeout=None, retries=None):
+        '''
+        Sends request to node, returning a future for the result. The request is retransmitted
+        if there is no response within timeout (by default from the node's round trip times),
+        and the future fails once the retries run out. Only the requests in TIMED_REQUESTS
+        feed the node's round trip times
+        '''
+        magic = int.from_bytes(os.urandom(4), byteorder='little')
+        while magic in self.requests:
+            magic = int.from_bytes(os.urandom(4), byteorder='little')
 
-        request_s = json.dumps(request).encode('utf8')
-        log.debug("Making request with %s to (%s:%s)", request_s, host, port)
+        request['magic'] = magic
+        request["requester"] = self.node.to_dict()
 
-        try:
-            self.networking.send_message(request, (host, port))
-        except Exception as e:
-            log.info("Error %s connecting to %s:%s", e, host, port)
-            future.set_exception(e)
+        log.debug("Making request %s to (%s:%s)", request, node.ip, node.port)
 
-        return future
+        if timeout is None:
+            timeout = self.rtt.timeout(node)
+        timed = request["type"] in TIMED_REQUESTS
+        return self.requests.add(magic, request, node, timeout, retries, timed)
 
 
 
@@ -275,13 +428,12 @@ class DHT:
         '''
         Sends a request to each of our nodes to see if they are still alive
         '''
-        log.debug("Pinging %d nodes", len(self.routing.nodes))
-        log.debug("%s", self.routing.nodes)
+        log.debug("Pinging %d nodes", len(self.routing))
 
         futs = []
         nodes = {}
 
-        for node in self.routing:
+        for node in list(self.routing):
             log.debug("Pinging node %s", str(node))
             request = { "type":"ping_node", "params" : {} }
             fut = self.make_request(request, node)
@@ -309,6 +461,31 @@ class DHT:
         return
 
 
+    def update_routing(self, node):
+        '''
+        Records that we heard from node, if its bucket is full the least recently seen node
+        is pinged and only evicted if it doesn't respond
+        '''
+        stale = self.routing.add_or_update_node(node)
+        #Only one ping per stale node, however many newcomers are waiting on its bucket
+        if stale is not None and stale.node_id not in self.pending_evictions:
+            self.pending_evictions.add(stale.node_id)
+            asyncio.ensure_future(self.ping_or_evict(stale))
+
+    @asyncio.coroutine
+    def ping_or_evict(self, node):
+        request = { "type":"ping_node", "params" : {} }
+        try:
+            yield from self.make_request(request, node)
+        except Exception:
+            log.debug("Evicting unresponsive node %s", node)
+            self.routing.remove_node(node)
+            return
+        finally:
+            self.pending_evictions.discard(node.node_id)
+
+        self.routing.add_or_update_node(node)
+
     @asyncio.coroutine
     def store_value(self, hash_id, data):
         '''
@@ -316,140 +493,107 @@ class DHT:
         '''
 
         # Add to our own storage so it is available on the network from us
-        self.storage.set(hash_id, data)
+        yield from self.disk.set(hash_id, data)
 
         nodes = yield from self.find_node(hash_id)
+        yield from self.replicate(hash_id, nodes)
+
+    @asyncio.coroutine
+    def replicate(self, hash_id, nodes):
+        '''
+        Asks each of nodes to store hash_id, which must already be in our storage since the
+        nodes pull the value from us. Gives up on nodes that haven't answered in max_timeout
+        '''
+        if len(nodes) == 0:
+            log.warning("No nodes to store %s on", hash_id)
+            return
 
         log.info("Storing on nodes %s", nodes)
 
         futs = []
         for node in nodes:
             request = { "type": "store_value", "params": { "id": hash_id } }
-            futs.append(self.make_request(request, node))
+            #The node pulls the value from us before responding, so allow for the transfer time.
+            #Not retransmitted, since every copy of the request would start another pull
+            futs.append(self.make_request(request, node, timeout=self.max_timeout, retries=0))
 
-        self.ensure_not_empty(futs)
-        complete, pending = yield from asyncio.wait(futs)
+        complete, pending = yield from asyncio.wait(futs, timeout=self.max_timeout)
+        for fut in pending:
+            fut.cancel()
 
-        return
+    def plan_lookups(self, hash_ids):
+        '''
+        Ranks our routing table against many hashes at once, for bulk stores and retrievals.
+        Does no I/O, so it is called directly rather than yielded from. Returns a dict of
+        hash => the nodes to start its lookup from (the candidates argument of
+        find_node/find_value/get_value)
+        '''
+        hash_ids = list(hash_ids)
+        return dict(zip(hash_ids, self.routing.nearest_nodes_batch(hash_ids)))
 
     @asyncio.coroutine
-    def find_node(self, hash_id):
+    def find_node(self, hash_id, candidates=None):
         '''
-        Makes a request to the n nodes with ids closest to hash_id asking them to find the nodes who's ids
-        are closest to hash_id
+        Iteratively asks the nodes with ids closest to hash_id for the nodes they know of that
+        are closest to hash_id, and returns the closest nodes that responded
         '''
-
-        to_search = self.routing.nearest_nodes(hash_id)
-        searched = set()
-
-        while len(to_search) > 0:
-
-            futs = []
-            log.debug("next search set %s", to_search)
-            for node in to_search:
-                request = { "type":"find_node", "params":{ "id":hash_id } }
-                fut = self.make_request(request, node)
-                futs.append(fut)
-
-            self.ensure_not_empty(futs)
-            complete, pending = yield from asyncio.wait(futs, timeout=self.max_timeout)
-
-            searched.update(to_search)
-
-            nodes = set(searched)
-            for fut in filter(lambda f: f.exception() is None, complete):
-                res = fut.result()
-                res = filter(lambda x: x.node_id != self.node.node_id, res)
-                nodes.update(res)
-
-            to_search = set(self.routing.nearest_nodes(hash_id, nodes=nodes)) - searched
-
-            #Update our own routing table in case any of the found nodes are useful to us
-            self.routing.add_nodes(to_search)
-
-        return self.routing.nearest_nodes(hash_id, nodes=searched)
+        lookup = Lookup(self, hash_id, "find_node", alpha=self.alpha,
+            retries=self.lookup_retries, initial=candidates)
+        return (yield from lookup.run())
 
     @asyncio.coroutine
-    def find_value(self, hash_id):
+    def find_value(self, hash_id, candidates=None):
         '''
-        Makes a request to the n nodes with ids closest to hash_id to find who has the file hash_id
+        Iteratively asks the nodes with ids closest to hash_id to find who has the file hash_id
         '''
-        if(self.storage.has(hash_id)):
+        if (yield from self.disk.has(hash_id)):
            return self.node
 
-        to_search = self.routing.nearest_nodes(hash_id)
-        searched = set()
-
-        nodes_with_value = set()
-        while len(nodes_with_value) == 0 and len(to_search) > 0:
-            futs = []
-            log.debug("next search set %s", to_search)
-            for node in to_search:
-                request = { "type":"find_value", "params":{ "id":hash_id } }
-                fut = self.make_request(request, node)
-                futs.append(fut)
-
-            self.ensure_not_empty(futs)
-            complete, pending = yield from asyncio.wait(futs, timeout=self.max_timeout)
-
-            searched.update(to_search)
-            new_nodes = searched.copy()
-            for fut in filter(lambda f: f.exception() is None, complete):
-                res = fut.result()
-
-                #Either get back one node that has the value, or a list of nodes to check next
-                if isinstance(res, Node):
-                    nodes_with_value.add(res)
-                else:
-                    #Don't want to contact ourselves if that was returned
-                    res = filter(lambda x: x.node_id != self.node.node_id, res)
-                    new_nodes.update(res)
-
-
-            log.info("new nodes %s", new_nodes)
+        lookup = Lookup(self, hash_id, "find_value", alpha=self.alpha,
+            retries=self.lookup_retries, initial=candidates)
+        yield from lookup.run()
 
-            #Get the next set of top nodes, excluding nodes we've already searched
-            to_search = set(self.routing.nearest_nodes(hash_id, nodes=new_nodes)) - searched
-
-        return list(nodes_with_value)
+        return list(lookup.nodes_with_value)
 
     @asyncio.coroutine
-    def get_value(self, hash_id, node = None):
+    def get_value(self, hash_id, node = None, candidates = None):
         '''
         Retrieves the value associated with hash_id from the network.
-        Optionally pass in a node to request the data from the requested node
+        Optionally pass in a node to request the data from the requested node, or the
+        candidates to start the lookup from
         '''
-        data = None
-
-        if(self.storage.has(hash_id)):
-            return self.storage.get(hash_id)
+        if not (yield from self.fetch_value(hash_id, node, candidates)):
+            return None
 
-        if node is None:
-            nodes = yield from self.find_value(hash_id)
+        data = yield from self.disk.get(hash_id)
+        if data is not None and codec_of(data) is not None:
+            data = yield from self.disk.run(decode, data)
+        return data
 
-            if len(nodes) == 0:
-                raise Exception("No nodes have the requested value ({})".format(hash_id))
+    @asyncio.coroutine
+    def fetch_value(self, hash_id, node = None, candidates = None):
+        '''
+        Like get_value, but only brings the value into our storage without reading it back.
+        Returns whether we have the value
+        '''
+        if (yield from self.disk.has(hash_id)):
+            return True
 
+        if node is not None:
+            return (yield from self.networking.request_key(hash_id, node))
 
-            #just get from the first node
-            for node in nodes:
-                data = yield from self.networking.request_key(hash_id, node)
-                log.info("Read chunk %s from node %s" % (hash_id, node.node_id))
-                if data:
-                    break
-        else:
-            data = yield from self.networking.request_key(hash_id, node)
-            log.info("Read chunk %s from node %s" % (hash_id, node.node_id))
+        nodes = yield from self.find_value(hash_id, candidates)
 
-        if data is not None:
-            h = hash_utils.hash_data(data)
-            if(h != hash_id):
-                log.warning("Data returned for request %s did not match the hash (calculated %s)", hash_id, h)
-                return None
-            self.storage.set(hash_id, data)
+        if len(nodes) == 0:
+            raise Exception("No nodes have the requested value ({})".format(hash_id))
 
+        #Try the nodes we have the fastest round trips to first
+        for node in self.rtt.fastest(nodes):
+            if (yield from self.networking.request_key(hash_id, node)):
+                log.info("Read chunk %s from node %s" % (hash_id, node.node_id))
+                return True
 
-        return data
+        return False
 
     def read_config(self, filename):
         with open(filename) as f:
@@ -481,10 +625,11 @@ def main():
         help="Config file location")
 
     args = arg.parse_args()
-    loop = startup(args.config_file)[0]
-    loop.run_forever()
-
-    dht.stop()
+    loop, dht = startup(args.config_file)
+    try:
+        loop.run_forever()
+    finally:
+        dht.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class AsyncStorage:
+    '''
+    Runs the blocking calls of a storage engine (storage.Storage or packstore.PackStorage) on a
+    pool of threads, so that the event loop doesn't wait on the disk.
+
+    Values are written in batches, one batch at a time: set() queues its value and waits for
+    the batch it is written in, which holds everything queued while the batch before it was
+    being written. A value set again while still queued is only written once, and with sync
+    each batch is synced to disk together instead of value by value. Reads of queued values
+    are answered from the queue.
+    '''
+    def __init__(self, storage, loop, executor, sync=True):
+        self.storage = storage
+        self.loop = loop
+        self.executor = executor
+        self.sync = sync
+        #key => (value, future for whether it was stored) of the values waiting to be written
+        self.pending = OrderedDict()
+        #key => value of the batch being written
+        self.writing = {}
+        self.writer = None
+        self.batches = 0
+        self.coalesced = 0
+
+    def run(self, func, *args):
+        '''
+        Returns a future for func(*args) called on one of the storage threads
+        '''
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def queued(self, key):
+        '''
+        The value for key if it is waiting to be written, otherwise None
+        '''
+        entry = self.pending.get(key)
+        if entry is not None:
+            return entry[0]
+        return self.writing.get(key)
+
+    @asyncio.coroutine
+    def has(self, key):
+        if self.queued(key) is not None or key in self.storage.cache:
+            return True
+        if self.storage.indexed:
+            return self.storage.has(key)
+        return (yield from self.run(self.storage.has, key))
+
+    @asyncio.coroutine
+    def get(self, key):
+        value = self.queued(key)
+        if value is None and key in self.storage.cache:
+            value = self.storage.cached(key)
+        if value is not None:
+            return value
+        return (yield from self.run(self.storage.get, key))
+
+    @asyncio.coroutine
+    def open(self, key):
+        return (yield from self.run(self.storage.open, key))
+
+    @asyncio.coroutine
+    def commit(self, partial):
+        '''
+        Commits a value written with storage.create
+        '''
+        yield from self.run(partial.commit, self.sync)
+
+    @asyncio.coroutine
+    def set(self, key, value):
+        '''
+        Stores value under key, returning whether it was stored
+        '''
+        entry = self.pending.get(key)
+        if entry is not None:
+            self.coalesced += 1
+            fut = entry[1]
+        else:
+            fut = asyncio.Future(loop=self.loop)
+        self.pending[key] = (value, fut)
+
+        if self.writer is None:
+            self.writer = asyncio.ensure_future(self.write_batches(), loop=self.loop)
+        #Other writers may be waiting on the same future, so don't let a cancel reach it
+        return (yield from asyncio.shield(fut))
+
+    @asyncio.coroutine
+    def write_batches(self):
+        try:
+            while len(self.pending) > 0:
+                batch = self.pending
+                self.pending = OrderedDict()
+                self.writing = { key: value for key, (value, _) in batch.items() }
+                self.batches += 1
+
+                try:
+                    results = yield from self.run(
+                        self.storage.set_many, list(self.writing.items()), self.sync)
+                except Exception as e:
+                    log.warning("Couldn't write %d values (%s)", len(batch), e)
+                    results = [False] * len(batch)
+                finally:
+                    self.writing = {}
+
+                for (_, fut), stored in zip(batch.values(), results):
+                    if not fut.done():
+                        fut.set_result(stored)
+        finally:
+            self.writer = None
@@ -0,0 +1,90 @@
+'''
+Choosing which stored values to drop once a node's storage is over its capacity.
+
+Values whose keys we aren't among the closest known nodes to are dropped first, since the
+nodes responsible for them keep their own copies. Within that, values are dropped in order
+of a score adding up how close their key is to our id and how recently they were used.
+'''
+
+import threading
+from collections import OrderedDict
+
+import hash_utils
+
+ID_BITS = 256
+
+class RecentKeys:
+    '''
+    The max_size most recently used keys, in order of use. Safe to use from the storage
+    threads and the event loop at once
+    '''
+    def __init__(self, max_size=1 << 16):
+        self.max_size = max_size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def touch(self, key):
+        with self.lock:
+            self.keys[key] = None
+            self.keys.move_to_end(key)
+            if len(self.keys) > self.max_size:
+                self.keys.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def recency(self):
+        '''
+        key => how recently it was used, from just above 0 for the least recent key we
+        remember to 1 for the most recent. Keys we don't remember count as 0
+        '''
+        with self.lock:
+            keys = list(self.keys)
+        return { key: (i + 1) / len(keys) for i, key in enumerate(keys) }
+
+
+def is_id(key):
+    '''
+    Whether key is a hex id that can be ranked by distance
+    '''
+    if not isinstance(key, str) or len(key) != ID_BITS // 4:
+        return False
+    try:
+        hash_utils.id_to_int(key)
+    except ValueError:
+        return False
+    return True
+
+def eviction_order(node_id, keys, responsible, recency):
+    '''
+    Orders keys from the first to the last to evict. node_id is our integer id, responsible
+    the set of keys we should hold and recency as given by RecentKeys.recency
+    '''
+    def score(key):
+        distance = hash_utils.id_to_int(key) ^ node_id
+        closeness = 1 - distance / (1 << ID_BITS)
+        #Distances too close for the float score to tell apart are ordered by the distance
+        return (key in responsible, closeness + recency.get(key, 0), -distance)
+    return sorted(keys, key=score)
+
+def evict(storage, order, excess):
+    '''
+    Clears values from storage in order until at least excess bytes are freed, returning
+    the number of values cleared and the bytes freed
+    '''
+    cleared = 0
+    freed = 0
+    for key in order:
+        if freed >= excess:
+            break
+        try:
+            freed += storage.clear(key)
+        except (KeyError, OSError):
+            #Cleared since the order was made
+            continue
+        cleared += 1
+    return cleared, freed
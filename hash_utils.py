@@ -1,14 +1,18 @@
 import hashlib
 
+def new_hash():
+    '''
+    Hash object for computing a key incrementally, hexdigest() gives the same key as hash_data
+    '''
+    return hashlib.sha256()
+
 def hash_data(data):
-    h = hashlib.sha256()
+    h = new_hash()
     h.update(data)
     return h.hexdigest()
 
-def xor_string(s1, s2):
-    return bytes([x ^ y for x,y in zip(s1, s2)])
-
-def dist(h1, h2):
-    h1 = bytes.fromhex(h1)
-    h2 = bytes.fromhex(h2)
-    return xor_string(h1, h2)
\ No newline at end of file
+def id_to_int(h):
+    '''
+    Converts a hex id (node id or key) into the integer used for distance calculations
+    '''
+    return int(h, 16)
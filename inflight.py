@@ -0,0 +1,115 @@
+import asyncio
+import logging
+
+log = logging.getLogger(__name__)
+
+class InFlightRequest:
+    __slots__ = ("magic", "request", "node", "fut", "timeout", "retries", "attempts", "sent_at", "timer",
+        "timed")
+
+    def __init__(self, magic, request, node, fut, timeout, retries, timed=True):
+        self.magic = magic
+        self.request = request
+        self.node = node
+        self.fut = fut
+        #Timeout for the current attempt, grows by the backoff factor with every retransmission
+        self.timeout = timeout
+        self.retries = retries
+        self.attempts = 0
+        self.sent_at = None
+        self.timer = None
+        #Whether the response time is a round trip time, rather than including work the node
+        #does before answering
+        self.timed = timed
+
+
+class InFlightRequests:
+    '''
+    Table of the requests we are waiting on a response for, keyed by request magic.
+
+    Every request has a deadline timer, on expiry the request is retransmitted up to
+    `retries` times with exponential backoff before its future fails with a TimeoutError.
+    Entries are removed as soon as they are answered, expire, or their future is cancelled.
+    '''
+    def __init__(self, loop, send, max_size=4096, retries=2, backoff=2., on_timeout=None):
+        self.loop = loop
+        #Function (request, node) that puts the request on the wire
+        self.send = send
+        #Optional function (entry) called every time an attempt of a timed request goes unanswered
+        self.on_timeout = on_timeout
+        self.max_size = max_size
+        self.retries = retries
+        self.backoff = backoff
+        self.requests = {}
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __contains__(self, magic):
+        return magic in self.requests
+
+    def add(self, magic, request, node, timeout, retries=None, timed=True):
+        '''
+        Sends the request and returns a future for the response. Requests that aren't timed
+        don't call on_timeout
+        '''
+        fut = asyncio.Future(loop=self.loop)
+
+        if len(self.requests) >= self.max_size:
+            log.warning("Too many requests in flight (%d), dropping request to %s", len(self.requests), node)
+            fut.set_exception(Exception("Too many requests in flight"))
+            return fut
+
+        if retries is None:
+            retries = self.retries
+
+        entry = InFlightRequest(magic, request, node, fut, timeout, retries, timed)
+        self.requests[magic] = entry
+        fut.add_done_callback(lambda f: self.__discard(entry))
+
+        self.__transmit(entry)
+        return fut
+
+    def pop(self, magic):
+        '''
+        Removes and returns the request for magic, or None if it is not in flight
+        '''
+        entry = self.requests.pop(magic, None)
+        if entry is not None and entry.timer is not None:
+            entry.timer.cancel()
+        return entry
+
+    def __discard(self, entry):
+        #The magic may already belong to a newer request
+        if self.requests.get(entry.magic) is entry:
+            self.pop(entry.magic)
+
+    def __transmit(self, entry):
+        entry.attempts += 1
+        entry.sent_at = self.loop.time()
+        try:
+            self.send(entry.request, entry.node)
+        except Exception as e:
+            log.info("Error %s sending request to %s", e, entry.node)
+            if not entry.fut.done():
+                entry.fut.set_exception(e)
+            return
+
+        entry.timer = self.loop.call_later(entry.timeout, self.__expire, entry.magic)
+
+    def __expire(self, magic):
+        entry = self.requests.get(magic)
+        if entry is None or entry.fut.done():
+            return
+
+        if self.on_timeout is not None and entry.timed:
+            self.on_timeout(entry)
+
+        if entry.attempts <= entry.retries:
+            entry.timeout *= self.backoff
+            log.debug("Retransmitting request %s to %s (attempt %d)", magic, entry.node, entry.attempts + 1)
+            self.__transmit(entry)
+            return
+
+        log.debug("Request %s to %s timed out", magic, entry.node)
+        entry.fut.set_exception(asyncio.TimeoutError())
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+
+from routing import Node
+
+log = logging.getLogger(__name__)
+
+class Lookup:
+    '''
+    A single iterative Kademlia lookup for hash_id.
+
+    Keeps at most alpha requests in flight, sending the next request as soon as any
+    response (or timeout) comes back, and finishes once the k closest nodes that we know
+    of have all responded. For find_value requests the lookup finishes early as soon as a
+    node reports having the value.
+
+    The lookup starts from the k closest nodes in our routing table, unless the caller
+    already ranked them (see DHT.plan_lookups) and passes them as initial.
+
+    timeout is the time allowed for the first attempt of each request (by default taken from
+    the round trip times of the node queried), which is retransmitted up to retries times with
+    the timeout doubling each time.
+    '''
+    def __init__(self, dht, hash_id, request_type, k=7, alpha=3, timeout=None, retries=None,
+            initial=None):
+        self.dht = dht
+        self.hash_id = hash_id
+        self.request_type = request_type
+        self.k = k
+        self.alpha = alpha
+        self.timeout = timeout
+        self.retries = retries
+        self.initial = initial
+
+        #node_id => node for every node we have heard of
+        self.candidates = {}
+        self.queried = set()
+        self.responded = set()
+        self.failed = set()
+        self.nodes_with_value = set()
+
+    def add_candidates(self, nodes):
+        for node in nodes:
+            if node.node_id == self.dht.node.node_id:
+                continue
+            self.candidates.setdefault(node.node_id, node)
+
+    def closest(self, nodes):
+        return self.dht.routing.nearest_nodes(self.hash_id, nodes=nodes, k=self.k)
+
+    def shortlist(self):
+        '''
+        The k closest nodes that have not failed to respond
+        '''
+        return self.closest(n for n in self.candidates.values() if n.node_id not in self.failed)
+
+    @asyncio.coroutine
+    def query(self, node):
+        request = { "type":self.request_type, "params":{ "id":self.hash_id } }
+        return (yield from self.dht.make_request(request, node, timeout=self.timeout, retries=self.retries))
+
+    @asyncio.coroutine
+    def run(self):
+        if self.initial is None:
+            self.initial = self.dht.routing.nearest_nodes(self.hash_id, k=self.k)
+        self.add_candidates(self.initial)
+        in_flight = {}
+
+        while len(self.nodes_with_value) == 0:
+            shortlist = self.shortlist()
+            #Done once the k closest have all responded, whatever else is still outstanding
+            if len(shortlist) > 0 and all(n.node_id in self.responded for n in shortlist):
+                break
+
+            to_query = [n for n in shortlist if n.node_id not in self.queried]
+            for node in to_query[:self.alpha - len(in_flight)]:
+                log.debug("Querying %s for %s", node, self.hash_id)
+                self.queried.add(node.node_id)
+                in_flight[asyncio.ensure_future(self.query(node))] = node
+
+            if len(in_flight) == 0:
+                break
+
+            done, _ = yield from asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                self.handle_result(in_flight.pop(fut), fut)
+
+        for fut in in_flight:
+            fut.cancel()
+
+        return self.closest(self.candidates[n] for n in self.responded)
+
+    def handle_result(self, node, fut):
+        if fut.cancelled() or fut.exception() is not None:
+            log.debug("No response from %s for %s", node, self.hash_id)
+            self.failed.add(node.node_id)
+            return
+
+        self.responded.add(node.node_id)
+        #The node responded, so it is a good candidate for our own routing table
+        self.dht.update_routing(node)
+
+        res = fut.result()
+        #Either get back one node that has the value, or a list of nodes to check next
+        if isinstance(res, Node):
+            self.nodes_with_value.add(res)
+            return
+
+        self.add_candidates(res)
+        #Update our own routing table in case any of the found nodes are useful to us
+        self.dht.routing.add_nodes(res)
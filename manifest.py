@@ -0,0 +1,157 @@
+'''
+Binary manifests, the chunk list of a stored file kept in the network itself.
+
+A manifest is a tree of pages, each stored as a value under its own hash like any chunk.
+Leaf pages list (chunk hash, size) for a run of the file's chunks, and index pages list
+(page hash, bytes covered) for the pages below them. The hash of the root page is a Merkle
+root for the whole file, so a file is addressed by that one hash, and each page fetched can
+be checked against the hash its parent gives for it. The byte counts let a reader find the
+chunk at any offset by fetching one page per level.
+
+A page is the marker, the format version, the kind of page and the number of entries as a
+varint, followed by each entry as the raw 32 byte hash and the size as a varint.
+'''
+
+import struct
+from bisect import bisect_right
+
+from hash_utils import hash_data
+
+MARKER = b"DM"
+VERSION = 1
+HEADER = struct.Struct(">2sBB")
+LEAF, INDEX = range(2)
+
+HASH_BYTES = 32
+#Most entries in a page, which keeps pages of 1 MB chunks to around 150 KB
+PAGE_ENTRIES = 4096
+
+def pack_varint(n):
+    if n < 0:
+        raise ValueError("Varints can't be negative ({})".format(n))
+    out = bytearray()
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n == 0:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+def unpack_varint(data, offset):
+    n = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[offset]
+        offset += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("Varint too long")
+
+def pack_page(kind, entries):
+    '''
+    Packs a page of (hex hash, size) entries
+    '''
+    parts = [HEADER.pack(MARKER, VERSION, kind), pack_varint(len(entries))]
+    for hash, size in entries:
+        raw = bytes.fromhex(hash)
+        if len(raw) != HASH_BYTES:
+            raise ValueError("Hash {} isn't {} bytes".format(hash, HASH_BYTES))
+        parts.append(raw)
+        parts.append(pack_varint(size))
+    return b"".join(parts)
+
+
+class Page:
+    '''
+    An unpacked manifest page, with the offset in the file (relative to the page's first
+    byte) that each entry starts at
+    '''
+    def __init__(self, kind, entries):
+        self.kind = kind
+        self.hashes = [hash for hash, _ in entries]
+        self.sizes = [size for _, size in entries]
+        self.offsets = [0]
+        for size in self.sizes:
+            self.offsets.append(self.offsets[-1] + size)
+        self.size = self.offsets[-1]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def entries(self):
+        return list(zip(self.hashes, self.sizes))
+
+    def locate(self, offset):
+        '''
+        Index of the entry holding the byte at offset
+        '''
+        return bisect_right(self.offsets, offset) - 1
+
+
+def unpack_page(data):
+    '''
+    Unpacks a page, raising ValueError if it is malformed
+    '''
+    try:
+        marker, version, kind = HEADER.unpack_from(data)
+    except struct.error as e:
+        raise ValueError("Malformed manifest page ({})".format(e))
+    if marker != MARKER or version != VERSION or kind not in (LEAF, INDEX):
+        raise ValueError("Not a version {} manifest page".format(VERSION))
+
+    count, offset = unpack_varint(data, HEADER.size)
+    entries = []
+    for _ in range(count):
+        raw = data[offset:offset + HASH_BYTES]
+        if len(raw) != HASH_BYTES:
+            raise ValueError("Truncated manifest page")
+        size, offset = unpack_varint(data, offset + HASH_BYTES)
+        entries.append((raw.hex(), size))
+    if offset != len(data):
+        raise ValueError("{} trailing bytes after manifest page".format(len(data) - offset))
+    return Page(kind, entries)
+
+def verify_page(hash, data, size=None):
+    '''
+    Unpacks the page stored under hash, raising ValueError unless it matches the hash and,
+    for pages below the root, covers the size its parent gives for it
+    '''
+    if hash_data(data) != hash:
+        raise ValueError("Manifest page {} doesn't match its hash".format(hash))
+    page = unpack_page(data)
+    if size is not None and page.size != size:
+        raise ValueError("Manifest page {} covers {} bytes, expected {}".format(
+            hash, page.size, size))
+    return page
+
+def build_manifest(hashes, page_entries=PAGE_ENTRIES):
+    '''
+    Builds the manifest of a file from its list of (hash, size) chunks. Returns the root
+    hash and the list of (hash, page) to store, root last
+    '''
+    if page_entries < 2:
+        raise ValueError("Pages need room for at least 2 entries")
+
+    level = list(hashes)
+    kind = LEAF
+    pages = []
+    while True:
+        parents = []
+        #An empty file still has a (empty) root page
+        for start in range(0, max(len(level), 1), page_entries):
+            group = level[start:start + page_entries]
+            page = pack_page(kind, group)
+            hash = hash_data(page)
+            pages.append((hash, page))
+            parents.append((hash, sum(size for _, size in group)))
+
+        if len(parents) == 1:
+            return parents[0][0], pages
+        level = parents
+        kind = INDEX
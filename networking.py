@@ -1,13 +1,49 @@
 import asyncio
 import json
 import logging
+from collections import OrderedDict
+
+import compression
+import hash_utils
+import wire
+from admission import AdmissionControl, RequestClass
+from compression import FRAME, IncomingValue, codec_of, sendable, transcode
+from connections import (ConnectionPool, ENCODED_HELLO, HELLO, LEGACY_SIZE, MISSING, REQUEST,
+    RESPONSE, parse_hello)
+from eviction import is_id
 
 log = logging.getLogger(__name__)
 
+#Size of the pieces a chunk is streamed in when sendfile isn't available
+SEND_CHUNK_SIZE = 1 << 16
+#Most bytes read from a peer at once when receiving a chunk
+RECV_CHUNK_SIZE = 1 << 16
+#Most peers remembered as understanding binary messages
+MAX_BINARY_PEERS = 4096
+
+def read_at(file, offset, length):
+    file.seek(offset)
+    return file.read(length)
+
 class Networking:
     def __init__(self, dht_protocol, storage):
         self.dht = dht_protocol
         self.storage = storage
+        self.disk = self.dht.disk
+        #Connections for fetching chunks from other nodes
+        self.pool = ConnectionPool(
+            self.dht.loop,
+            max_size=self.dht.max_connections,
+            idle_timeout=self.dht.connection_idle_timeout,
+            codecs=compression.names() if self.dht.transfer_compression else ())
+        #Limits on the requests we handle at once, store_value requests pull the value from
+        #the requester so they get their own, smaller, limits
+        store = RequestClass("store", self.dht.max_concurrent_stores, self.dht.max_queued_stores)
+        self.admission = AdmissionControl(
+            { "store_value": store, "ping_nodes": store },
+            RequestClass("default", self.dht.max_concurrent_requests, self.dht.max_queued_requests))
+        #Addresses of the peers that understand binary messages, least recently heard from first
+        self.binary_peers = OrderedDict()
 
     #UDP
     def connection_made(self, transport):
@@ -20,31 +56,51 @@ class Networking:
         message = None
         try:
             message = self.parse_message(data)
+            version = message.get("wire")
+            if wire.is_binary(data) or (isinstance(version, int) and version >= wire.VERSION):
+                self.add_binary_peer(addr)
             if message.get("error") is not None:
                 log.info("Error parsing message %s", message.get("error"))
-                self.transport.close()
                 return
         except Exception as e:
             log.warning("Exception %s thrown parsing message %s", e, data)
-            self.transport.close()
             return
 
         is_resp = message.get("resp")
         if is_resp is not None and is_resp == True:
             self.dht.handle_response(message)
         else:
-            #make whatever store/find/etc requests
-            #Can't use yield from directly since this function is never itself scheduled
-            task = asyncio.async(self.dht.handle_request(message))
+            #make whatever store/find/etc requests, once there is room for them
+            magic = message.get("magic")
+            admitted = self.admission.submit(
+                (addr, magic if isinstance(magic, int) else id(message)),
+                message.get("type"),
+                lambda: self.dht.handle_request(message),
+                lambda task: self.send_response(task, addr))
 
-            #schedule response
-            task.add_done_callback(lambda task: self.send_message(task.result(), addr))
+            #Tell the requester to back off rather than leaving it to time out
+            if not admitted and isinstance(magic, int):
+                self.send_message({
+                    "magic": magic,
+                    "type": message.get("type"),
+                    "resp": True,
+                    "overloaded": True
+                }, addr)
         log.debug("Connection end for %s", addr)
 
+    def send_response(self, task, addr):
+        if task.cancelled() or task.exception() is not None:
+            log.warning("Error handling request from %s: %s", addr,
+                "cancelled" if task.cancelled() else task.exception())
+            return
+        self.send_message(task.result(), addr)
+
 
     def parse_message(self, data):
         if data is None:
             return {"error": "empty message"}
+        if wire.is_binary(data):
+            return wire.decode(data)
         message = json.loads(data.decode('utf8'))
 
         if not isinstance(message, dict):
@@ -52,8 +108,30 @@ class Networking:
 
         return message
 
+    def add_binary_peer(self, addr):
+        self.binary_peers[addr] = True
+        self.binary_peers.move_to_end(addr)
+        if len(self.binary_peers) > MAX_BINARY_PEERS:
+            self.binary_peers.popitem(last=False)
+
+    def encode_message(self, message, addr):
+        '''
+        Encodes message in the binary format if the peer at addr understands it, otherwise as
+        JSON, advertising that we understand the binary format
+        '''
+        if not self.dht.binary_wire:
+            return json.dumps(message).encode('utf8')
+
+        if addr in self.binary_peers:
+            try:
+                return wire.encode(message)
+            except ValueError as e:
+                log.debug("Sending message as JSON (%s)", e)
+
+        return json.dumps(dict(message, wire=wire.VERSION)).encode('utf8')
+
     def send_message(self, message, addr):
-        message_s = json.dumps(message).encode('utf8')
+        message_s = self.encode_message(message, addr)
         log.debug("Sending message %s to %s", message_s, addr)
 
         self.transport.sendto(message_s, addr)
@@ -73,50 +151,188 @@ class Networking:
         log.info("New TCP connection from %s", peer)
 
         request = yield from asyncio.wait_for(reader.readline(), timeout=15)
-        #strip the newline
-        request = request[:-1].decode()
 
-        log.info("Peer %s requested %s and we have it? %s", peer, request, self.storage.has(request))
+        codecs = parse_hello(request)
+        if request == HELLO:
+            #The peer wants to pipeline requests over this connection
+            writer.write(HELLO)
+            yield from self.serve_framed(peer, reader, writer)
+        elif codecs is not None:
+            #and can take values compressed with codecs as we store them
+            writer.write(ENCODED_HELLO)
+            yield from self.serve_framed(peer, reader, writer, compression.parse_names(codecs))
+        else:
+            #strip the newline
+            request = request[:-1].decode()
+            yield from self.serve_key(peer, request, writer)
 
+        writer.close()
+
+    @asyncio.coroutine
+    def serve_framed(self, peer, reader, writer, codecs=None):
+        '''
+        Answers framed requests in order until the peer closes the connection or leaves it
+        idle for longer than its own idle timeout. codecs is as for send_value
+        '''
+        while True:
+            try:
+                header = yield from asyncio.wait_for(
+                    reader.readexactly(REQUEST.size), timeout=self.dht.serve_idle_timeout)
+                request_id, key_len = REQUEST.unpack(header)
+                request = (yield from reader.readexactly(key_len)).decode()
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+
+            found = yield from self.send_value(
+                writer, request, lambda size: RESPONSE.pack(request_id, size), codecs)
+            log.info("Peer %s requested %s and we have it? %s", peer, request, found)
+            if not found:
+                writer.write(RESPONSE.pack(request_id, MISSING))
+
+    @asyncio.coroutine
+    def serve_key(self, peer, request, writer):
+        '''
+        Answers a single unframed request, for peers that open a connection per key
+        '''
+        found = yield from self.send_value(
+            writer, request, lambda size: LEGACY_SIZE.pack(size, b"\n"))
+        log.info("Peer %s requested %s and we have it? %s", peer, request, found)
+
+    @asyncio.coroutine
+    def send_value(self, writer, key, header, codecs=None):
+        '''
+        Sends header(size) followed by the value for key, from memory if it is waiting to be
+        written or in the storage cache, and otherwise straight from its file. Returns whether
+        we have the value.
 
-        if self.storage.has(request):
-            log.info("Serving %s", request)
-            data = self.storage.get(request)
-            data_len = len(data)
-            writer.write(data_len.to_bytes(4, byteorder="little") + b"\n")
+        The value is sent as it is stored if the peer decodes codecs, the set of compression
+        codecs it gave in its hello, or has to be decompressed if codecs is None or doesn't
+        hold the codec the value was stored with
+        '''
+        #Values are only ever asked for by their hash, any other key could name a path outside
+        #of the storage
+        if not is_id(key):
+            return False
+
+        data = self.disk.queued(key)
+        if data is None:
+            data = self.storage.cached(key)
+        if data is None:
+            value = yield from self.disk.open(key)
+            if value is None:
+                return False
+
+            file, offset, length = value
+            with file:
+                head = yield from self.disk.run(read_at, file, offset, min(length, FRAME.size))
+                if sendable(codec_of(head), codecs):
+                    writer.write(header(length))
+                    yield from self.send_file(writer, file, offset, length)
+                    return True
+                data = yield from self.disk.run(read_at, file, offset, length)
+
+        if not sendable(codec_of(data), codecs):
+            data = yield from self.disk.run(transcode, data, codecs)
+        writer.write(header(len(data)))
+        writer.write(data)
+        yield from writer.drain()
+        return True
+
+    @asyncio.coroutine
+    def send_file(self, writer, file, offset, length):
+        '''
+        Sends length bytes of file from offset to the peer. Uses sendfile where the event loop
+        supports it, so the data goes from the page cache to the socket without being copied
+        through python, otherwise streams the file in SEND_CHUNK_SIZE pieces
+        '''
+        loop = self.dht.loop
+        if hasattr(loop, "sendfile"):
             yield from writer.drain()
-            log.debug("Sent size header (%d) for %s", data_len, request)
-            if isinstance(data, str):
-                data = data.encode()
+            #Falls back to reading and writing the file itself if the transport can't sendfile
+            yield from loop.sendfile(writer.transport, file, offset, length)
+            return
+
+        file.seek(offset)
+        while length > 0:
+            data = yield from self.disk.run(file.read, min(length, SEND_CHUNK_SIZE))
+            if not data:
+                raise EOFError("Stored value ended {} bytes early".format(length))
             writer.write(data)
             yield from writer.drain()
-            log.debug("Sent data for %s", request)
-
-        writer.close()
+            length -= len(data)
 
     @asyncio.coroutine
     def request_key(self, hash_id, node):
-        data = None
+        '''
+        Streams the value for hash_id from node into storage, hashing it as it arrives. The
+        value is only stored if it matches hash_id. Returns whether the value was stored.
+        Requests to the same node share one pooled connection
+        '''
+        if not is_id(hash_id):
+            log.warning("Not requesting %s from %s:%s, it isn't a hash", hash_id, node.ip, node.port)
+            return False
+
         try:
-            reader, writer = yield from asyncio.open_connection(node.ip, node.port)
+            #Round trip estimates come from small UDP requests, while a response header also
+            #waits on the peer's disk and the requests ahead of it on the connection
+            timeout = self.dht.transfer_timeout
+            conn = yield from self.pool.get((node.ip, node.port), timeout)
+            return (yield from conn.request(
+                hash_id,
+                lambda reader, size: self.receive_value(
+                    hash_id, reader, size, conn.encoded, timeout),
+                timeout))
 
-            #Request the key
-            writer.write(hash_id.encode() + b"\n")
-            yield from writer.drain()
-            #Wait until the request has been sent before continuing
+        except Exception as e:
+            log.warning("Error requesting %s from %s:%s (%s)", hash_id, node.ip, node.port, e)
+            return False
 
-            size = yield from asyncio.wait_for(reader.readline(), timeout=10)
-            size = int.from_bytes(size[:-1], byteorder="little")
+    @asyncio.coroutine
+    def receive_value(self, hash_id, reader, size, encoded=False, timeout=None):
+        '''
+        Reads a size byte value for hash_id off reader into storage, as the peer stores it if
+        encoded and otherwise uncompressed. The hash is checked against the uncompressed value.
+        Fails with a TimeoutError if no data arrives for timeout seconds, rather than holding
+        up the requests behind it on the connection
+        '''
+        if size == MISSING:
+            log.info("Peer doesn't have %s", hash_id)
+            return False
+
+        log.debug("Request %s of size %d", hash_id, size)
+        partial = yield from self.disk.run(self.storage.create, hash_id)
+        try:
+            h = hash_utils.new_hash()
+            incoming = IncomingValue(size, encoded)
+            remaining = size
+            while remaining > 0:
+                data = yield from asyncio.wait_for(
+                    reader.read(min(remaining, RECV_CHUNK_SIZE)), timeout=timeout)
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(data)
+                stored, value = incoming.feed(data)
+                h.update(value)
+                if stored:
+                    yield from self.disk.run(partial.write, stored)
+            stored, value = incoming.finish()
+            h.update(value)
+            if stored:
+                yield from self.disk.run(partial.write, stored)
+            log.debug("Finished receiving data for %s, received %d bytes", hash_id, size)
 
-            log.debug("Request %s of size %d", hash_id, size)
-            data = yield from reader.readexactly(size)
-            log.debug("Finished receiving data for %s, received %d bytes", hash_id, len(data))
-            data = data
+            digest = h.hexdigest()
+            if digest != hash_id:
+                log.warning("Data returned for request %s did not match the hash (calculated %s)", hash_id, digest)
+                return False
 
-        except Exception as e:
-            log.warning("Error connecting to %s:%s (%s)", node.ip, node.port, e)
+            yield from self.disk.commit(partial)
+            partial = None
+            return True
 
-        return data
+        finally:
+            if partial is not None:
+                partial.discard()
 
 
     #General
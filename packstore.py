@@ -0,0 +1,409 @@
+import io
+import mmap
+import os
+import struct
+import threading
+from logging import getLogger
+
+from eviction import RecentKeys
+from storage import ChunkCache
+
+log = getLogger(__name__)
+
+#Index records: operation and key length, then the key, then for additions where the value is
+#(pack, offset, length)
+ADD, CLEAR = range(2)
+RECORD = struct.Struct("<BH")
+LOCATION = struct.Struct("<IQI")
+
+INDEX_NAME = "index.log"
+PACK_NAME = "pack-{:08d}.dat"
+
+class BufferedValue:
+    '''
+    A value being written to a PackStorage, which is only added once committed
+    '''
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        self.buffer = io.BytesIO()
+
+    def write(self, data):
+        self.buffer.write(data)
+
+    def commit(self, sync=False):
+        if not self.storage.set_many([(self.key, self.buffer.getvalue())], sync)[0]:
+            raise OSError("Couldn't store {}".format(self.key))
+
+    def discard(self):
+        self.buffer = None
+
+
+class PackStorage:
+    '''
+    Values appended to large pack files instead of one file per key, for stores with many
+    small values.
+
+    Every change is appended to an index log of (key, pack, offset, length) records, which is
+    read back at startup into an in-memory index. Values are read through a memory map of
+    their pack. Cleared values stay in their pack until maintain() compacts it, by copying
+    the live values of packs that are mostly cleared values to the end of the current pack
+    and deleting the old pack. close() releases the index log, the current pack and the
+    memory maps, and the store can be used as a context manager that closes it.
+
+    size is the total size of the values still in use, cleared values count against the
+    disk until their pack is compacted.
+
+    Has the same interface as storage.Storage, and is safe to use from the storage threads
+    and the event loop at once.
+    '''
+    def __init__(self, file_dir, cache_size=64 << 20, max_pack_size=64 << 20, compact_ratio=0.5):
+        self.file_dir = file_dir
+        self.max_pack_size = max_pack_size
+        #Packs with at least this fraction of cleared bytes are compacted
+        self.compact_ratio = compact_ratio
+        #Recently read or written values, so that popular values are served from memory
+        self.cache = ChunkCache(cache_size)
+        #Held while the packs or the index are read or changed
+        self.lock = threading.RLock()
+        #Recently used keys, which are evicted last
+        self.recent = RecentKeys()
+        self.size = 0
+
+        os.makedirs(self.file_dir, exist_ok=True)
+
+        #key => (pack, offset, length)
+        self.index = {}
+        #pack => keys of the live values in it
+        self.pack_keys = {}
+        #pack => bytes of cleared values in it
+        self.dead_bytes = {}
+        #pack => memory map of it, created on first read
+        self.maps = {}
+        #Records in the index log that have been superseded
+        self.dead_records = 0
+
+        self.load_index()
+        for name in os.listdir(self.file_dir):
+            if name.startswith("pack-"):
+                pack = int(name[5:-4])
+                self.pack_keys.setdefault(pack, set())
+                self.dead_bytes.setdefault(pack, 0)
+
+        self.pack = max(self.pack_keys, default=0)
+        self.pack_file = None
+        self.open_pack(self.pack)
+
+        self.set(
+            "2ea970ff63aec5d7a014ca6447ec743d3ba37450b85ebdcbb582b089b0194fa2",
+            b"\xdf")
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def indexed(self):
+        return True
+
+    def close(self):
+        '''
+        Closes the index log, the current pack and the memory maps of the packs read from.
+        Files returned by open are the caller's to close
+        '''
+        with self.lock:
+            for mm in self.maps.values():
+                mm.close()
+            self.maps.clear()
+            if self.pack_file is not None:
+                self.pack_file.close()
+                self.pack_file = None
+            self.index_file.close()
+
+    def pack_path(self, pack):
+        return os.path.join(self.file_dir, PACK_NAME.format(pack))
+
+    def load_index(self):
+        path = os.path.join(self.file_dir, INDEX_NAME)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b""
+
+        offset = 0
+        while offset < len(data):
+            try:
+                op, key_len = RECORD.unpack_from(data, offset)
+                key = data[offset + RECORD.size:offset + RECORD.size + key_len].decode()
+                end = offset + RECORD.size + key_len
+                location = None
+                if op == ADD:
+                    location = LOCATION.unpack_from(data, end)
+                    end += LOCATION.size
+                if end > len(data):
+                    raise ValueError("Truncated record")
+            except (struct.error, ValueError) as e:
+                #The last record was cut short by a crash
+                log.warning("Dropping %d bytes at the end of the index (%s)", len(data) - offset, e)
+                break
+
+            self.__forget(key)
+            if location is not None:
+                self.index[key] = location
+                self.pack_keys.setdefault(location[0], set()).add(key)
+                self.size += location[2]
+            offset = end
+
+        self.index_file = open(path, "ab")
+        self.index_file.truncate(offset)
+
+    def open_pack(self, pack):
+        if self.pack_file is not None:
+            #Values are only added once their pack is on disk, so it is synced before moving on
+            self.pack_file.flush()
+            os.fsync(self.pack_file.fileno())
+            self.pack_file.close()
+        self.pack = pack
+        self.pack_keys.setdefault(pack, set())
+        self.dead_bytes.setdefault(pack, 0)
+        self.pack_file = open(self.pack_path(pack), "ab")
+
+    def __forget(self, key):
+        '''
+        Drops the index entry for key, counting its bytes as dead
+        '''
+        location = self.index.pop(key, None)
+        if location is None:
+            return None
+
+        pack, _, length = location
+        self.pack_keys[pack].discard(key)
+        self.dead_bytes[pack] = self.dead_bytes.get(pack, 0) + length
+        self.dead_records += 1
+        self.size -= length
+        return location
+
+    def __record(self, op, key, location=None):
+        raw = key.encode()
+        record = RECORD.pack(op, len(raw)) + raw
+        if location is not None:
+            record += LOCATION.pack(*location)
+        self.index_file.write(record)
+        self.index_file.flush()
+
+    def __write(self, value):
+        '''
+        Appends value to the current pack, returning its location
+        '''
+        if self.pack_file.tell() + len(value) > self.max_pack_size and self.pack_file.tell() > 0:
+            self.open_pack(self.pack + 1)
+
+        offset = self.pack_file.tell()
+        self.pack_file.write(value)
+        self.pack_file.flush()
+        return (self.pack, offset, len(value))
+
+    def __add(self, key, location):
+        self.__forget(key)
+        self.__record(ADD, key, location)
+        self.index[key] = location
+        self.pack_keys[location[0]].add(key)
+        self.size += location[2]
+
+    def sync(self):
+        '''
+        Waits until the current pack and the index are on disk
+        '''
+        with self.lock:
+            os.fsync(self.pack_file.fileno())
+            os.fsync(self.index_file.fileno())
+
+    def __read(self, location):
+        pack, offset, length = location
+        if length == 0:
+            return b""
+        mm = self.maps.get(pack)
+        #The current pack grows, so its map is remade once it no longer covers the value
+        if mm is None or offset + length > len(mm):
+            if mm is not None:
+                mm.close()
+            with open(self.pack_path(pack), "rb") as file:
+                mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[pack] = mm
+        return mm[offset:offset + length]
+
+    def keys(self):
+        return list(self.index)
+
+    def iter_keys(self):
+        return iter(list(self.index))
+
+    def has(self, key):
+        return key in self.index
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is not None:
+            self.recent.touch(key)
+            return value
+
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            value = self.__read(location)
+        self.recent.touch(key)
+        self.cache.put(key, value)
+        return value
+
+    def cached(self, key):
+        '''
+        The value for key if it is in the cache, otherwise None
+        '''
+        value = self.cache.get(key)
+        if value is not None:
+            self.recent.touch(key)
+        return value
+
+    def open(self, key):
+        '''
+        Opens the stored value for key so it can be streamed instead of read into memory.
+        Returns (file, offset, length) where the value is the length bytes of the binary file
+        starting at offset, or None if we don't have the key
+        '''
+        with self.lock:
+            location = self.index.get(key)
+            if location is None:
+                return None
+            pack, offset, length = location
+            self.recent.touch(key)
+            return open(self.pack_path(pack), "rb"), offset, length
+
+    def create(self, key):
+        '''
+        Starts writing a value for key piece by piece, returning a BufferedValue which must be
+        committed (or discarded) once the value is complete
+        '''
+        return BufferedValue(self, key)
+
+    def set(self, key, value):
+        return self.set_many([(key, value)])[0]
+
+    def set_many(self, items, sync=False):
+        '''
+        Stores each (key, value) of items, returning a list of whether each was stored.
+        With sync the values are on disk before any is added to the index, and the whole
+        batch costs one sync of the pack and one of the index
+        '''
+        with self.lock:
+            locations = []
+            for key, value in items:
+                try:
+                    locations.append(self.__write(value))
+                except OSError as e:
+                    log.warning("Couldn't store %s (%s)", key, e)
+                    locations.append(None)
+            if sync:
+                os.fsync(self.pack_file.fileno())
+
+            results = []
+            for (key, value), location in zip(items, locations):
+                if location is not None:
+                    try:
+                        self.__add(key, location)
+                    except OSError as e:
+                        log.warning("Couldn't index %s (%s)", key, e)
+                        location = None
+
+                if location is None:
+                    self.cache.discard(key)
+                    results.append(False)
+                else:
+                    self.recent.touch(key)
+                    self.cache.put(key, value)
+                    results.append(True)
+
+            if sync:
+                os.fsync(self.index_file.fileno())
+            return results
+
+    def clear(self, key):
+        '''
+        Removes the value for key, returning its size
+        '''
+        self.cache.discard(key)
+        self.recent.discard(key)
+        with self.lock:
+            location = self.__forget(key)
+            if location is None:
+                raise KeyError(key)
+            self.__record(CLEAR, key)
+        return location[2]
+
+    def maintain(self, limit=None):
+        '''
+        Does up to limit steps of background upkeep, returning the number of steps left.
+        For this store that is copying live values out of the packs being compacted
+        '''
+        with self.lock:
+            moved = 0
+            for pack in self.compactable():
+                for key in list(self.pack_keys[pack]):
+                    if limit is not None and moved >= limit:
+                        return self.compaction_left()
+                    self.__add(key, self.__write(self.__read(self.index[key])))
+                    moved += 1
+                #The copies have to be on disk before the originals are gone
+                self.sync()
+                self.remove_pack(pack)
+
+            #Rewrite the index once it is mostly superseded records
+            if self.dead_records > max(1024, len(self.index)):
+                self.rewrite_index()
+            return 0
+
+    def compactable(self):
+        '''
+        The packs, other than the one being written to, that are mostly cleared values
+        '''
+        packs = []
+        for pack, keys in self.pack_keys.items():
+            if pack == self.pack:
+                continue
+            dead = self.dead_bytes.get(pack, 0)
+            live = sum(self.index[k][2] for k in keys)
+            if len(keys) == 0 or dead >= self.compact_ratio * (dead + live):
+                packs.append(pack)
+        return packs
+
+    def compaction_left(self):
+        return sum(len(self.pack_keys[p]) for p in self.compactable())
+
+    def remove_pack(self, pack):
+        log.info("Removing compacted pack %d", pack)
+        mm = self.maps.pop(pack, None)
+        if mm is not None:
+            mm.close()
+        os.unlink(self.pack_path(pack))
+        del self.pack_keys[pack]
+        self.dead_bytes.pop(pack, None)
+
+    def rewrite_index(self):
+        path = os.path.join(self.file_dir, INDEX_NAME)
+        partial = path + ".new"
+        with open(partial, "wb") as file:
+            for key, location in self.index.items():
+                raw = key.encode()
+                file.write(RECORD.pack(ADD, len(raw)) + raw + LOCATION.pack(*location))
+            file.flush()
+            os.fsync(file.fileno())
+        self.index_file.close()
+        os.replace(partial, path)
+        self.index_file = open(path, "ab")
+        self.dead_records = 0
@@ -0,0 +1,105 @@
+import heapq
+import logging
+
+import hash_utils
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger(__name__)
+
+HAVE_NUMPY = np is not None
+
+#Below this many candidates (times targets) a batch is ranked in python, as building the
+#matrix costs more than it saves
+NUMPY_MIN_PAIRS = 4096
+#Upper bound on the number of (target, candidate) pairs ranked at once in a batch,
+#to bound the size of the intermediate distance array
+MAX_BATCH_PAIRS = 1 << 20
+ID_BYTES = 32
+
+def target_id(hash_id):
+    '''
+    Integer form of a hex target id, checking that it is a 256 bit id
+    '''
+    if not isinstance(hash_id, str) or len(hash_id) != 2 * ID_BYTES:
+        raise ValueError("Target {} is not a {} bit hex id".format(hash_id, 8 * ID_BYTES))
+    return hash_utils.id_to_int(hash_id)
+
+def pack_ids(int_ids):
+    '''
+    Packs 256 bit integer ids into an (n, 4) uint64 matrix, most significant word first,
+    so that comparing rows lexicographically compares the ids numerically
+    '''
+    raw = b"".join(i.to_bytes(ID_BYTES, byteorder="big") for i in int_ids)
+    return np.frombuffer(raw, dtype=">u8").reshape(-1, 4).astype(np.uint64)
+
+
+class NodeRanker:
+    '''
+    Ranks a fixed set of candidate nodes by XOR distance to one or many target ids.
+
+    Uses NumPy when it is installed, storing the candidate ids as a packed (n, 4) uint64
+    matrix that is built once and reused for every ranking, otherwise falls back to
+    ranking in python.
+    '''
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.ids = None
+        if HAVE_NUMPY and len(self.nodes) > 0:
+            self.ids = pack_ids(n.id for n in self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def nearest(self, hash_id, k=7):
+        '''
+        Returns the k candidates nearest to hash_id, nearest first
+        '''
+        target = target_id(hash_id)
+        return heapq.nsmallest(k, self.nodes, key=lambda x: x.distance(target))
+
+    def nearest_batch(self, hash_ids, k=7):
+        '''
+        Returns a list with the k nearest candidates (nearest first) for each of hash_ids
+        '''
+        hash_ids = list(hash_ids)
+        if self.ids is None or len(hash_ids) * len(self.nodes) < NUMPY_MIN_PAIRS:
+            return [self.nearest(h, k) for h in hash_ids]
+
+        targets = pack_ids(target_id(h) for h in hash_ids)
+        k = min(k, len(self.nodes))
+        rows = max(1, MAX_BATCH_PAIRS // len(self.nodes))
+
+        results = []
+        for start in range(0, len(targets), rows):
+            block = targets[start:start + rows]
+            #(targets, candidates, words)
+            dists = self.ids[None, :, :] ^ block[:, None, :]
+            results.extend([self.nodes[i] for i in row] for row in self.__top_k(dists, k).tolist())
+
+        return results
+
+    def __top_k(self, dists, k):
+        '''
+        Indices of the k smallest distances in each row of a (targets, candidates, words) array
+        '''
+        n = dists.shape[1]
+        width = min(n, 2 * k)
+        high = dists[..., 0]
+
+        #Narrow each row down to the smallest entries by their most significant word, which is
+        #exact as long as no row has more than width entries tied up to its kth smallest word
+        if width < n:
+            kth = np.partition(high, k - 1, axis=-1)[:, k - 1]
+            if (np.count_nonzero(high <= kth[:, None], axis=-1) <= width).all():
+                candidates = np.argpartition(high, width - 1, axis=-1)[:, :width]
+                subset = np.take_along_axis(dists, candidates[..., None], axis=1)
+                order = np.lexsort(
+                    (subset[..., 3], subset[..., 2], subset[..., 1], subset[..., 0]), axis=-1)[:, :k]
+                return np.take_along_axis(candidates, order, axis=1)
+
+        return np.lexsort(
+            (dists[..., 3], dists[..., 2], dists[..., 1], dists[..., 0]), axis=-1)[:, :k]
@@ -48,6 +48,7 @@ class REPL(object):
         try:
             self.loop.run_forever()
         finally:
+            dht.close()
             self.loop.close()
 
     def print(self, *args, **kwargs):
@@ -81,7 +82,7 @@ class REPL(object):
         self.print("(paths containing spaces should be wrapped in quotes)")
         self.print()
 
-    # @asyncio.coroutine
+    @asyncio.coroutine
     def cli(self):
         self.print("Distributed File Storage CLI")
         self.print("Written by Schuyler Rosefield and Ryan Cebulko")
@@ -90,8 +91,11 @@ class REPL(object):
 
         while True:
             self.print(">>> ", end="", flush=True)
-            self.handle_input(input())
+            # wait for input on another thread so the node keeps serving requests
+            line = yield from self.loop.run_in_executor(None, input)
+            yield from self.handle_input(line)
 
+    @asyncio.coroutine
     def handle_input(self, input):
         args = shlex.split(input)
 
@@ -100,16 +104,16 @@ class REPL(object):
 
             if op in ("s", "store") and len(args) == 2:
                 # store a file
-                self.client.store_file(*args)
+                yield from self.client.store_file_async(*args)
                 self.print()
             elif op in ("r", "retrieve") and len(args) == 2:
                 # retrieve a file
-                self.client.retrieve_file(*args)
+                yield from self.client.retrieve_file_async(*args)
                 self.print()
             elif op in ("t", "test") and len(args):
                 # test storing and retrieving a file
                 for file in args:
-                    self.test_store_retrieve(file)
+                    yield from self.test_store_retrieve(file)
                 self.print()
             elif op in ("c", "clear") and len(args):
                 # clear a file from local storage
@@ -131,9 +135,10 @@ class REPL(object):
         else:
             self.show_usage()
 
+    @asyncio.coroutine
     def test_store_retrieve(self, file_path):
-        self.handle_input("s %s dht_store/tmp_keys" % file_path)
-        self.handle_input("r dht_store/tmp_keys dht_store/tmp_data")
+        yield from self.handle_input("s %s dht_store/tmp_keys" % file_path)
+        yield from self.handle_input("r dht_store/tmp_keys dht_store/tmp_data")
 
         with open(file_path, "rb") as file:
             hash_before = hash_data(file.read())
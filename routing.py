@@ -1,14 +1,41 @@
 import hash_utils
+import heapq
 import logging
+from collections import OrderedDict
+
+import ranking
+from ranking import NUMPY_MIN_PAIRS, NodeRanker
 
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
+#Ids are 256 bit hashes, so there is one bucket per possible length of shared prefix
+ID_BITS = 256
+#Number of replacement candidates to remember for each full bucket
+REPLACEMENT_CACHE_SIZE = 10
+
 class Node:
+    __slots__ = ("node_id", "ip", "port", "id")
+
     def __init__(self, n):
-        self.node_id = n["node_id"]
+        node_id = n["node_id"]
+        if not isinstance(node_id, str) or len(node_id) != ID_BITS // 4:
+            raise ValueError("Node id {} is not a {} bit hex id".format(node_id, ID_BITS))
+
+        self.node_id = node_id
         self.ip = n["ip"]
         self.port = n["port"]
+        #Integer form of node_id, so that distances are a single xor
+        self.id = hash_utils.id_to_int(self.node_id)
+
+    def to_dict(self):
+        return { "node_id": self.node_id, "ip": self.ip, "port": self.port }
+
+    def distance(self, target):
+        '''
+        XOR distance from this node to target, an integer id
+        '''
+        return self.id ^ target
 
     def __repr__(self):
         return "Node(id {}, ip {}, port {})".format(self.node_id, self.ip, self.port)
@@ -17,73 +44,195 @@ class Node:
         return "Node(id {}, ip {}, port {})".format(self.node_id, self.ip, self.port)
 
     def __eq__(self, other):
-        return self.node_id == other.node_id
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self.id == other.id
 
     def __hash__(self):
-        return hash(self.node_id)
+        return hash(self.id)
+
+
+class KBucket:
+    '''
+    A single bucket of the routing table, holding up to bucket_size nodes ordered from
+    least to most recently seen
+    '''
+    def __init__(self, bucket_size):
+        self.bucket_size = bucket_size
+        self.nodes = OrderedDict()
+        #Nodes that we have heard from while the bucket was full, used when a node is removed
+        self.replacements = OrderedDict()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def is_full(self):
+        return len(self.nodes) >= self.bucket_size
+
+    def least_recent(self):
+        return next(iter(self.nodes.values()))
+
+    def touch(self, node):
+        '''
+        Marks the node as the most recently seen node in the bucket
+        '''
+        self.nodes[node.node_id] = node
+        self.nodes.move_to_end(node.node_id)
+
+    def add_replacement(self, node):
+        self.replacements[node.node_id] = node
+        self.replacements.move_to_end(node.node_id)
+        if len(self.replacements) > REPLACEMENT_CACHE_SIZE:
+            self.replacements.popitem(last=False)
+
+    def remove(self, node_id):
+        self.replacements.pop(node_id, None)
+        if node_id not in self.nodes:
+            return False
+
+        del self.nodes[node_id]
+        #Promote the most recently seen replacement into the freed slot
+        if len(self.replacements) > 0:
+            _, replacement = self.replacements.popitem()
+            self.nodes[replacement.node_id] = replacement
+        return True
 
 
 class Routing:
     def __init__(self, node, nodes, bucket_size = 20):
-        self.nodes = {}
         self.node = node
         self.bucket_size = bucket_size
-        self.set_nodes(nodes)
+        self.buckets = [KBucket(bucket_size) for _ in range(ID_BITS)]
+        #Ranker over the whole table for batch lookups, rebuilt after the table changes
+        self.ranker = None
+        self.add_nodes(nodes)
 
     def __iter__(self):
-        for k,v in self.nodes.items():
-            yield v
+        for bucket in self.buckets:
+            for node in bucket:
+                yield node
 
-    def set_nodes(self, nodes):
-        self.nodes = {}
-        for node in nodes:
-            self.nodes[node.node_id] = node
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def bucket_for(self, node):
+        '''
+        The bucket for node, given by the position of the highest bit of its id that differs
+        from our own id. Returns None for our own id.
+        '''
+        index = node.distance(self.node.id).bit_length() - 1
+        if index < 0:
+            return None
+        return self.buckets[index]
 
     def add_nodes(self, nodes):
+        '''
+        Adds nodes that we have heard about (but not necessarily from) to the table.
+        Nodes only fill free slots, and go to the replacement cache for full buckets. Nodes
+        already in the table are left alone, since we haven't verified the new information
+        '''
         if len(nodes) == 0:
             return
-        if len(nodes) > self.bucket_size:
-            nodes = self.nearest_nodes(self.node.node_id, nodes, self.bucket_size)
 
         log.debug("Adding nodes %s", nodes)
 
         for node in nodes:
-            if node.node_id == self.node.node_id:
+            bucket = self.bucket_for(node)
+            if bucket is None or node.node_id in bucket.nodes:
                 continue
-            self.nodes[node.node_id] = node
-
-        self.set_nodes(self.nearest_nodes(self.node.node_id, k=self.bucket_size))
-        log.debug("Bucket size now %d", len(self.nodes))
-        
+            if not bucket.is_full():
+                bucket.touch(node)
+                self.ranker = None
+            else:
+                bucket.add_replacement(node)
 
     def add_or_update_node(self, node):
-        if(node.node_id == self.node.node_id):
-            return
-        id = node.node_id
-        if id in self.nodes:
-            log.debug("Updating node %s", id)
-            self.nodes[id] = node
-        else:
+        '''
+        Records that we have heard from node.
+
+        If the node's bucket is full the node is added to the replacement cache and the
+        least recently seen node of the bucket is returned, which the caller should ping
+        and then either update (it is alive) or remove (it is dead, and will be replaced).
+        Otherwise returns None.
+        '''
+        bucket = self.bucket_for(node)
+        if bucket is None:
+            return None
+
+        if node.node_id in bucket.nodes:
+            log.debug("Updating node %s", node.node_id)
+            old = bucket.nodes[node.node_id]
+            if (old.ip, old.port) != (node.ip, node.port):
+                self.ranker = None
+            bucket.touch(node)
+            return None
+
+        if not bucket.is_full():
             log.debug("Adding node %s", node)
-            self.nodes[id] = node
-            self.set_nodes(self.nearest_nodes(self.node.node_id, k=self.bucket_size))
+            bucket.touch(node)
+            self.ranker = None
+            return None
 
-        return
+        bucket.add_replacement(node)
+        return bucket.least_recent()
 
     def remove_node(self, node):
-        id = node.node_id
-        if id in self.nodes:
-            del self.nodes[id]
+        bucket = self.bucket_for(node)
+        if bucket is not None and bucket.remove(node.node_id):
+            self.ranker = None
 
     def nearest_nodes(self, node_id, nodes= None, k=7):
         '''
         Return the top k nodes who's ids are nearest to the provided hash
         '''
+        target = hash_utils.id_to_int(node_id)
 
         if nodes is None:
-            nodes = self.nodes
-            top =  sorted(nodes, key=lambda x: hash_utils.dist(node_id, x))[:k]
-            return [nodes[x] for x in top]
-        else:
-            top = sorted(nodes, key=lambda x: hash_utils.dist(node_id, x.node_id))[:k]
-            return top
+            nodes = self.__candidates(target, k)
+
+        return heapq.nsmallest(k, nodes, key=lambda x: x.id ^ target)
+
+    def nearest_nodes_batch(self, node_ids, nodes=None, k=7):
+        '''
+        Like nearest_nodes, but for many hashes at once. Returns a list with the top k nodes
+        for each of node_ids
+        '''
+        if nodes is not None:
+            return NodeRanker(nodes).nearest_batch(node_ids, k)
+
+        #Ranking the whole table in python is slower than walking the buckets for each hash
+        node_ids = list(node_ids)
+        if not ranking.HAVE_NUMPY or len(node_ids) * len(self) < NUMPY_MIN_PAIRS:
+            return [self.nearest_nodes(node_id, k=k) for node_id in node_ids]
+
+        #The packed table is reused until the table changes
+        if self.ranker is None:
+            self.ranker = NodeRanker(self)
+        return self.ranker.nearest_batch(node_ids, k)
+
+    def __candidates(self, target, k):
+        '''
+        Collects at least k nodes (if we know that many) which are guaranteed to contain the
+        k nearest nodes to target, by walking buckets in order of increasing distance
+        '''
+        index = (target ^ self.node.id).bit_length() - 1
+
+        #Nodes in the target's bucket share more of its prefix than any other nodes, then nodes
+        #in all lower buckets are at the same distance band, followed by each higher bucket in turn
+        groups = []
+        if index >= 0:
+            groups.append([index])
+            groups.append(range(index - 1, -1, -1))
+        groups.extend([i] for i in range(index + 1, ID_BITS))
+
+        candidates = []
+        for group in groups:
+            for i in group:
+                candidates.extend(self.buckets[i])
+            if len(candidates) >= k:
+                break
+
+        return candidates
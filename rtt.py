@@ -0,0 +1,102 @@
+import logging
+
+log = logging.getLogger(__name__)
+
+#Gains for the smoothed round trip time and its variation, as in TCP (RFC 6298)
+ALPHA = 1 / 8
+BETA = 1 / 4
+#Number of deviations above the smoothed round trip time allowed before a timeout
+K = 4
+
+class RTTEstimate:
+    '''
+    Smoothed round trip time (srtt) and round trip time variation (rttvar) for one node
+    '''
+    __slots__ = ("srtt", "rttvar", "backoff")
+
+    def __init__(self, sample):
+        self.srtt = sample
+        self.rttvar = sample / 2
+        #Multiplier applied to the timeout after timeouts, reset by the next sample
+        self.backoff = 1
+
+    def update(self, sample):
+        self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - sample)
+        self.srtt = (1 - ALPHA) * self.srtt + ALPHA * sample
+        self.backoff = 1
+
+    def rto(self):
+        return (self.srtt + K * self.rttvar) * self.backoff
+
+
+class RTTTable:
+    '''
+    Per-node round trip time estimates, keyed by node id, used to pick the timeout for each
+    request and to prefer faster nodes.
+
+    Nodes we have no samples for get initial_timeout. All timeouts are clamped to
+    [min_timeout, max_timeout].
+    '''
+    def __init__(self, initial_timeout=1., min_timeout=0.2, max_timeout=15., max_size=4096):
+        self.initial_timeout = initial_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_size = max_size
+        self.estimates = {}
+
+    def __len__(self):
+        return len(self.estimates)
+
+    def __contains__(self, node):
+        return node.node_id in self.estimates
+
+    def add_sample(self, node, sample):
+        '''
+        Records a round trip time (in seconds) measured for a request to node. Only requests
+        that were answered on their first transmission give a sample, since a response to
+        a retransmitted request can't be matched to one of the attempts
+        '''
+        estimate = self.estimates.get(node.node_id)
+        if estimate is not None:
+            estimate.update(sample)
+            return
+
+        if len(self.estimates) >= self.max_size:
+            #Forget the oldest node, dicts are in insertion order
+            del self.estimates[next(iter(self.estimates))]
+        self.estimates[node.node_id] = RTTEstimate(sample)
+
+    def timed_out(self, node):
+        '''
+        Records that a request to node went unanswered, doubling its timeout until the next
+        sample as in TCP
+        '''
+        estimate = self.estimates.get(node.node_id)
+        if estimate is not None and estimate.rto() < self.max_timeout:
+            estimate.backoff *= 2
+
+    def srtt(self, node):
+        '''
+        The smoothed round trip time to node, or None if we have no samples for it
+        '''
+        estimate = self.estimates.get(node.node_id)
+        return None if estimate is None else estimate.srtt
+
+    def timeout(self, node):
+        '''
+        The time to wait for a response from node before retransmitting
+        '''
+        estimate = self.estimates.get(node.node_id)
+        if estimate is None:
+            return self.initial_timeout
+        return min(self.max_timeout, max(self.min_timeout, estimate.rto()))
+
+    def fastest(self, nodes):
+        '''
+        Orders nodes by smoothed round trip time, fastest first, keeping the given order for
+        nodes we have no samples for after all of the measured ones
+        '''
+        def key(node):
+            srtt = self.srtt(node)
+            return (srtt is None, srtt or 0.)
+        return sorted(nodes, key=key)
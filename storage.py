@@ -1,45 +1,473 @@
 import os
+import tempfile
+import threading
+from collections import OrderedDict
 from logging import getLogger
 
+from bloom import BloomFilter
+from eviction import RecentKeys, is_id
+
 log = getLogger(__name__)
 
+#Prefix of the files holding values that are still being written, which aren't keys
+PARTIAL_PREFIX = ".partial-"
+
+class ChunkCache:
+    '''
+    Least recently used cache of values, holding at most max_bytes of them. Safe to use
+    from the storage threads and the event loop at once
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        #key => value, least recently used first
+        self.values = OrderedDict()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.values.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.__discard(key)
+            #A value that would push out most of the cache isn't worth keeping
+            if len(value) > self.max_bytes // 4:
+                return
+
+            self.values[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.values.popitem(last=False)
+                self.size -= len(evicted)
+
+    def discard(self, key):
+        with self.lock:
+            self.__discard(key)
+
+    def __discard(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.size -= len(value)
+
+
+class PartialValue:
+    '''
+    A value being written to storage, which only appears under its key once committed
+    '''
+    def __init__(self, storage, key):
+        self.storage = storage
+        self.key = key
+        fd, self.partial_path = tempfile.mkstemp(dir=storage.file_dir, prefix=PARTIAL_PREFIX)
+        self.file = os.fdopen(fd, "wb")
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def close(self, sync=False):
+        '''
+        Finishes writing the value, with sync waiting until it is on disk
+        '''
+        if sync and not self.file.closed:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+
+    def commit(self, sync=False):
+        '''
+        Atomically moves the value into place under its key
+        '''
+        self.close(sync)
+        path = self.storage.prepare(self.key)
+        replaced = file_size(path)
+        os.replace(self.partial_path, path)
+        if sync:
+            sync_dir(os.path.dirname(path))
+        self.storage.added(self.key, self.size - replaced)
+
+    def discard(self):
+        self.close()
+        try:
+            os.unlink(self.partial_path)
+        except OSError:
+            pass
+
+
+def file_size(path):
+    '''
+    Size of the file at path, or 0 if there is none
+    '''
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def sync_dir(path):
+    '''
+    Waits until the entries of the directory at path are on disk
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class Storage:
-    def __init__(self, file_dir):
+    '''
+    Values stored as one file per key under file_dir.
+
+    Files are spread over nested directories named after prefixes of their key, with one
+    level for each entry of fanout, so fanout (2, 2) stores key abcdef... as ab/cd/abcdef...
+    Keys no longer than the prefixes stay in file_dir itself. Files left in another layout
+    (from before the fanout changed) are still found, and migrate() moves them into place
+    while the store is in use. Only files named like a hash are taken for values when the
+    directory is read, so that other files kept there are left alone.
+
+    index decides how has() and keys() avoid going to the disk: "keys" keeps every key in
+    memory, "bloom" keeps a Bloom filter that answers for the keys we don't have (the common
+    case for find_value requests) and checks the disk for the rest, and "none" always checks
+    the disk.
+
+    size is the total size of the values, which eviction keeps under the node's capacity
+    '''
+    def __init__(self, file_dir, cache_size=64 << 20, index="keys", bloom_capacity=1 << 20,
+            fanout=(2, 2)):
         self.file_dir = file_dir
-        
+        self.fanout = tuple(fanout)
+        #Recently read or written values, so that popular values are served from memory
+        self.cache = ChunkCache(cache_size)
+        #Recently used keys, which are evicted last
+        self.recent = RecentKeys()
+        #Held while size is updated
+        self.lock = threading.Lock()
+        self.size = 0
+
         #Ensure that the save directory exists
         os.makedirs(self.file_dir, exist_ok=True)
 
+        #Values that were still being written when we last stopped
+        for name in os.listdir(self.file_dir):
+            if name.startswith(PARTIAL_PREFIX):
+                os.unlink(os.path.join(self.file_dir, name))
+
+        #key => path of the values that aren't where the current layout puts them
+        self.misplaced = {}
+        keys = []
+        for key, path in self.walk():
+            keys.append(key)
+            if path != self.path_for_key(key):
+                #A copy left behind next to one in the right place can just be ignored
+                if os.path.exists(self.path_for_key(key)):
+                    continue
+                self.misplaced[key] = path
+            self.size += file_size(path)
+        if len(self.misplaced) > 0:
+            log.info("%d values in %s need to be moved to the current layout",
+                len(self.misplaced), self.file_dir)
+
+        self.index = None
+        self.bloom = None
+        if index == "keys":
+            self.index = set(keys)
+        elif index == "bloom":
+            self.bloom_capacity = bloom_capacity
+            self.rebuild_bloom(keys)
+        elif index != "none":
+            raise ValueError("Unknown storage index {}".format(index))
+
         self.set(
             "2ea970ff63aec5d7a014ca6447ec743d3ba37450b85ebdcbb582b089b0194fa2",
             b"\xdf")
 
+    def __len__(self):
+        if self.index is not None:
+            return len(self.index)
+        return sum(1 for _ in self.iter_keys())
+
+    @property
+    def indexed(self):
+        '''
+        Whether has() is answered from memory, without going to the disk
+        '''
+        return self.index is not None
+
+    def close(self):
+        '''
+        Nothing to release, as each value's file is only open while it is used. There for the
+        same interface as packstore.PackStorage
+        '''
+
     def path_for_key(self, key):
-        return os.path.join(self.file_dir, key)
+        if len(key) <= sum(self.fanout):
+            return os.path.join(self.file_dir, key)
+
+        parts = []
+        start = 0
+        for width in self.fanout:
+            parts.append(key[start:start + width])
+            start += width
+        return os.path.join(self.file_dir, *parts, key)
+
+    def locate(self, key):
+        '''
+        The path the value for key is at, which is only different from path_for_key(key) if
+        it hasn't been migrated to the current layout yet
+        '''
+        return self.misplaced.get(key) or self.path_for_key(key)
+
+    def walk(self, path=None):
+        '''
+        Generates (key, path) for every value on disk, reading one directory at a time.
+        Files that aren't named like a hash, such as hash files and values still being
+        written, aren't values and are skipped
+        '''
+        with os.scandir(path or self.file_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(PARTIAL_PREFIX):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self.walk(entry.path)
+                elif is_id(entry.name):
+                    yield entry.name, entry.path
+
+    def iter_keys(self):
+        '''
+        Generates the keys of the values on disk without listing them all at once
+        '''
+        for key, _ in self.walk():
+            yield key
+
+    def list_keys(self):
+        '''
+        The keys of the values on disk, read from the directory
+        '''
+        return list(self.iter_keys())
+
+    def migrate(self, limit=None):
+        '''
+        Moves up to limit (or all) misplaced values to where the current layout puts them,
+        returning the number still left to move
+        '''
+        moved = 0
+        while len(self.misplaced) > 0 and (limit is None or moved < limit):
+            key, path = self.misplaced.popitem()
+            target = self.path_for_key(key)
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(path, target)
+            except OSError as e:
+                log.warning("Couldn't move %s to %s (%s)", path, target, e)
+                continue
+            moved += 1
+            self.remove_empty_dirs(path)
+
+        return len(self.misplaced)
+
+    def maintain(self, limit=None):
+        '''
+        Does up to limit steps of background upkeep, returning the number of steps left.
+        For this store that is migrating values to the current layout
+        '''
+        return self.migrate(limit)
+
+    def remove_empty_dirs(self, path):
+        '''
+        Removes the directories above path that the old layout leaves empty
+        '''
+        parent = os.path.dirname(path)
+        while os.path.abspath(parent) != os.path.abspath(self.file_dir):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    def rebuild_bloom(self, keys=None):
+        if keys is None:
+            keys = self.list_keys()
+        #Leave room to grow before the filter has to be rebuilt again
+        self.bloom_capacity = max(self.bloom_capacity, 2 * len(keys))
+        self.bloom = BloomFilter(self.bloom_capacity)
+        for key in keys:
+            self.bloom.add(key)
+
+    def added(self, key, size):
+        '''
+        Records that a value for key was written to disk, growing the store by size bytes
+        '''
+        with self.lock:
+            self.size += size
+        self.recent.touch(key)
+        self.cache.discard(key)
+        if self.index is not None:
+            self.index.add(key)
+        elif self.bloom is not None:
+            self.bloom.add(key)
+            if self.bloom.is_full():
+                log.info("Rebuilding the storage Bloom filter for %d keys", len(self.bloom))
+                self.bloom_capacity *= 2
+                self.rebuild_bloom()
 
     def keys(self):
-        return os.listdir(self.file_dir)
+        if self.index is not None:
+            return list(self.index)
+        return self.list_keys()
+
+    def prepare(self, key):
+        '''
+        Makes the directory for key, and forgets any misplaced copy that is about to be
+        replaced, returning the path to write the value to
+        '''
+        path = self.path_for_key(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        old = self.misplaced.pop(key, None)
+        if old is not None:
+            size = file_size(old)
+            try:
+                os.unlink(old)
+                with self.lock:
+                    self.size -= size
+            except OSError:
+                pass
+            self.remove_empty_dirs(old)
+        return path
 
     def has(self, key):
-        return os.path.exists(self.path_for_key(key))
+        if key in self.cache:
+            return True
+        if self.index is not None:
+            return key in self.index
+        if self.bloom is not None and key not in self.bloom:
+            return False
+        return os.path.exists(self.locate(key))
 
     def get(self, key):
+        value = self.cache.get(key)
+        if value is not None:
+            self.recent.touch(key)
+            return value
+
         try:
-            with open(self.path_for_key(key), "rb") as file:
-                return file.read()
+            with open(self.locate(key), "rb") as file:
+                value = file.read()
         except:
             return None
 
-    def set(self, key, value):
+        self.recent.touch(key)
+        self.cache.put(key, value)
+        return value
+
+    def cached(self, key):
+        '''
+        The value for key if it is in the cache, otherwise None
+        '''
+        value = self.cache.get(key)
+        if value is not None:
+            self.recent.touch(key)
+        return value
+
+    def open(self, key):
+        '''
+        Opens the stored value for key so it can be streamed instead of read into memory.
+        Returns (file, offset, length) where the value is the length bytes of the binary file
+        starting at offset, or None if we don't have the key
+        '''
         try:
-            with open(self.path_for_key(key), "wb") as file:
-                file.write(value)
-                return True
-        except:
-            return False
+            file = open(self.locate(key), "rb")
+        except OSError:
+            return None
+        self.recent.touch(key)
+        return file, 0, os.fstat(file.fileno()).st_size
+
+    def create(self, key):
+        '''
+        Starts writing a value for key piece by piece, returning a PartialValue which must be
+        committed (or discarded) once the value is complete
+        '''
+        return PartialValue(self, key)
+
+    def set(self, key, value):
+        return self.set_many([(key, value)])[0]
+
+    def set_many(self, items, sync=False):
+        '''
+        Stores each (key, value) of items, returning a list of whether each was stored.
+        With sync the values are on disk before any is added, with every file written before
+        any is synced and each directory synced once for the whole batch
+        '''
+        partials = []
+        for key, value in items:
+            partial = None
+            try:
+                partial = PartialValue(self, key)
+                partial.write(value)
+                partial.close(sync)
+            except Exception as e:
+                log.warning("Couldn't store %s (%s)", key, e)
+                if partial is not None:
+                    partial.discard()
+                partial = None
+            partials.append(partial)
+
+        results = []
+        dirs = set()
+        for (key, value), partial in zip(items, partials):
+            if partial is not None:
+                try:
+                    partial.commit()
+                    dirs.add(os.path.dirname(self.path_for_key(key)))
+                except OSError as e:
+                    log.warning("Couldn't store %s (%s)", key, e)
+                    partial.discard()
+                    partial = None
+
+            if partial is None:
+                self.cache.discard(key)
+                results.append(False)
+            else:
+                self.cache.put(key, value)
+                results.append(True)
+
+        if sync:
+            for path in dirs:
+                sync_dir(path)
+        return results
 
     def clear(self, key):
-        os.unlink(self.path_for_key(key))
+        '''
+        Removes the value for key, returning its size
+        '''
+        self.cache.discard(key)
+        self.recent.discard(key)
+        if self.index is not None:
+            self.index.discard(key)
+        old = self.misplaced.pop(key, None)
+        path = old or self.path_for_key(key)
+        size = file_size(path)
+        os.unlink(path)
+        with self.lock:
+            self.size -= size
+        if old is not None:
+            self.remove_empty_dirs(old)
+        return size
 
 if __name__ == "__main__":
     storage = Storage("dht_store/")
@@ -0,0 +1,58 @@
+import asyncio
+import unittest
+
+from admission import AdmissionControl, RequestClass
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.store = RequestClass("store", 1, 1)
+        self.admission = AdmissionControl({ "store_value": self.store }, RequestClass("default", 2, 2))
+        self.done = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def submit(self, key, request_type="find_node"):
+        fut = asyncio.Future(loop=self.loop)
+        admitted = self.admission.submit(key, request_type, lambda: fut,
+            lambda task: self.done.append(key))
+        return fut, admitted
+
+    def run_once(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_limits_and_queue(self):
+        running = [self.submit(i) for i in range(4)]
+        self.assertTrue(all(admitted for _, admitted in running))
+        self.assertEqual(self.admission.default.running, 2)
+        self.assertEqual(len(self.admission.default.queue), 2)
+        self.assertFalse(self.submit(4)[1])
+
+        #Finishing a request starts the next queued one
+        running[0][0].set_result(None)
+        self.run_once()
+        self.assertEqual(self.done, [0])
+        self.assertEqual(self.admission.default.running, 2)
+        self.assertEqual(len(self.admission.default.queue), 1)
+        self.assertTrue(self.submit(5)[1])
+
+    def test_classes_are_separate(self):
+        self.assertTrue(self.submit("a", "store_value")[1])
+        self.assertTrue(self.submit("b", "store_value")[1])
+        self.assertFalse(self.submit("c", "store_value")[1])
+        #Cheap requests still get in while stores are full
+        self.assertTrue(self.submit("d", "ping_node")[1])
+        self.assertTrue(self.submit("e", None)[1])
+
+    def test_duplicates_are_not_handled_twice(self):
+        self.submit("a")
+        self.submit("a")
+        self.assertEqual(len(self.admission), 1)
+        self.assertEqual(self.admission.default.running, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from bloom import BloomFilter
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        keys = ["key{}".format(i) for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        self.assertFalse(bloom.is_full())
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add("key{}".format(i))
+        false_positives = sum("other{}".format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_full(self):
+        bloom = BloomFilter(2)
+        for key in "abc":
+            bloom.add(key)
+        self.assertTrue(bloom.is_full())
+
+    def test_duplicates_are_counted_once(self):
+        bloom = BloomFilter(2)
+        self.assertTrue(bloom.add("a"))
+        for _ in range(10):
+            self.assertFalse(bloom.add("a"))
+        self.assertEqual(len(bloom), 1)
+        self.assertFalse(bloom.is_full())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import random
+import tempfile
+import unittest
+
+import chunking
+from chunking import GEAR, WINDOW, ContentChunker, FixedChunker, chunk_bounds, map_file
+
+
+def random_bytes(n, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for _ in range(n))
+
+def split(data, chunker):
+    return [data[offset:offset + size] for offset, size in chunk_bounds(data, chunker)]
+
+def reference_cuts(data, chunker):
+    '''
+    Cut points from the definition of the Gear hash, the sum of the gear value of each of the
+    last WINDOW bytes of the chunk shifted by its age, rather than from a rolling hash
+    '''
+    cuts = []
+    start = 0
+    while start < len(data):
+        end = min(len(data), start + chunker.max_size)
+        cut = end
+        for i in range(start + chunker.min_size, end):
+            h = sum(GEAR[data[i - age]] << age for age in range(WINDOW) if i - age >= start)
+            mask = chunker.small_mask if i - start < chunker.avg_size else chunker.large_mask
+            if h & mask == 0:
+                cut = i + 1
+                break
+        cuts.append(cut)
+        start = cut
+    return cuts
+
+def cuts(data, chunker):
+    return [offset + size for offset, size in chunk_bounds(data, chunker)]
+
+
+class FixedChunkerTest(unittest.TestCase):
+    def test_split(self):
+        chunks = split(b"x" * 25, FixedChunker(10))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+
+
+class ContentChunkerTest(unittest.TestCase):
+    def setUp(self):
+        self.chunker = ContentChunker(1 << 12)
+        self.data = random_bytes(1 << 17)
+
+    def test_sizes(self):
+        chunks = split(self.data, self.chunker)
+        self.assertEqual(b"".join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), self.chunker.min_size)
+            self.assertLessEqual(len(chunk), self.chunker.max_size)
+
+    def test_insert_only_changes_nearby_chunks(self):
+        before = split(self.data, self.chunker)
+        edited = self.data[:1000] + b"inserted" + self.data[1000:]
+        after = split(edited, self.chunker)
+        self.assertEqual(b"".join(after), edited)
+        self.assertGreaterEqual(len(set(before) & set(after)), len(before) - 2)
+
+    def test_known_cut_points(self):
+        #Worked out once and kept, so that every version and both implementations cut the
+        #same files at the same points
+        expected = [4169, 8384, 12501, 17815, 21648, 25861, 30439, 35475, 39689, 45892, 51498,
+            54580, 59029, 63760, 67018, 68371, 76768, 82744, 91424, 94123, 98449, 102630, 104418,
+            112363, 114696, 119593, 125129, 129869, 1 << 17]
+        self.assertEqual(cuts(self.data, self.chunker), expected)
+
+    def test_matches_reference(self):
+        data = self.data[:1 << 15]
+        self.assertEqual(cuts(data, self.chunker), reference_cuts(data, self.chunker))
+
+    def test_python_fallback(self):
+        expected = split(self.data, self.chunker)
+        have_numpy = chunking.HAVE_NUMPY
+        chunking.HAVE_NUMPY = False
+        try:
+            self.assertEqual(split(self.data, self.chunker), expected)
+        finally:
+            chunking.HAVE_NUMPY = have_numpy
+
+    def test_invalid_sizes(self):
+        with self.assertRaises(ValueError):
+            ContentChunker(3000)
+        with self.assertRaises(ValueError):
+            ContentChunker(1 << 12, min_size=1 << 13)
+
+
+class MapFileTest(unittest.TestCase):
+    def test_map_file(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, b"x" * 25)
+            os.close(fd)
+            data = map_file(path)
+            bounds = list(chunk_bounds(data, FixedChunker(10)))
+            self.assertEqual(bounds, [(0, 10), (10, 10), (20, 5)])
+            del data
+
+            open(path, "wb").close()
+            self.assertEqual(list(chunk_bounds(map_file(path), FixedChunker(10))), [])
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
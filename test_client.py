@@ -0,0 +1,339 @@
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import client
+from chunking import FixedChunker
+from client import DistributedClient
+from dht import DHT
+from hash_utils import hash_data
+
+CHUNK_SIZE = 10
+
+
+class StubDHT:
+    '''
+    Serves values from a dict. Fetches of the hashes in slow only finish when the test says
+    so, and every fetch is kept so that the test can see which were cancelled
+    '''
+    def __init__(self, loop, values):
+        self.loop = loop
+        self.values = values
+        self.slow = set()
+        self.fetches = {}
+        #hash => seconds its fetches take
+        self.delays = {}
+        self.finished = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def plan_lookups(self, hash_ids):
+        return { hash_id: None for hash_id in hash_ids }
+
+    @asyncio.coroutine
+    def get_value(self, hash_id, candidates=None):
+        fut = asyncio.Future(loop=self.loop)
+        self.fetches.setdefault(hash_id, []).append(fut)
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            if hash_id in self.delays:
+                yield from asyncio.sleep(self.delays[hash_id])
+            if hash_id not in self.slow:
+                fut.set_result(self.values.get(hash_id))
+            value = yield from fut
+        finally:
+            self.in_flight -= 1
+        self.finished.append(hash_id)
+        return value
+
+    @asyncio.coroutine
+    def store_value(self, hash_id, data):
+        self.values[hash_id] = data
+
+
+class ClientTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.data = bytes(range(100))
+        chunks = [self.data[i:i + CHUNK_SIZE] for i in range(0, len(self.data), CHUNK_SIZE)]
+        self.hashes = [(hash_data(chunk), len(chunk)) for chunk in chunks]
+        self.dht = StubDHT(self.loop, { hash_data(chunk): chunk for chunk in chunks })
+        self.client = DistributedClient(self.dht, self.loop, window=2)
+
+    def tearDown(self):
+        self.client.hash_pool.shutdown()
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def open(self, hash_data=None, **kwargs):
+        return self.wait(self.client.open_file(
+            self.hashes if hash_data is None else hash_data, **kwargs))
+
+
+class ReaderTest(ClientTestCase):
+    def test_reads_in_order(self):
+        reader = self.open()
+        self.assertEqual(self.wait(reader.read(15)), self.data[:15])
+        self.assertEqual(reader.tell(), 15)
+        self.assertEqual(self.wait(reader.read_chunk()), self.data[15:20])
+        self.assertEqual(self.wait(reader.read()), self.data[20:])
+        self.assertEqual(self.wait(reader.read()), b"")
+
+    def test_seek_and_tell(self):
+        reader = self.open()
+        self.assertTrue(reader.seekable())
+        self.assertEqual(reader.seek(42), 42)
+        self.assertEqual(self.wait(reader.read(3)), self.data[42:45])
+        self.assertEqual(reader.seek(-5, 1), 40)
+        self.assertEqual(self.wait(reader.read(2)), self.data[40:42])
+        self.assertEqual(reader.seek(-7, 2), 93)
+        self.assertEqual(self.wait(reader.read()), self.data[93:])
+        reader.seek(200)
+        self.assertEqual(self.wait(reader.read(5)), b"")
+        with self.assertRaises(ValueError):
+            reader.seek(-1)
+        with self.assertRaises(ValueError):
+            reader.seek(0, 3)
+
+    def test_read_range_across_chunks(self):
+        for offset, length in [(0, 10), (5, 10), (9, 2), (25, 50), (95, 20), (100, 5), (3, 0)]:
+            got = self.wait(self.client.read_range(self.hashes, offset, length))
+            self.assertEqual(got, self.data[offset:offset + length])
+
+    def test_read_range_fetches_only_overlapping_chunks(self):
+        self.wait(self.client.read_range(self.hashes, 25, 10))
+        fetched = set(self.dht.fetches)
+        self.assertEqual(fetched, { hash for hash, _ in self.hashes[2:4] })
+
+    def test_seek_cancels_prefetches(self):
+        reader = self.open(prefetch=2)
+        self.dht.slow = { hash for hash, _ in self.hashes[1:3] }
+        self.assertEqual(self.wait(reader.read(5)), self.data[:5])
+        prefetched = [self.dht.fetches[hash][0] for hash, _ in self.hashes[1:3]]
+        self.assertFalse(any(fut.done() for fut in prefetched))
+
+        reader.seek(70)
+        self.assertEqual(self.wait(reader.read(5)), self.data[70:75])
+        self.wait(asyncio.sleep(0))
+        self.assertTrue(all(fut.cancelled() for fut in prefetched))
+        self.assertEqual(sorted(reader.fetching), [80, 90])
+        reader.close()
+
+    def test_short_chunk_raises(self):
+        hash, size = self.hashes[1]
+        self.dht.values[hash] = self.dht.values[hash][:5]
+        reader = self.open()
+        self.assertEqual(self.wait(reader.read(10)), self.data[:10])
+        with self.assertRaises(ValueError):
+            self.wait(reader.read(20))
+        reader.seek(12)
+        with self.assertRaises(ValueError):
+            self.wait(reader.read_chunk())
+        with self.assertRaises(ValueError):
+            self.wait(self.client.read_range(self.hashes, 0, 100))
+
+    def test_manifest_root(self):
+        root = self.wait(self.client.store_manifest(self.hashes))
+        reader = self.open(root)
+        self.assertEqual(reader.size, len(self.data))
+        self.assertEqual(self.wait(reader.read()), self.data)
+        self.assertEqual(self.wait(self.client.read_range(root, 33, 40)), self.data[33:73])
+
+
+class RetrieveTest(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "file")
+
+    def tearDown(self):
+        super().tearDown()
+        shutil.rmtree(self.dir)
+
+    def retrieve(self):
+        self.wait(self.client.retrieve_file_async(self.hashes, self.path))
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_out_of_order_completion(self):
+        #Later chunks arrive first
+        for i, (hash, _) in enumerate(self.hashes):
+            self.dht.delays[hash] = (len(self.hashes) - i) / 1000
+        self.client.window = 4
+
+        threads = []
+        write_at = client.write_at
+        def record(*args):
+            threads.append(threading.get_ident())
+            return write_at(*args)
+        client.write_at = record
+        try:
+            self.assertEqual(self.retrieve(), self.data)
+        finally:
+            client.write_at = write_at
+
+        self.assertNotEqual(self.dht.finished, [hash for hash, _ in self.hashes])
+        #The chunks are written on the executor rather than the event loop's thread
+        self.assertEqual(len(threads), len(self.hashes))
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_window_limit(self):
+        for hash, _ in self.hashes:
+            self.dht.delays[hash] = 0.001
+        self.assertEqual(self.retrieve(), self.data)
+        self.assertEqual(self.dht.most_in_flight, self.client.window)
+
+    def test_failed_chunks(self):
+        hash, _ = self.hashes[3]
+        del self.dht.values[hash]
+        with self.assertRaises(Exception):
+            self.retrieve()
+        self.assertEqual(len(self.dht.finished), len(self.hashes))
+
+
+class StubDisk:
+    def __init__(self):
+        self.values = {}
+
+    @asyncio.coroutine
+    def set(self, hash_id, value):
+        self.values[hash_id] = value
+
+
+class StoringDHT:
+    '''
+    What storing a file goes through. Lookups answer after a random delay, so chunks go
+    through the pipeline out of order. Store requests are answered straight away, unless
+    hold is set, in which case they wait for release
+    '''
+    replicate = DHT.replicate
+
+    def __init__(self, loop, nodes):
+        self.loop = loop
+        self.disk = StubDisk()
+        self.nodes = nodes
+        self.max_timeout = 10.
+        self.rng = random.Random(0)
+        self.failing = None
+        self.requests = []
+        self.hold = False
+        self.held = []
+
+    @asyncio.coroutine
+    def find_node(self, hash_id):
+        yield from asyncio.sleep(self.rng.random() / 1000)
+        if hash_id == self.failing:
+            raise ValueError("Lookup failed")
+        return self.nodes
+
+    def make_request(self, request, node, timeout=None, retries=None):
+        self.requests.append((request["params"]["id"], node))
+        fut = asyncio.Future(loop=self.loop)
+        if self.hold:
+            self.held.append(fut)
+        else:
+            fut.set_result(True)
+        return fut
+
+    def release(self):
+        self.hold = False
+        for fut in self.held:
+            fut.set_result(True)
+
+    @asyncio.coroutine
+    def store_value(self, hash_id, data):
+        yield from self.disk.set(hash_id, data)
+
+
+class StoreFileTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        self.data = os.urandom(100 * CHUNK_SIZE)
+        self.chunks = [self.data[i:i + CHUNK_SIZE] for i in range(0, len(self.data), CHUNK_SIZE)]
+        self.file = os.path.join(self.dir, "file")
+        with open(self.file, "wb") as f:
+            f.write(self.data)
+        self.dht = StoringDHT(self.loop, ["a", "b"])
+        self.client = DistributedClient(self.dht, self.loop, window=2,
+            chunker=FixedChunker(CHUNK_SIZE), hash_threads=2)
+
+    def tearDown(self):
+        self.client.hash_pool.shutdown()
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+    def store(self):
+        return asyncio.wait_for(self.client.store_file_async(
+            self.file, os.path.join(self.dir, "hashes")), timeout=5)
+
+    def assertNoTasksLeft(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(asyncio.all_tasks(self.loop), set())
+
+    def test_hashes_in_file_order(self):
+        hashfile = self.loop.run_until_complete(self.store())
+        hashes = [(hash_data(chunk), len(chunk)) for chunk in self.chunks]
+        self.assertEqual(self.client.hashes_from_file(hashfile), hashes)
+        self.assertEqual(sorted(self.dht.requests),
+            sorted((hash, node) for hash, _ in hashes for node in "ab"))
+        self.assertNoTasksLeft()
+
+    def test_default_hashfile_in_working_directory(self):
+        cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.addCleanup(os.chdir, cwd)
+        hashfile = self.loop.run_until_complete(self.client.store_file_async(self.file))
+
+        root = [key for key in self.dht.disk.values if key not in
+            set(hash_data(chunk) for chunk in self.chunks)][0]
+        self.assertEqual(hashfile, os.path.join(os.path.realpath(self.dir),
+            "file-{}.hashes".format(root[:16])))
+        self.assertEqual(len(self.client.hashes_from_file(hashfile)), len(self.chunks))
+
+    def test_backpressure(self):
+        self.dht.hold = True
+        store = asyncio.ensure_future(self.store(), loop=self.loop)
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        #Each stage holds at most window chunks, and has a queue of at most window in front of
+        #it, and the reader waits with one more
+        window = self.client.window
+        self.assertLessEqual(len(self.dht.disk.values), 4 * window + 1)
+        self.assertEqual(len(set(hash for hash, _ in self.dht.requests)), window)
+
+        self.dht.release()
+        self.loop.run_until_complete(store)
+        self.assertEqual(len(self.dht.requests), 2 * len(self.chunks))
+
+    def test_failed_stage_stops_pipeline(self):
+        self.dht.failing = hash_data(self.chunks[10])
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(self.store())
+        self.assertNoTasksLeft()
+
+    def test_no_nodes(self):
+        self.dht.nodes = []
+        self.loop.run_until_complete(self.store())
+        self.assertEqual(self.dht.requests, [])
+        self.assertEqual(len(self.dht.disk.values), len(self.chunks) + 1)
+        self.assertNoTasksLeft()
+
+    def test_replicate_gives_up_on_silent_nodes(self):
+        self.dht.hold = True
+        self.dht.max_timeout = 0.01
+        self.loop.run_until_complete(self.dht.replicate(hash_data(b"value"), ["a", "b"]))
+        self.assertTrue(all(fut.cancelled() for fut in self.dht.held))
+
+
+if __name__ == "__main__":
+    unittest.main()
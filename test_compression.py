@@ -0,0 +1,143 @@
+import unittest
+
+import compression
+from compression import (CODECS, DECOMPRESS_STEP, FRAME, MARKER, MAX_VALUE_SIZE, NONE, ZLIB,
+    IncomingValue, codec_of, decode, encode, sendable, transcode)
+
+TEXT = b"".join(b'{"line": %d, "level": "info"}\n' % i for i in range(2000))
+
+
+def receive(stored, encoded, piece=7):
+    '''
+    Feeds stored to an IncomingValue a piece at a time, returning what it gives to store and
+    to hash
+    '''
+    incoming = IncomingValue(len(stored), encoded)
+    kept, values = [], []
+    for start in range(0, len(stored), piece):
+        data, value = incoming.feed(stored[start:start + piece])
+        kept.append(data)
+        values.append(value)
+    data, value = incoming.finish()
+    return b"".join(kept) + data, b"".join(values) + value
+
+
+class EncodeTest(unittest.TestCase):
+    def test_round_trip(self):
+        for name in compression.names():
+            codec = compression.BY_NAME[name]
+            stored = encode(memoryview(TEXT), codec)
+            self.assertEqual(codec_of(stored), codec)
+            self.assertLess(len(stored), len(TEXT) // 5)
+            self.assertEqual(decode(stored), TEXT)
+
+    def test_incompressible_is_stored_as_is(self):
+        data = bytes(range(256))
+        self.assertEqual(encode(data, ZLIB), data)
+        self.assertIsNone(codec_of(data))
+
+    def test_marker_is_escaped(self):
+        data = MARKER + b"not a frame"
+        stored = encode(data)
+        self.assertEqual(codec_of(stored), NONE)
+        self.assertEqual(decode(stored), data)
+
+    def test_malformed(self):
+        with self.assertRaises(ValueError):
+            codec_of(MARKER + b"\x01")
+        with self.assertRaises(ValueError):
+            codec_of(FRAME.pack(MARKER, 200, 0))
+        with self.assertRaises(ValueError):
+            decode(FRAME.pack(MARKER, NONE, 5) + b"abc")
+
+
+class TranscodeTest(unittest.TestCase):
+    def test_sendable(self):
+        self.assertTrue(sendable(None, None))
+        self.assertFalse(sendable(ZLIB, None))
+        self.assertFalse(sendable(NONE, None))
+        self.assertTrue(sendable(ZLIB, { ZLIB }))
+        self.assertTrue(sendable(NONE, set()))
+        self.assertFalse(sendable(ZLIB, set()))
+
+    def test_transcode(self):
+        stored = encode(TEXT, ZLIB)
+        self.assertIs(transcode(stored, { ZLIB }), stored)
+        self.assertEqual(transcode(stored, None), TEXT)
+        self.assertEqual(transcode(stored, set()), TEXT)
+        escaped = encode(MARKER)
+        self.assertEqual(transcode(escaped, None), MARKER)
+        self.assertEqual(transcode(escaped, set()), escaped)
+
+
+class IncomingValueTest(unittest.TestCase):
+    def test_compressed(self):
+        stored = encode(TEXT, ZLIB)
+        self.assertEqual(receive(stored, True, piece=100), (stored, TEXT))
+
+    def test_uncompressed(self):
+        for data in [b"", b"ab", TEXT]:
+            self.assertEqual(receive(data, True), (data, data))
+            self.assertEqual(receive(data, False), (data, data))
+
+    def test_plain_marker_is_escaped(self):
+        data = MARKER + b"\x01 plain"
+        stored, value = receive(data, False)
+        self.assertEqual(value, data)
+        self.assertEqual(decode(stored), data)
+
+    def test_wrong_size(self):
+        packed = encode(TEXT, ZLIB)[FRAME.size:]
+        for size in [len(TEXT) - 1, len(TEXT) + 1]:
+            with self.assertRaises(ValueError):
+                receive(FRAME.pack(MARKER, ZLIB, size) + packed, True)
+
+
+class DecompressionBombTest(unittest.TestCase):
+    '''
+    Frames whose data inflates to far more than their size says
+    '''
+    def setUp(self):
+        self.zeros = bytes(16 << 20)
+
+    def bombs(self):
+        for name in compression.names():
+            codec = compression.BY_NAME[name]
+            yield name, FRAME.pack(MARKER, codec, 100) + CODECS[codec].compress(self.zeros)
+
+    def test_decode_stops_at_size(self):
+        for name, bomb in self.bombs():
+            with self.subTest(codec=name), self.assertRaises(ValueError):
+                decode(bomb)
+
+    def test_incoming_stops_at_size(self):
+        for name, bomb in self.bombs():
+            with self.subTest(codec=name), self.assertRaises(ValueError):
+                receive(bomb, True, piece=1 << 16)
+
+    def test_output_is_stepped(self):
+        for name in compression.names():
+            codec = compression.BY_NAME[name]
+            decompressor = CODECS[codec].decompressor()
+            pieces = []
+            write = decompressor.write
+            decompressor.write = lambda piece: pieces.append(len(piece)) or write(piece)
+            value = decompressor.decompress(CODECS[codec].compress(self.zeros), len(self.zeros))
+            with self.subTest(codec=name):
+                self.assertEqual(value, self.zeros)
+                self.assertLessEqual(max(pieces), DECOMPRESS_STEP)
+
+    def test_oversized_frame_is_rejected(self):
+        packed = encode(TEXT, ZLIB)[FRAME.size:]
+        frame = FRAME.pack(MARKER, ZLIB, MAX_VALUE_SIZE + 1) + packed
+        with self.assertRaises(ValueError):
+            decode(frame)
+        with self.assertRaises(ValueError):
+            receive(frame, True)
+        #Values too large to decompress again are stored as they are
+        large = bytes(MAX_VALUE_SIZE + 1)
+        self.assertIs(codec_of(encode(large, ZLIB)), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import asyncio
+import unittest
+
+from connections import (HELLO, LEGACY_SIZE, MISSING, REQUEST, RESPONSE, ConnectionPool,
+    LegacyConnection, PeerConnection)
+
+
+class StubWriter:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+
+
+class StubPool:
+    def __init__(self, loop):
+        self.loop = loop
+        self.idled = 0
+        self.removed = []
+
+    def idle(self, conn):
+        self.idled += 1
+
+    def remove(self, conn):
+        self.removed.append(conn)
+
+
+@asyncio.coroutine
+def receive(reader, size):
+    if size == MISSING:
+        return None
+    return (yield from reader.readexactly(size))
+
+
+class PeerConnectionTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.pool = StubPool(self.loop)
+        self.reader = asyncio.StreamReader(loop=self.loop)
+        self.writer = StubWriter()
+        self.conn = PeerConnection(self.pool, ("127.0.0.1", 1), self.reader, self.writer)
+
+    def tearDown(self):
+        self.conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    def respond(self, request_id, value):
+        size = MISSING if value is None else len(value)
+        self.reader.feed_data(RESPONSE.pack(request_id, size) + (value or b""))
+
+    def wait(self, *futs):
+        return self.loop.run_until_complete(asyncio.gather(*futs, return_exceptions=True))
+
+    def test_requests_are_framed(self):
+        futs = [self.conn.request("ab", receive), self.conn.request("c", receive)]
+        self.assertEqual(bytes(self.writer.data),
+            REQUEST.pack(0, 2) + b"ab" + REQUEST.pack(1, 1) + b"c")
+        self.conn.close()
+        self.assertTrue(all(isinstance(e, ConnectionError) for e in self.wait(*futs)))
+
+    def test_out_of_order_responses(self):
+        first = self.conn.request("a", receive)
+        second = self.conn.request("b", receive)
+        self.respond(1, b"second")
+        self.respond(0, b"first")
+        self.assertEqual(self.wait(first, second), [b"first", b"second"])
+        self.assertEqual(len(self.conn), 0)
+        self.assertEqual(self.pool.idled, 1)
+        self.assertFalse(self.conn.closed)
+
+    def test_not_found(self):
+        fut = self.conn.request("a", receive)
+        self.respond(0, None)
+        self.assertEqual(self.wait(fut), [None])
+        self.assertFalse(self.conn.closed)
+
+    def test_drop_fails_every_request(self):
+        futs = [self.conn.request(key, receive) for key in "abc"]
+        self.respond(0, b"value")
+        self.reader.feed_data(RESPONSE.pack(1, 10) + b"part")
+        self.reader.feed_eof()
+
+        results = self.wait(*futs)
+        self.assertEqual(results[0], b"value")
+        self.assertIsInstance(results[1], asyncio.IncompleteReadError)
+        self.assertIsInstance(results[2], asyncio.IncompleteReadError)
+        self.assertTrue(self.conn.closed)
+        self.assertEqual(self.pool.removed, [self.conn])
+        self.assertIsInstance(self.wait(self.conn.request("d", receive))[0], ConnectionError)
+
+    def test_unknown_response_closes(self):
+        fut = self.conn.request("a", receive)
+        self.respond(7, b"value")
+        self.assertIsInstance(self.wait(fut)[0], ValueError)
+        self.assertTrue(self.conn.closed)
+
+    def test_stalled_response_times_out(self):
+        fut = self.conn.request("a", receive, timeout=0.01)
+        self.assertIsInstance(self.wait(fut)[0], asyncio.TimeoutError)
+        self.assertTrue(self.conn.closed)
+
+
+class LegacyFallbackTest(unittest.TestCase):
+    '''
+    A server from before pooled connections, which takes one key per connection and closes
+    the connection on keys it doesn't have
+    '''
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.values = { "key": b"value" }
+        self.requests = []
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.serve, "127.0.0.1", 0))
+        self.addr = self.server.sockets[0].getsockname()[:2]
+        self.pool = ConnectionPool(self.loop, codecs=["zlib"])
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.close()
+
+    @asyncio.coroutine
+    def serve(self, reader, writer):
+        key = (yield from reader.readline())[:-1].decode()
+        self.requests.append(key)
+        value = self.values.get(key)
+        if value is not None:
+            writer.write(LEGACY_SIZE.pack(len(value), b"\n") + value)
+        writer.close()
+
+    def fetch(self, key):
+        @asyncio.coroutine
+        def fetch():
+            conn = yield from self.pool.get(self.addr, 1.)
+            return conn, (yield from conn.request(key, receive, 1.))
+        return self.loop.run_until_complete(fetch())
+
+    def test_falls_back_to_one_request_per_connection(self):
+        conn, value = self.fetch("key")
+        self.assertIsInstance(conn, LegacyConnection)
+        self.assertEqual(value, b"value")
+        self.assertEqual(self.requests, ["MUX2 zlib", HELLO[:-1].decode(), "key"])
+        self.assertIn(self.addr, self.pool.legacy_peers)
+        self.assertEqual(len(self.pool), 0)
+
+        #Known legacy peers go straight to the old protocol
+        conn, value = self.fetch("missing")
+        self.assertIsNone(value)
+        self.assertEqual(self.requests[3:], ["missing"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import shutil
+import tempfile
+import unittest
+
+from eviction import RecentKeys, evict, eviction_order, is_id
+from storage import Storage
+
+
+def key(n):
+    return "{:064x}".format(n)
+
+
+class RecentKeysTest(unittest.TestCase):
+    def test_recency(self):
+        recent = RecentKeys(max_size=3)
+        for k in "abcd":
+            recent.touch(k)
+        recent.touch("b")
+        self.assertEqual(recent.recency(), { "c": 1 / 3, "d": 2 / 3, "b": 1 })
+        recent.discard("d")
+        self.assertNotIn("d", recent.recency())
+
+
+class EvictionOrderTest(unittest.TestCase):
+    def test_unowned_keys_go_first(self):
+        keys = [key(1), key(2), key(1 << 255)]
+        order = eviction_order(0, keys, { key(1 << 255) }, {})
+        self.assertEqual(order[-1], key(1 << 255))
+
+    def test_far_keys_go_first(self):
+        keys = [key(1), key(1 << 255), key(1 << 200)]
+        order = eviction_order(0, keys, set(), {})
+        self.assertEqual(order, [key(1 << 255), key(1 << 200), key(1)])
+
+    def test_recent_keys_go_last(self):
+        keys = [key(1), key(1 << 255)]
+        order = eviction_order(0, keys, set(), { key(1 << 255): 1 })
+        self.assertEqual(order, [key(1), key(1 << 255)])
+
+    def test_is_id(self):
+        self.assertTrue(is_id(key(5)))
+        self.assertFalse(is_id("testing"))
+        self.assertFalse(is_id("z" * 64))
+
+
+class EvictTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = Storage(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_evicts_until_enough_is_freed(self):
+        start = self.storage.size
+        for n in range(4):
+            self.storage.set(key(n), b"x" * 10)
+        self.assertEqual(self.storage.size, start + 40)
+
+        cleared, freed = evict(self.storage, [key(3), "missing", key(2), key(1)], 15)
+        self.assertEqual((cleared, freed), (2, 20))
+        self.assertFalse(self.storage.has(key(3)))
+        self.assertTrue(self.storage.has(key(1)))
+        self.assertEqual(self.storage.size, start + 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import unittest
+
+from inflight import InFlightRequests
+
+
+class FakeHandle:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeLoop:
+    '''
+    Just enough of an event loop for futures and timers, with a clock that only moves when
+    advance is called
+    '''
+    def __init__(self):
+        self.now = 0.
+        self.timers = []
+        self.ready = []
+
+    def time(self):
+        return self.now
+
+    def get_debug(self):
+        return False
+
+    def call_soon(self, callback, *args, context=None):
+        self.ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        handle = FakeHandle(self.now + delay, callback, args)
+        heapq.heappush(self.timers, handle)
+        return handle
+
+    def run_ready(self):
+        while self.ready:
+            callback, args = self.ready.pop(0)
+            callback(*args)
+
+    def advance(self, seconds):
+        end = self.now + seconds
+        while self.timers and self.timers[0].when <= end:
+            handle = heapq.heappop(self.timers)
+            if handle.cancelled:
+                continue
+            self.now = handle.when
+            handle.callback(*handle.args)
+            self.run_ready()
+        self.now = end
+        self.run_ready()
+
+
+class InFlightRequestsTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = FakeLoop()
+        self.sent = []
+        self.timeouts = []
+        self.requests = InFlightRequests(self.loop,
+            lambda request, node: self.sent.append((self.loop.time(), request, node)),
+            retries=2, on_timeout=self.timeouts.append)
+
+    def test_retransmits_with_backoff_then_fails(self):
+        fut = self.requests.add(1, { "type": "ping_node" }, "node", 1.)
+        self.loop.advance(0.5)
+        self.assertEqual(len(self.sent), 1)
+
+        self.loop.advance(10)
+        #Sent at 0, then retransmitted after 1 and 2 more seconds, failing 4 seconds later
+        self.assertEqual([when for when, _, _ in self.sent], [0., 1., 3.])
+        self.assertEqual(len(self.timeouts), 3)
+        self.assertIsInstance(fut.exception(), asyncio.TimeoutError)
+        self.assertNotIn(1, self.requests)
+
+    def test_untimed_requests_skip_on_timeout(self):
+        fut = self.requests.add(1, {}, "node", 1., retries=1, timed=False)
+        self.loop.advance(10)
+        self.assertEqual(len(self.sent), 2)
+        self.assertEqual(self.timeouts, [])
+        self.assertTrue(fut.done())
+
+    def test_no_retries(self):
+        fut = self.requests.add(1, {}, "node", 1., retries=0)
+        self.loop.advance(1)
+        self.assertEqual(len(self.sent), 1)
+        self.assertTrue(fut.done())
+
+    def test_pop_answers_request(self):
+        fut = self.requests.add(1, {}, "node", 1.)
+        self.loop.advance(1.5)
+        entry = self.requests.pop(1)
+        self.assertEqual((entry.attempts, entry.node), (2, "node"))
+
+        #The response stops any more retransmissions
+        self.loop.advance(10)
+        self.assertEqual(len(self.sent), 2)
+        self.assertFalse(fut.done())
+        self.assertIsNone(self.requests.pop(1))
+
+    def test_pop_after_timeout(self):
+        fut = self.requests.add(1, {}, "node", 1., retries=0)
+        self.loop.advance(2)
+        self.assertTrue(fut.done())
+        self.assertIsNone(self.requests.pop(1))
+
+    def test_cancelled_request_is_discarded(self):
+        fut = self.requests.add(1, {}, "node", 1.)
+        fut.cancel()
+        self.loop.run_ready()
+        self.assertNotIn(1, self.requests)
+        self.loop.advance(10)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_max_size(self):
+        requests = InFlightRequests(self.loop, lambda request, node: None, max_size=1)
+        requests.add(1, {}, "node", 1.)
+        self.assertIsNotNone(requests.add(2, {}, "node", 1.).exception())
+        self.assertNotIn(2, requests)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import hashlib
+import heapq
+import random
+import unittest
+
+from lookup import Lookup
+from routing import Node, Routing
+
+def make_node(n):
+    return Node({ "node_id": "{:064x}".format(n), "ip": "127.0.0.1", "port": 50000 })
+
+def nearest(nodes, target, k):
+    return heapq.nsmallest(k, nodes, key=lambda n: n.id ^ int(target, 16))
+
+
+class StubDHT:
+    '''
+    Answers find_node requests from a map of node => the nodes it answers with, or its
+    routing table, after a random delay. Nodes in hang never answer
+    '''
+    def __init__(self, loop, own, known, hang=()):
+        self.loop = loop
+        self.node = own
+        self.routing = Routing(own, [])
+        self.known = known
+        self.hang = set(hang)
+        self.queried = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.rng = random.Random(0)
+
+    def make_request(self, request, node, timeout=None, retries=None):
+        fut = asyncio.Future(loop=self.loop)
+        self.queried.append(node)
+        if node in self.hang:
+            return fut
+
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        def respond():
+            self.in_flight -= 1
+            if not fut.done():
+                fut.set_result(self.answer(node, request["params"]["id"]))
+        self.loop.call_later(self.rng.random() / 1000, respond)
+        return fut
+
+    def answer(self, node, target):
+        known = self.known.get(node, [])
+        if isinstance(known, Routing):
+            return known.nearest_nodes(target)
+        return known
+
+    def update_routing(self, node):
+        pass
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.own = make_node(0)
+        self.target = "{:064x}".format(1 << 200)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_lookup(self, dht, initial, k, alpha):
+        lookup = Lookup(dht, self.target, "find_node", k=k, alpha=alpha, initial=initial)
+        return self.loop.run_until_complete(lookup.run()), lookup
+
+    def test_finds_k_closest_with_alpha_in_flight(self):
+        nodes = [make_node(int(hashlib.sha256(str(i).encode()).hexdigest(), 16) >> (i % 64))
+            for i in range(300)]
+        #Every node knows a few nodes at each distance from itself, so the lookup has to walk
+        known = { node: Routing(node, nodes, bucket_size=2) for node in nodes }
+        dht = StubDHT(self.loop, self.own, known)
+
+        result, lookup = self.run_lookup(dht, nodes[:7], k=7, alpha=3)
+        self.assertEqual(result, nearest(nodes, self.target, 7))
+        self.assertLessEqual(dht.most_in_flight, 3)
+        self.assertEqual(len(dht.queried), len(set(dht.queried)))
+
+    def test_stops_once_k_closest_responded(self):
+        far, slow = make_node(1 << 255), make_node((1 << 255) | 1)
+        close = [make_node((1 << 200) | i) for i in range(1, 3)]
+        #slow never answers, but the nodes far points to are closer than it
+        dht = StubDHT(self.loop, self.own, { far: close }, hang=[slow])
+
+        result, lookup = self.run_lookup(dht, [far, slow], k=2, alpha=3)
+        self.assertEqual(result, close)
+        self.assertEqual(set(dht.queried), { far, slow } | set(close))
+        self.assertNotIn(slow.node_id, lookup.responded)
+
+    def test_failed_nodes_are_skipped(self):
+        nodes = [make_node((1 << 200) | i) for i in range(1, 5)]
+        dht = StubDHT(self.loop, self.own, {}, hang=nodes[:1])
+        dht.make_request = self.failing(dht.make_request, nodes[0])
+
+        result, lookup = self.run_lookup(dht, nodes, k=2, alpha=2)
+        self.assertEqual(result, nodes[1:3])
+        self.assertIn(nodes[0].node_id, lookup.failed)
+
+    def failing(self, make_request, node):
+        def request(request, to, timeout=None, retries=None):
+            fut = make_request(request, to, timeout, retries)
+            if to == node:
+                fut.set_exception(asyncio.TimeoutError())
+            return fut
+        return request
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+
+from hash_utils import hash_data
+from manifest import (INDEX, LEAF, build_manifest, pack_page, pack_varint, unpack_page,
+    unpack_varint, verify_page)
+
+
+def chunks(n, size=100):
+    return [(hash_data(str(i).encode()), size + i) for i in range(n)]
+
+
+class VarintTest(unittest.TestCase):
+    def test_round_trip(self):
+        for n in [0, 1, 127, 128, 300, 1 << 20, (1 << 63) - 1]:
+            data = b"x" + pack_varint(n)
+            self.assertEqual(unpack_varint(data, 1), (n, len(data)))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            pack_varint(-1)
+        with self.assertRaises(ValueError):
+            unpack_varint(b"\x80", 0)
+
+
+class PageTest(unittest.TestCase):
+    def test_round_trip(self):
+        entries = chunks(5)
+        page = unpack_page(pack_page(LEAF, entries))
+        self.assertEqual(page.kind, LEAF)
+        self.assertEqual(page.entries(), entries)
+        self.assertEqual(page.size, sum(size for _, size in entries))
+        self.assertEqual(page.locate(0), 0)
+        self.assertEqual(page.locate(100), 1)
+        self.assertEqual(page.locate(page.size - 1), 4)
+
+    def test_malformed(self):
+        data = pack_page(LEAF, chunks(2))
+        for bad in [b"", b"XX" + data[2:], data[:-1], data + b"\x00"]:
+            with self.assertRaises(ValueError):
+                unpack_page(bad)
+
+    def test_verify(self):
+        data = pack_page(LEAF, chunks(2))
+        hash = hash_data(data)
+        self.assertEqual(verify_page(hash, data, 201).size, 201)
+        with self.assertRaises(ValueError):
+            verify_page(hash_data(b"other"), data)
+        with self.assertRaises(ValueError):
+            verify_page(hash, data, 200)
+
+
+class BuildManifestTest(unittest.TestCase):
+    def test_single_page(self):
+        root, pages = build_manifest(chunks(3))
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(pages[0][0], root)
+        self.assertEqual(verify_page(root, pages[0][1]).entries(), chunks(3))
+
+    def test_levels(self):
+        hashes = chunks(10)
+        root, pages = build_manifest(hashes, page_entries=3)
+        stored = dict(pages)
+        self.assertEqual(pages[-1][0], root)
+
+        #Walk the tree back to the chunk list, checking each page as a reader would
+        def walk(hash, size):
+            page = verify_page(hash, stored[hash], size)
+            if page.kind == LEAF:
+                return page.entries()
+            return [entry for child in page.entries() for entry in walk(*child)]
+        self.assertEqual(unpack_page(stored[root]).kind, INDEX)
+        self.assertEqual(walk(root, None), hashes)
+
+    def test_empty_file(self):
+        root, pages = build_manifest([])
+        self.assertEqual(len(pages), 1)
+        page = verify_page(root, pages[0][1])
+        self.assertEqual((page.kind, len(page), page.size), (LEAF, 0, 0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from hash_utils import hash_data
+from networking import Networking
+from storage import Storage
+
+
+class StubDisk:
+    '''
+    Runs storage calls straight away rather than on a thread pool
+    '''
+    def __init__(self, storage):
+        self.storage = storage
+
+    def queued(self, key):
+        return None
+
+    @asyncio.coroutine
+    def open(self, key):
+        return self.storage.open(key)
+
+    @asyncio.coroutine
+    def run(self, func, *args):
+        return func(*args)
+
+    @asyncio.coroutine
+    def commit(self, partial):
+        partial.commit()
+
+
+class StubWriter:
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    @asyncio.coroutine
+    def drain(self):
+        pass
+
+
+def make_networking(storage):
+    networking = Networking.__new__(Networking)
+    #A loop without sendfile, so values are streamed through the stub writer
+    networking.dht = types.SimpleNamespace(loop=object())
+    networking.storage = storage
+    networking.disk = StubDisk(storage)
+    return networking
+
+
+class NetworkingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.mkdtemp()
+        #Without a cache, values are sent from their files
+        self.storage = Storage(os.path.join(self.dir, "store"), cache_size=0)
+        self.networking = make_networking(self.storage)
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.dir)
+
+
+class SendValueTest(NetworkingTestCase):
+    def send(self, key):
+        writer = StubWriter()
+        found = self.loop.run_until_complete(
+            self.networking.send_value(writer, key, lambda size: b""))
+        return found, bytes(writer.data)
+
+    def test_sends_stored_value(self):
+        key = hash_data(b"value")
+        self.storage.set(key, b"value")
+        self.assertEqual(self.send(key), (True, b"value"))
+
+    def test_rejects_keys_that_are_not_hashes(self):
+        with open(os.path.join(self.dir, "secret"), "wb") as f:
+            f.write(b"secret")
+        for key in ["../secret", os.path.join(self.dir, "secret"), "testing"]:
+            self.assertEqual(self.send(key), (False, b""))
+
+
+class ReceiveValueTest(NetworkingTestCase):
+    def receive(self, key, data, size, timeout=1.):
+        reader = asyncio.StreamReader(loop=self.loop)
+        reader.feed_data(data)
+        return self.loop.run_until_complete(
+            self.networking.receive_value(key, reader, size, timeout=timeout))
+
+    def test_receives_value(self):
+        key = hash_data(b"value")
+        self.assertTrue(self.receive(key, b"value", 5))
+        self.assertEqual(self.storage.get(key), b"value")
+
+    def test_rejects_wrong_value(self):
+        key = hash_data(b"value")
+        self.assertFalse(self.receive(key, b"other", 5))
+        self.assertFalse(self.storage.has(key))
+
+    def test_stalled_transfer_times_out(self):
+        key = hash_data(b"value")
+        with self.assertRaises(asyncio.TimeoutError):
+            self.receive(key, b"val", 5, timeout=0.01)
+        self.assertFalse(self.storage.has(key))
+
+
+class StubConnection:
+    encoded = False
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.timeouts = []
+
+    def request(self, key, receive, timeout=None):
+        self.timeouts.append(timeout)
+        fut = asyncio.Future(loop=self.loop)
+        fut.set_result(True)
+        return fut
+
+
+class StubPool:
+    def __init__(self, conn):
+        self.conn = conn
+        self.timeouts = []
+
+    @asyncio.coroutine
+    def get(self, addr, timeout):
+        self.timeouts.append(timeout)
+        return self.conn
+
+
+class RequestKeyTest(NetworkingTestCase):
+    def test_uses_transfer_timeout(self):
+        #Round trip estimates only bound UDP requests
+        self.networking.dht = types.SimpleNamespace(loop=self.loop, transfer_timeout=5.,
+            rtt=types.SimpleNamespace(timeout=lambda node: 0.2))
+        conn = StubConnection(self.loop)
+        self.networking.pool = StubPool(conn)
+        node = types.SimpleNamespace(ip="127.0.0.1", port=1)
+
+        stored = self.loop.run_until_complete(
+            self.networking.request_key(hash_data(b"value"), node))
+        self.assertTrue(stored)
+        self.assertEqual(self.networking.pool.timeouts, [5.])
+        self.assertEqual(conn.timeouts, [5.])
+
+
+if __name__ == "__main__":
+    unittest.main()
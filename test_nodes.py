@@ -30,13 +30,13 @@ def create_config(i, nodes):
 
     node = nodes[i]
     
-    config = node.__dict__.copy()
+    config = node.to_dict()
     config["file_dir"] = os.path.join(TEST_DIR, "store" + str(i))
     node_sample = random.sample(nodes, 7)
     #make sure we aren't in our own list
     node_sample = filter(lambda x: x.node_id != node.node_id, node_sample)    
 
-    config["nodes"] = [n.__dict__ for n in node_sample]
+    config["nodes"] = [n.to_dict() for n in node_sample]
 
 
     filename = os.path.join(TEST_DIR, "config{}.json".format(i))
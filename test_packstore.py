@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from packstore import PackStorage
+
+
+class PackStorageTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.storage = PackStorage(self.dir, cache_size=0, max_pack_size=100)
+        self.addCleanup(lambda: self.storage.close())
+
+    def reopen(self):
+        self.storage.close()
+        self.storage = PackStorage(self.dir, cache_size=0, max_pack_size=100)
+
+    def test_set_get_clear(self):
+        self.assertTrue(self.storage.set("a", b"value a"))
+        self.assertTrue(self.storage.has("a"))
+        self.assertEqual(self.storage.get("a"), b"value a")
+        self.storage.clear("a")
+        self.assertFalse(self.storage.has("a"))
+        self.assertIsNone(self.storage.get("a"))
+        with self.assertRaises(KeyError):
+            self.storage.clear("a")
+
+    def test_open(self):
+        self.storage.set("a", b"first")
+        self.storage.set("b", b"second")
+        file, offset, length = self.storage.open("b")
+        with file:
+            file.seek(offset)
+            self.assertEqual(file.read(length), b"second")
+        self.assertIsNone(self.storage.open("c"))
+
+    def test_create(self):
+        value = self.storage.create("a")
+        value.write(b"part one, ")
+        value.write(b"part two")
+        self.assertFalse(self.storage.has("a"))
+        value.commit()
+        self.assertEqual(self.storage.get("a"), b"part one, part two")
+
+    def test_set_many(self):
+        results = self.storage.set_many([("a", b"x" * 60), ("b", b"y" * 60)], sync=True)
+        self.assertEqual(results, [True, True])
+        self.reopen()
+        self.assertEqual(self.storage.get("a"), b"x" * 60)
+        self.assertEqual(self.storage.get("b"), b"y" * 60)
+
+    def test_size(self):
+        start = self.storage.size
+        self.storage.set("a", b"12345")
+        self.storage.set("a", b"123")
+        self.storage.set("b", b"1234")
+        self.assertEqual(self.storage.size, start + 7)
+        self.assertEqual(self.storage.clear("a"), 3)
+        self.reopen()
+        self.assertEqual(self.storage.size, start + 4)
+
+    def test_index_survives_restart(self):
+        self.storage.set("a", b"x" * 60)
+        self.storage.set("b", b"y" * 60)
+        self.storage.set("a", b"z" * 10)
+        self.storage.clear("b")
+        self.reopen()
+        self.assertEqual(self.storage.get("a"), b"z" * 10)
+        self.assertFalse(self.storage.has("b"))
+
+    def test_torn_index_record_is_dropped(self):
+        self.storage.set("a", b"value a")
+        self.storage.set("b", b"value b")
+        self.storage.index_file.close()
+        path = os.path.join(self.dir, "index.log")
+        with open(path, "r+b") as file:
+            file.truncate(os.path.getsize(path) - 3)
+        self.reopen()
+        self.assertEqual(self.storage.get("a"), b"value a")
+        self.assertFalse(self.storage.has("b"))
+        self.storage.set("c", b"value c")
+        self.reopen()
+        self.assertEqual(self.storage.get("c"), b"value c")
+
+    def test_compaction(self):
+        for key in "abcd":
+            self.storage.set(key, key.encode() * 40)
+        first = self.storage.index["a"][0]
+        self.storage.clear("a")
+        self.storage.clear("b")
+        self.assertGreater(self.storage.maintain(limit=0), 0)
+        self.assertEqual(self.storage.maintain(), 0)
+
+        self.assertNotIn(first, self.storage.pack_keys)
+        self.assertFalse(os.path.exists(self.storage.pack_path(first)))
+        self.assertEqual(self.storage.get("c"), b"c" * 40)
+        self.assertEqual(self.storage.get("d"), b"d" * 40)
+        self.reopen()
+        self.assertEqual(self.storage.get("c"), b"c" * 40)
+
+    def test_close(self):
+        for key in "abcd":
+            self.storage.set(key, key.encode() * 40)
+            self.storage.get(key)
+        maps = list(self.storage.maps.values())
+        files = [self.storage.pack_file, self.storage.index_file]
+        self.assertGreater(len(maps), 1)
+
+        self.storage.close()
+        self.assertTrue(all(mm.closed for mm in maps))
+        self.assertTrue(all(file.closed for file in files))
+        #Closing again does nothing
+        self.storage.close()
+
+        with PackStorage(self.dir, cache_size=0, max_pack_size=100) as storage:
+            self.assertEqual(storage.get("d"), b"d" * 40)
+        self.assertTrue(storage.index_file.closed)
+
+    def test_compaction_closes_removed_packs(self):
+        for key in "abcd":
+            self.storage.set(key, key.encode() * 40)
+            self.storage.get(key)
+        first = self.storage.index["a"][0]
+        mm = self.storage.maps[first]
+        self.storage.clear("a")
+        self.storage.clear("b")
+        self.storage.maintain()
+        self.assertTrue(mm.closed)
+        self.assertNotIn(first, self.storage.maps)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import hashlib
+import heapq
+import unittest
+
+import ranking
+from ranking import NodeRanker
+from routing import Node, Routing
+
+def make_node(i, prefix=""):
+    node_id = prefix + hashlib.sha256(str(i).encode()).hexdigest()[len(prefix):]
+    return Node({ "node_id": node_id, "ip": "127.0.0.1", "port": 50000 + i })
+
+def make_hash(i):
+    return hashlib.sha256(("target" + str(i)).encode()).hexdigest()
+
+def expected(nodes, hash_id, k):
+    target = int(hash_id, 16)
+    return heapq.nsmallest(k, nodes, key=lambda n: n.id ^ target)
+
+
+class NodeRankerTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [make_node(i) for i in range(1000)]
+        self.targets = [make_hash(i) for i in range(100)]
+
+    def test_nearest_matches_heapq(self):
+        ranker = NodeRanker(self.nodes)
+        for hash_id in self.targets[:20]:
+            self.assertEqual(ranker.nearest(hash_id, 20), expected(self.nodes, hash_id, 20))
+
+    def test_batch_matches_heapq(self):
+        for k in (1, 7, 20):
+            results = NodeRanker(self.nodes).nearest_batch(self.targets, k)
+            for hash_id, result in zip(self.targets, results):
+                self.assertEqual(result, expected(self.nodes, hash_id, k))
+
+    def test_batch_with_tied_high_words(self):
+        #All ids share their most significant word, so the preselection can't narrow them down
+        nodes = [make_node(i, prefix="00" * 8) for i in range(600)]
+        results = NodeRanker(nodes).nearest_batch(self.targets, 7)
+        for hash_id, result in zip(self.targets, results):
+            self.assertEqual(result, expected(nodes, hash_id, 7))
+
+    def test_batch_with_some_tied_high_words(self):
+        #Half of the ids share a high word, so some rows narrow down and some don't
+        nodes = [make_node(i, prefix="ab" * 8 if i % 2 else "") for i in range(600)]
+        targets = self.targets + ["ab" * 8 + t[16:] for t in self.targets]
+        results = NodeRanker(nodes).nearest_batch(targets, 7)
+        for hash_id, result in zip(targets, results):
+            self.assertEqual(result, expected(nodes, hash_id, 7))
+
+    def test_k_larger_than_candidates(self):
+        nodes = self.nodes[:5]
+        results = NodeRanker(nodes).nearest_batch(self.targets, 7)
+        for hash_id, result in zip(self.targets, results):
+            self.assertEqual(result, expected(nodes, hash_id, 7))
+
+    def test_invalid_target(self):
+        ranker = NodeRanker(self.nodes)
+        with self.assertRaises(ValueError):
+            ranker.nearest_batch(["abcd"] + self.targets)
+        with self.assertRaises(ValueError):
+            ranker.nearest("0" * 65)
+
+    def test_python_fallback(self):
+        have_numpy = ranking.HAVE_NUMPY
+        ranking.HAVE_NUMPY = False
+        try:
+            results = NodeRanker(self.nodes).nearest_batch(self.targets, 7)
+        finally:
+            ranking.HAVE_NUMPY = have_numpy
+        for hash_id, result in zip(self.targets, results):
+            self.assertEqual(result, expected(self.nodes, hash_id, 7))
+
+
+class RoutingBatchTest(unittest.TestCase):
+    def test_batch_matches_nearest_nodes(self):
+        routing = Routing(make_node(-1), [make_node(i) for i in range(2000)])
+        targets = [make_hash(i) for i in range(50)]
+        for hash_id, result in zip(targets, routing.nearest_nodes_batch(targets)):
+            self.assertEqual(result, routing.nearest_nodes(hash_id))
+
+        #The cached ranker is rebuilt once the table changes
+        removed = routing.nearest_nodes(targets[0])[0]
+        routing.remove_node(removed)
+        self.assertNotIn(removed, routing.nearest_nodes_batch(targets[:1])[0])
+
+    def test_small_table_or_no_numpy_walks_buckets(self):
+        routing = Routing(make_node(-1), [make_node(i) for i in range(100)])
+        targets = [make_hash(i) for i in range(10)]
+        have_numpy = ranking.HAVE_NUMPY
+        for numpy in (have_numpy, False):
+            ranking.HAVE_NUMPY = numpy
+            try:
+                results = routing.nearest_nodes_batch(targets)
+            finally:
+                ranking.HAVE_NUMPY = have_numpy
+            self.assertEqual(results, [routing.nearest_nodes(hash_id) for hash_id in targets])
+            self.assertIsNone(routing.ranker)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import hashlib
+import heapq
+import unittest
+
+from routing import ID_BITS, REPLACEMENT_CACHE_SIZE, KBucket, Node, Routing
+
+OWN_ID = 0
+
+def make_node(n, port=None):
+    return Node({ "node_id": "{:064x}".format(n), "ip": "127.0.0.1",
+        "port": port if port is not None else 50000 + n % 10000 })
+
+def in_bucket(index, i):
+    '''
+    The i-th node whose highest bit differing from our id is index
+    '''
+    return make_node((1 << index) | i)
+
+
+class KBucketTest(unittest.TestCase):
+    def test_touch_orders_by_recency(self):
+        bucket = KBucket(3)
+        a, b, c = make_node(1), make_node(2), make_node(3)
+        for node in (a, b, c):
+            bucket.touch(node)
+        bucket.touch(a)
+        self.assertEqual(list(bucket), [b, c, a])
+        self.assertEqual(bucket.least_recent(), b)
+        self.assertTrue(bucket.is_full())
+
+    def test_replacement_cache_is_bounded(self):
+        bucket = KBucket(1)
+        for n in range(REPLACEMENT_CACHE_SIZE + 5):
+            bucket.add_replacement(make_node(n))
+        self.assertEqual(len(bucket.replacements), REPLACEMENT_CACHE_SIZE)
+        self.assertNotIn(make_node(0).node_id, bucket.replacements)
+
+    def test_remove_promotes_most_recent_replacement(self):
+        bucket = KBucket(2)
+        a, b = make_node(1), make_node(2)
+        bucket.touch(a)
+        bucket.touch(b)
+        bucket.add_replacement(make_node(3))
+        bucket.add_replacement(make_node(4))
+
+        self.assertTrue(bucket.remove(a.node_id))
+        self.assertEqual(list(bucket), [b, make_node(4)])
+        self.assertEqual(list(bucket.replacements), [make_node(3).node_id])
+        self.assertFalse(bucket.remove(a.node_id))
+
+
+class RoutingTest(unittest.TestCase):
+    def setUp(self):
+        self.own = make_node(OWN_ID)
+        self.routing = Routing(self.own, [], bucket_size=2)
+
+    def test_bucket_for_distance(self):
+        for index in (0, 5, 200, ID_BITS - 1):
+            node = in_bucket(index, 0)
+            self.assertIs(self.routing.bucket_for(node), self.routing.buckets[index])
+        self.assertIsNone(self.routing.bucket_for(self.own))
+
+    def test_full_bucket_returns_least_recent(self):
+        first, second, third = in_bucket(10, 0), in_bucket(10, 1), in_bucket(10, 2)
+        self.assertIsNone(self.routing.add_or_update_node(first))
+        self.assertIsNone(self.routing.add_or_update_node(second))
+        self.assertEqual(self.routing.add_or_update_node(third), first)
+
+        bucket = self.routing.buckets[10]
+        self.assertEqual(list(bucket), [first, second])
+        self.assertIn(third.node_id, bucket.replacements)
+
+        #first didn't answer its ping, so third takes its slot
+        self.routing.remove_node(first)
+        self.assertEqual(list(bucket), [second, third])
+
+    def test_add_nodes_only_fills_free_slots(self):
+        known = in_bucket(10, 0)
+        self.routing.add_or_update_node(known)
+        moved = make_node(known.id, port=1)
+        self.routing.add_nodes([moved, in_bucket(10, 1), in_bucket(10, 2)])
+
+        bucket = self.routing.buckets[10]
+        self.assertEqual(bucket.nodes[known.node_id].port, known.port)
+        self.assertEqual(len(bucket), 2)
+        self.assertIn(in_bucket(10, 2).node_id, bucket.replacements)
+
+    def test_nearest_nodes_walks_buckets(self):
+        routing = Routing(self.own, [], bucket_size=20)
+        nodes = [make_node(int(hashlib.sha256(str(i).encode()).hexdigest(), 16) >> (i % 200))
+            for i in range(500)]
+        routing.add_nodes(nodes)
+        nodes = list(routing)
+
+        targets = ["{:064x}".format(0), "{:064x}".format((1 << ID_BITS) - 1)]
+        targets += [hashlib.sha256(str(i).encode()).hexdigest() for i in range(20)]
+        for target in targets:
+            for k in (1, 7, 20):
+                expected = heapq.nsmallest(k, nodes, key=lambda n: n.id ^ int(target, 16))
+                self.assertEqual(routing.nearest_nodes(target, k=k), expected)
+
+    def test_nearest_nodes_with_few_nodes(self):
+        self.routing.add_nodes([in_bucket(3, 0), in_bucket(100, 0)])
+        self.assertEqual(len(self.routing.nearest_nodes("{:064x}".format(1), k=7)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import hashlib
+import unittest
+
+from routing import Node
+from rtt import RTTTable
+
+def make_node(i):
+    node_id = hashlib.sha256(str(i).encode()).hexdigest()
+    return Node({ "node_id": node_id, "ip": "127.0.0.1", "port": 50000 + i })
+
+
+class RTTTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = RTTTable(initial_timeout=1., min_timeout=0.01, max_timeout=15.)
+        self.node = make_node(0)
+
+    def test_unknown_node_uses_initial_timeout(self):
+        self.assertEqual(self.table.timeout(self.node), 1.)
+        self.assertIsNone(self.table.srtt(self.node))
+
+    def test_first_sample(self):
+        self.table.add_sample(self.node, 0.1)
+        self.assertAlmostEqual(self.table.srtt(self.node), 0.1)
+        #srtt + 4 * rttvar, with rttvar starting at half the sample
+        self.assertAlmostEqual(self.table.timeout(self.node), 0.3)
+
+    def test_steady_samples_shrink_timeout(self):
+        for _ in range(50):
+            self.table.add_sample(self.node, 0.005)
+        self.assertAlmostEqual(self.table.srtt(self.node), 0.005)
+        self.assertLess(self.table.timeout(self.node), 0.02)
+
+    def test_timeout_is_clamped(self):
+        for _ in range(50):
+            self.table.add_sample(self.node, 0.0001)
+        self.assertEqual(self.table.timeout(self.node), 0.01)
+
+        self.table.add_sample(self.node, 100.)
+        self.assertEqual(self.table.timeout(self.node), 15.)
+
+    def test_timeouts_back_off_until_next_sample(self):
+        self.table.add_sample(self.node, 0.1)
+        timeout = self.table.timeout(self.node)
+        self.table.timed_out(self.node)
+        self.table.timed_out(self.node)
+        self.assertAlmostEqual(self.table.timeout(self.node), 4 * timeout)
+
+        self.table.add_sample(self.node, 0.1)
+        self.assertLess(self.table.timeout(self.node), 2 * timeout)
+
+    def test_fastest(self):
+        nodes = [make_node(i) for i in range(4)]
+        self.table.add_sample(nodes[2], 0.5)
+        self.table.add_sample(nodes[3], 0.1)
+        self.assertEqual(self.table.fastest(nodes), [nodes[3], nodes[2], nodes[0], nodes[1]])
+
+    def test_max_size(self):
+        table = RTTTable(max_size=2)
+        nodes = [make_node(i) for i in range(3)]
+        for node in nodes:
+            table.add_sample(node, 0.1)
+        self.assertEqual(len(table), 2)
+        self.assertNotIn(nodes[0], table)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from hash_utils import hash_data
+from storage import PARTIAL_PREFIX, ChunkCache, Storage
+
+def key(name):
+    return hash_data(name.encode())
+
+
+class ChunkCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = ChunkCache(100)
+        for key in "abcd":
+            cache.put(key, b"x" * 20)
+        cache.get("a")
+        cache.put("e", b"x" * 25)
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertEqual(cache.size, 85)
+
+    def test_counters(self):
+        cache = ChunkCache(100)
+        cache.put("a", b"x")
+        cache.get("a")
+        cache.get("b")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_large_values_are_not_cached(self):
+        cache = ChunkCache(100)
+        cache.put("a", b"x" * 26)
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.size, 0)
+
+
+class StorageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = Storage(self.dir, cache_size=1 << 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_set_and_clear(self):
+        self.storage.set("a", b"value")
+        self.assertEqual(self.storage.cached("a"), b"value")
+        self.storage.set("a", b"other")
+        self.assertEqual(self.storage.get("a"), b"other")
+        self.storage.clear("a")
+        self.assertIsNone(self.storage.cached("a"))
+        self.assertIsNone(self.storage.get("a"))
+
+    def test_get_fills_cache(self):
+        self.storage.set("a", b"value")
+        self.storage.cache.discard("a")
+        self.assertEqual(self.storage.get("a"), b"value")
+        self.assertEqual(self.storage.cached("a"), b"value")
+
+    def test_commit_invalidates(self):
+        self.storage.set("a", b"value")
+        partial = self.storage.create("a")
+        partial.write(b"new value")
+        partial.commit()
+        self.assertEqual(self.storage.get("a"), b"new value")
+
+    def test_set_many(self):
+        results = self.storage.set_many([("aaaaaa", b"one"), ("bbbbbb", b"two")], sync=True)
+        self.assertEqual(results, [True, True])
+        self.storage.cache.discard("aaaaaa")
+        self.assertEqual(self.storage.get("aaaaaa"), b"one")
+        self.assertEqual(self.storage.get("bbbbbb"), b"two")
+        self.assertFalse(any(name.startswith(".partial-") for name in os.listdir(self.dir)))
+
+    def test_size(self):
+        start = self.storage.size
+        self.storage.set(key("a"), b"12345")
+        self.storage.set(key("a"), b"123")
+        partial = self.storage.create(key("b"))
+        partial.write(b"1234")
+        partial.commit()
+        self.assertEqual(self.storage.size, start + 7)
+        self.assertEqual(self.storage.clear(key("a")), 3)
+        self.assertEqual(self.storage.size, start + 4)
+        self.assertEqual(Storage(self.dir).size, start + 4)
+
+    def test_set_many_reports_failures(self):
+        results = self.storage.set_many([("a", b"one"), ("b", "not bytes")])
+        self.assertEqual(results, [True, False])
+        self.assertFalse(self.storage.has("b"))
+
+
+class StorageIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_index(self, index):
+        Storage(self.dir).set(key("old"), b"value")
+        storage = Storage(self.dir, index=index, bloom_capacity=2)
+        self.assertTrue(storage.has(key("old")))
+        self.assertFalse(storage.has(key("missing")))
+
+        for name in "abc":
+            storage.set(key(name), b"value")
+        partial = storage.create(key("d"))
+        partial.write(b"value")
+        partial.commit()
+        storage.clear(key("a"))
+
+        for name in ("old", "b", "c", "d"):
+            self.assertTrue(storage.has(key(name)))
+        self.assertFalse(storage.has(key("a")))
+        self.assertEqual(sorted(storage.keys()), sorted(storage.list_keys()))
+
+    def test_keys(self):
+        self.check_index("keys")
+
+    def test_bloom(self):
+        self.check_index("bloom")
+
+    def test_none(self):
+        self.check_index("none")
+
+    def test_rewrites_dont_fill_bloom(self):
+        storage = Storage(self.dir, index="bloom", bloom_capacity=2)
+        capacity = storage.bloom_capacity
+        for _ in range(10):
+            storage.set(key("a"), b"value")
+        self.assertEqual(storage.bloom_capacity, capacity)
+
+
+class StorageLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.key = "abcdef" + "0" * 58
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_sharded_paths(self):
+        storage = Storage(self.dir, fanout=(2, 2))
+        storage.set(self.key, b"value")
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "ab", "cd", self.key)))
+        self.assertEqual(Storage(self.dir).get(self.key), b"value")
+        self.assertIn(self.key, Storage(self.dir, index="none").keys())
+
+    def test_migration(self):
+        flat = Storage(self.dir, fanout=())
+        keys = ["{:02x}".format(i) * 32 for i in range(10)]
+        for key in keys:
+            flat.set(key, key.encode())
+        self.assertTrue(os.path.exists(os.path.join(self.dir, keys[0])))
+
+        storage = Storage(self.dir, fanout=(2, 2))
+        #Values are found where they are before they are moved
+        self.assertEqual(storage.get(keys[0]), keys[0].encode())
+        self.assertEqual(storage.migrate(limit=4), len(storage.misplaced))
+        storage.clear(keys[1])
+        self.assertEqual(storage.migrate(), 0)
+
+        for key in keys[2:]:
+            self.assertTrue(os.path.exists(storage.path_for_key(key)))
+            self.assertEqual(Storage(self.dir, index="none").get(key), key.encode())
+        self.assertFalse(storage.has(keys[1]))
+        self.assertEqual(Storage(self.dir).misplaced, {})
+
+        #And back again, removing the emptied shard directories
+        storage = Storage(self.dir, fanout=())
+        storage.migrate()
+        files = [f for f in os.listdir(self.dir) if os.path.isfile(os.path.join(self.dir, f))]
+        self.assertEqual(sorted(files), sorted(storage.keys()))
+        self.assertNotIn("2e", os.listdir(self.dir))
+
+    def test_other_files_are_left_alone(self):
+        flat = Storage(self.dir, fanout=())
+        flat.set(self.key, b"value")
+        others = ["tmp_keys", "tmp_data", "file-{}.hashes".format(self.key[:16])]
+        for name in others:
+            with open(os.path.join(self.dir, name), "wb") as f:
+                f.write(b"not a value")
+        os.makedirs(os.path.join(self.dir, "ab", "cd"), exist_ok=True)
+        partial = os.path.join(self.dir, "ab", "cd", PARTIAL_PREFIX + "x")
+        open(partial, "wb").close()
+
+        storage = Storage(self.dir, fanout=(2, 2))
+        self.assertEqual(list(storage.misplaced), [self.key])
+        self.assertEqual(storage.migrate(), 0)
+        self.assertEqual(sorted(storage.keys()), sorted(storage.list_keys()))
+        self.assertNotIn("tmp_keys", storage.keys())
+        for name in others:
+            self.assertTrue(os.path.isfile(os.path.join(self.dir, name)))
+        self.assertTrue(os.path.exists(partial))
+        self.assertEqual(storage.get(self.key), b"value")
+
+
+if __name__ == "__main__":
+    unittest.main()
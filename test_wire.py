@@ -0,0 +1,61 @@
+import hashlib
+import json
+import unittest
+
+import wire
+
+def make_node(i, ip="127.0.0.1"):
+    return { "node_id": hashlib.sha256(str(i).encode()).hexdigest(), "ip": ip, "port": 50000 + i }
+
+
+class WireTest(unittest.TestCase):
+    def assertRoundTrip(self, message):
+        data = wire.encode(message)
+        self.assertTrue(wire.is_binary(data))
+        self.assertEqual(wire.decode(data), message)
+        return data
+
+    def test_requests(self):
+        hash_id = hashlib.sha256(b"value").hexdigest()
+        for request_type in wire.TYPES:
+            self.assertRoundTrip({ "magic": 1234, "type": request_type,
+                "requester": make_node(1), "params": { "id": hash_id } })
+        self.assertRoundTrip({ "magic": 0, "type": "ping_node",
+            "requester": make_node(2, ip="::1"), "params": {} })
+
+    def test_responses(self):
+        for result in (None, make_node(3), [make_node(i) for i in range(7)], [], "saved"):
+            self.assertRoundTrip({ "magic": 2 ** 32 - 1, "type": "find_value", "resp": True,
+                "result": result })
+
+    def test_overloaded(self):
+        data = self.assertRoundTrip({ "magic": 7, "type": "store_value", "resp": True,
+            "overloaded": True })
+        self.assertEqual(len(data), wire.HEADER.size)
+
+    def test_error(self):
+        self.assertRoundTrip({ "error": "Request has no request magic" })
+
+    def test_smaller_than_json(self):
+        message = { "magic": 1, "type": "find_node", "resp": True,
+            "result": [make_node(i) for i in range(7)] }
+        self.assertLess(3 * len(self.assertRoundTrip(message)), len(json.dumps(message)))
+
+    def test_unencodable(self):
+        request = { "magic": 1, "type": "find_node", "requester": make_node(1), "params": {} }
+        for change in ({ "type": "unknown" }, { "magic": 2 ** 32 }, { "params": { "data": "x" } },
+                { "params": { "id": "ABC" * 21 + "D" } }, { "requester": make_node(1, ip="localhost") }):
+            with self.assertRaises(ValueError):
+                wire.encode(dict(request, **change))
+
+    def test_malformed(self):
+        data = wire.encode({ "magic": 1, "type": "find_node", "resp": True,
+            "result": [make_node(i) for i in range(3)] })
+        for bad in (data[:-1], data + b"\x00", data[:5], bytes([wire.MARKER, 99]) + data[2:]):
+            with self.assertRaises(ValueError):
+                wire.decode(bad)
+        self.assertFalse(wire.is_binary(json.dumps({ "magic": 1 }).encode()))
+
+
+if __name__ == "__main__":
+    unittest.main()
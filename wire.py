@@ -0,0 +1,186 @@
+'''
+Binary encoding of the UDP DHT messages, an alternative to JSON for peers that support it.
+
+A message is a header (marker, version, kind, request type, magic) followed by, for requests,
+the requester node and the id param, for responses the result, and for errors the message.
+Overloaded responses are just the header.
+Nodes are packed as their raw 32 byte id, the ip version and packed address, and the port.
+decode gives back the same dicts as parsing the JSON message would.
+'''
+
+import ipaddress
+import struct
+
+#Binary messages start with this byte, which can't start a JSON message
+MARKER = 0xD4
+VERSION = 1
+
+#marker, version, kind, request type, magic
+HEADER = struct.Struct(">BBBBI")
+REQUEST, RESPONSE, ERROR, OVERLOADED = range(4)
+
+#Request types, by their code on the wire
+TYPES = ["ping_node", "ping_nodes", "find_node", "find_value", "store_value"]
+TYPE_CODES = { t: i for i, t in enumerate(TYPES) }
+
+#Kinds of result, which decide what follows the result kind byte
+NO_RESULT, NODE_RESULT, NODES_RESULT, STRING_RESULT = range(4)
+
+ID_BYTES = 32
+PORT = struct.Struct(">H")
+LENGTH = struct.Struct(">H")
+
+def is_binary(data):
+    return len(data) > 0 and data[0] == MARKER
+
+def encode(message):
+    '''
+    Encodes a message dict, raising ValueError if it has anything the binary format can't
+    represent (the message should be sent as JSON instead)
+    '''
+    try:
+        return pack_message(message)
+    except (struct.error, KeyError, TypeError, AttributeError) as e:
+        raise ValueError("Message has no binary encoding ({})".format(e))
+
+def pack_message(message):
+    if "error" in message:
+        return HEADER.pack(MARKER, VERSION, ERROR, 0, 0) + pack_string(message["error"])
+
+    request_type = message.get("type")
+    if request_type not in TYPE_CODES:
+        raise ValueError("Request type {} has no binary encoding".format(request_type))
+    if message.get("overloaded"):
+        kind = OVERLOADED
+    elif message.get("resp"):
+        kind = RESPONSE
+    else:
+        kind = REQUEST
+    header = HEADER.pack(MARKER, VERSION, kind, TYPE_CODES[request_type], message["magic"])
+
+    if kind == OVERLOADED:
+        return header
+    if message.get("resp"):
+        return header + pack_result(message.get("result"))
+
+    params = message.get("params", {})
+    if len(params.keys() - {"id"}) > 0:
+        raise ValueError("Params {} have no binary encoding".format(params))
+    return header + pack_node(message["requester"]) + pack_id(params.get("id"))
+
+def decode(data):
+    '''
+    Decodes a binary message, raising ValueError if it is malformed
+    '''
+    try:
+        marker, version, kind, type_code, magic = HEADER.unpack_from(data)
+        if marker != MARKER or version != VERSION:
+            raise ValueError("Unsupported message version {}".format(version))
+
+        offset = HEADER.size
+        if kind == ERROR:
+            error, offset = unpack_string(data, offset)
+            message = { "error": error }
+        elif type_code >= len(TYPES):
+            raise ValueError("Unknown request type {}".format(type_code))
+        elif kind == OVERLOADED:
+            message = { "magic": magic, "type": TYPES[type_code], "resp": True, "overloaded": True }
+        elif kind == RESPONSE:
+            result, offset = unpack_result(data, offset)
+            message = { "magic": magic, "type": TYPES[type_code], "resp": True, "result": result }
+        elif kind == REQUEST:
+            requester, offset = unpack_node(data, offset)
+            hash_id, offset = unpack_id(data, offset)
+            params = {} if hash_id is None else { "id": hash_id }
+            message = { "magic": magic, "type": TYPES[type_code], "requester": requester,
+                "params": params }
+        else:
+            raise ValueError("Unknown message kind {}".format(kind))
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError("Malformed message ({})".format(e))
+
+    if offset != len(data):
+        raise ValueError("{} trailing bytes after message".format(len(data) - offset))
+    return message
+
+def pack_id(hash_id):
+    if hash_id is None:
+        return b"\x00"
+    #Ids come back as lowercase hex, so anything else has to go as JSON to be kept as is
+    if not isinstance(hash_id, str) or len(hash_id) != 2 * ID_BYTES or hash_id != hash_id.lower():
+        raise ValueError("Id {} has no binary encoding".format(hash_id))
+    return b"\x01" + bytes.fromhex(hash_id)
+
+def unpack_id(data, offset):
+    if data[offset] == 0:
+        return None, offset + 1
+    offset += 1
+    raw = data[offset:offset + ID_BYTES]
+    if len(raw) != ID_BYTES:
+        raise ValueError("Truncated id")
+    return raw.hex(), offset + ID_BYTES
+
+def pack_node(node):
+    ip = ipaddress.ip_address(node["ip"])
+    return (pack_id(node["node_id"])[1:] + bytes([ip.version]) + ip.packed
+        + PORT.pack(node["port"]))
+
+def unpack_node(data, offset):
+    node_id = data[offset:offset + ID_BYTES]
+    if len(node_id) != ID_BYTES:
+        raise ValueError("Truncated node id")
+    offset += ID_BYTES
+
+    version = data[offset]
+    size = { 4: 4, 6: 16 }.get(version)
+    if size is None:
+        raise ValueError("Unknown ip version {}".format(version))
+    ip = ipaddress.ip_address(data[offset + 1:offset + 1 + size])
+    offset += 1 + size
+
+    port, = PORT.unpack_from(data, offset)
+    return { "node_id": node_id.hex(), "ip": str(ip), "port": port }, offset + PORT.size
+
+def pack_string(s):
+    raw = s.encode("utf8")
+    return LENGTH.pack(len(raw)) + raw
+
+def unpack_string(data, offset):
+    length, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    raw = data[offset:offset + length]
+    if len(raw) != length:
+        raise ValueError("Truncated string")
+    return raw.decode("utf8"), offset + length
+
+def pack_result(result):
+    if result is None:
+        return bytes([NO_RESULT])
+    if isinstance(result, dict):
+        return bytes([NODE_RESULT]) + pack_node(result)
+    if isinstance(result, list):
+        if len(result) > 255:
+            raise ValueError("Too many nodes in result")
+        return bytes([NODES_RESULT, len(result)]) + b"".join(pack_node(n) for n in result)
+    if isinstance(result, str):
+        return bytes([STRING_RESULT]) + pack_string(result)
+    raise ValueError("Result {} has no binary encoding".format(result))
+
+def unpack_result(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == NO_RESULT:
+        return None, offset
+    if kind == NODE_RESULT:
+        return unpack_node(data, offset)
+    if kind == NODES_RESULT:
+        count = data[offset]
+        offset += 1
+        nodes = []
+        for _ in range(count):
+            node, offset = unpack_node(data, offset)
+            nodes.append(node)
+        return nodes, offset
+    if kind == STRING_RESULT:
+        return unpack_string(data, offset)
+    raise ValueError("Unknown result kind {}".format(kind))